@@ -1,16 +1,45 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import plotly.express as px
 from io import BytesIO
 from dotenv import load_dotenv
 import os
-from datetime import datetime
-import plotly.express as px
-from sqlalchemy import text # <-- 1. ADD THIS IMPORT
+import json
+import time
+from functools import partial
 
 # --- Imports for app logic ---
-from classifier import summarize_clusters
-from mapper import get_semantic_clusters, map_feedback_to_dealblockers
+from classifier import (
+    summarize_clusters, resume_summary_run, summary_source_counts, QuotaExhaustedError, FAILED_SUMMARY_LABEL,
+    CARRY_FORWARD_THRESHOLD, LABELER_GEMINI, LABELER_LOCAL, LOCAL_FALLBACK
+)
+from mapper import (
+    get_semantic_clusters, get_linkage_tree, cluster_count_curve, cluster_medoids, compare_context_modes, DISTANCE_THRESHOLD,
+    CONTEXT_MODES, DEFAULT_CONTEXT_MODE,
+    compute_candidate_scores, filter_candidates, threshold_match_counts,
+    compute_reranked_candidates, build_labelled_sample, evaluate_rerank, RERANK_TOP_K, RERANK_BATCH_SIZE,
+    MATCH_MODE_TEXT, MATCH_MODE_CENTROID, MATCH_MODES, match_mode_gold_keys, evaluate_match_modes
+)
+from cluster_embeddings import save_cluster_embeddings, centroids_for
 from jira_connector import fetch_jira_issues
+from integrations.jira_integration import write_back_mapping
+from stage_cache import cache_stats, clear_cache
+from low_memory import LOW_MEMORY_MODE
+from embedding_service import EMBEDDING_SERVICE_URL, RemoteEmbeddingModel
+from exports import EXPORT_FORMATS, build_export, get_export, clear_exports
+from telemetry import run_context, record_metric, summarize_run_metrics, compare_runs, llm_parse_rates
+from profiling import PROFILE_ENV_VAR, profiling_enabled, profile_stage, top_functions, list_profiles
+from visualize import TREEMAP_MAX_LEAVES, build_treemap_frame, cluster_items, treemap_figure
+from history_db import (
+    init_db, new_run_id, save_run_data, load_run_data, get_run_timestamp, load_all_history, clear_all_history,
+    load_trend_clusters, save_run_items, expand_items, ITEM_TEXT_COLUMNS
+)
+from trends import TREND_GRANULARITIES, item_timestamps, update_trends, trend_frame
+from search_index import search, index_step_3_run, index_step_4_run, unindexed_run_ids, backfill_index
+from job_runner import (
+    enqueue_job, get_job, list_jobs, reap_stale_jobs, JOB_TYPE_CONSOLIDATION, JOB_TYPE_MAPPING, ACTIVE_STATUSES, POLL_INTERVAL_SECONDS
+)
 
 # Load env (so jira_connector can read credentials from .env)
 load_dotenv()
@@ -19,74 +48,19 @@ st.set_page_config(page_title="Feedback Consolidation & Dealblocker Mapper", lay
 st.title("🧠 Feedback Consolidation & Dealblocker Mapping Tool")
 
 # -----------------------------------------------------------------
-# --- DATABASE CONNECTION ---
+# --- DATABASE (shared with the background worker, see history_db.py) ---
 # -----------------------------------------------------------------
-conn = st.connection("my_db", type="sql", url="sqlite:///history.db")
-
-# --- Database Utility Functions (NOW FIXED) ---
-
 @st.cache_resource
-def init_db():
+def init_db_once():
     """Create the history tables in the database if they don't exist."""
-    with conn.session as s:
-        # --- 2. WRAP SQL IN text() ---
-        s.execute(text("CREATE TABLE IF NOT EXISTS step_3_history (run_id TEXT, run_timestamp TEXT, data_json TEXT);"))
-        s.execute(text("CREATE TABLE IF NOT EXISTS step_4_history (run_id TEXT, run_timestamp TEXT, data_json TEXT);"))
-        # -----------------------------
-        s.commit()
-
-def save_run_data_db(df, table_name, run_id):
-    """Saves a dataframe to the database for a specific run_id."""
-    if df is None or df.empty:
-        return
-    
-    data_json = df.to_json(orient='records')
-    timestamp = datetime.now().isoformat()
-    
-    with conn.session as s:
-        # --- 3. WRAP SQL IN text() ---
-        s.execute(text(f"DELETE FROM {table_name} WHERE run_id = :id"), params={"id": run_id})
-        s.execute(
-            text(f"INSERT INTO {table_name} (run_id, run_timestamp, data_json) VALUES (:id, :ts, :data)"),
-            params={"id": run_id, "ts": timestamp, "data": data_json}
-        )
-        # -----------------------------
-        s.commit()
-
-def load_all_history_db():
-    """Loads all run data from the database."""
-    with conn.session as s:
-        try:
-            # --- 4. WRAP SQL IN text() ---
-            hist_3 = pd.read_sql(text("SELECT * FROM step_3_history"), s.connection)
-        except Exception as e:
-            print(f"No Step 3 history or error: {e}")
-            hist_3 = pd.DataFrame(columns=['run_id', 'run_timestamp', 'data_json'])
-            
-        try:
-            # --- 5. WRAP SQL IN text() ---
-            hist_4 = pd.read_sql(text("SELECT * FROM step_4_history"), s.connection)
-        except Exception as e:
-            print(f"No Step 4 history or error: {e}")
-            hist_4 = pd.DataFrame(columns=['run_id', 'run_timestamp', 'data_json'])
-            
-    return hist_3, hist_4
-
-def clear_all_history_db():
-    """Deletes all data from the history tables."""
-    with conn.session as s:
-        # --- 6. WRAP SQL IN text() ---
-        s.execute(text("DELETE FROM step_3_history;"))
-        s.execute(text("DELETE FROM step_4_history;"))
-        # -----------------------------
-        s.commit()
+    init_db()
 
 # --- Initialize the database (creates tables if needed) ---
-init_db()
+init_db_once()
 
 # --- Generate a unique ID for this session's run ---
 if "run_id" not in st.session_state:
-    st.session_state.run_id = f"run_{datetime.now().strftime('%Y%m%d_%H%MS')}"
+    st.session_state.run_id = new_run_id()
 
 # -----------------------------------------------------------------
 # --- SIDEBAR - RUN HISTORY (Now reads from DB) ---
@@ -94,8 +68,17 @@ if "run_id" not in st.session_state:
 st.sidebar.title("🕰️ Run History")
 st.sidebar.info(f"Current Run ID: `{st.session_state.run_id}`")
 
+# --- Profiling: FEEDBACK_PROFILE=1, or a toggle only shown with ?debug=1 ---
+profile_toggle = False
+if "debug" in st.query_params:
+    profile_toggle = st.sidebar.toggle(
+        "🔬 Profile Step 3 / Step 4",
+        help=f"Runs the stages under cProfile + tracemalloc. Also enabled by {PROFILE_ENV_VAR}=1."
+    )
+profiling_on = profiling_enabled(profile_toggle)
+
 # ... (This section is unchanged and will work now) ...
-hist_df_3, hist_df_4 = load_all_history_db()
+hist_df_3, hist_df_4 = load_all_history()
 
 all_run_ids = set()
 if not hist_df_3.empty:
@@ -115,7 +98,7 @@ else:
             st.markdown("--- \n #### Step 3: Consolidation")
             data_3 = hist_df_3[hist_df_3['run_id'] == run_id]
             if not data_3.empty:
-                run_3_df = pd.read_json(data_3['data_json'].iloc[0], orient='records')
+                run_3_df = expand_items(pd.read_json(data_3['data_json'].iloc[0], orient='records'), run_id)
                 st.dataframe(run_3_df)
             else:
                 st.write("No Step 3 data for this run.")
@@ -123,15 +106,174 @@ else:
             st.markdown("--- \n #### Step 4: Mapping")
             data_4 = hist_df_4[hist_df_4['run_id'] == run_id]
             if not data_4.empty:
-                run_4_df = pd.read_json(data_4['data_json'].iloc[0], orient='records')
+                run_4_df = expand_items(
+                    pd.read_json(data_4['data_json'].iloc[0], orient='records'), run_id, ITEM_TEXT_COLUMNS["step_4_history"]
+                )
                 st.dataframe(run_4_df)
             else:
                 st.write("No Step 4 data for this run.")
 
+            st.markdown("--- \n #### ⏱️ Performance")
+            perf_df = summarize_run_metrics(run_id)
+            if not perf_df.empty:
+                st.dataframe(perf_df, hide_index=True)
+                parse_rates = llm_parse_rates(run_id)
+                if parse_rates:
+                    st.caption(
+                        f"LLM answers: {parse_rates['responses']} · repaired locally "
+                        f"{parse_rates['repair_rate']:.0%} · unparseable (retried) {parse_rates['parse_failure_rate']:.0%}"
+                    )
+            else:
+                st.write("No performance metrics recorded for this run.")
+
+            profiles_df = list_profiles(run_id)
+            if not profiles_df.empty:
+                st.markdown("--- \n #### 🔬 Profiles")
+                for profile in profiles_df.itertuples():
+                    meta = json.loads(profile.meta_json or "{}")
+                    st.caption(
+                        f"**{profile.name}** · {meta.get('wall_s')} s · "
+                        f"tracemalloc peak {meta.get('tracemalloc_peak_mb')} MB"
+                    )
+                    if not os.path.exists(profile.path):
+                        st.write("Profile file no longer on disk.")
+                        continue
+                    st.dataframe(top_functions(profile.path), hide_index=True)
+                    with open(profile.path, "rb") as f:
+                        st.download_button(
+                            "Download .pstats", f.read(), file_name=os.path.basename(profile.path),
+                            key=f"pstats_{profile.path}"
+                        )
+
+if len(all_run_ids) > 1:
+    with st.sidebar.expander("📈 Compare Run Performance"):
+        compare_ids = st.multiselect("Runs", options=sorted_run_ids, default=sorted_run_ids[:2])
+        comparison_df = compare_runs(compare_ids)
+        if comparison_df.empty:
+            st.write("No metrics for the selected runs.")
+        else:
+            st.caption("Total ms per stage")
+            st.dataframe(comparison_df)
+
 if st.sidebar.button("Clear All History", type="secondary"):
-    clear_all_history_db()
+    clear_all_history()
+    clear_exports()
     st.rerun()
 
+# -----------------------------------------------------------------
+# --- SIDEBAR - STAGE CACHE ---
+# -----------------------------------------------------------------
+with st.sidebar.expander("⚡ Stage Cache"):
+    st.caption("Disk cache for clustering, summarization and mapping (hit rates are for this server process).")
+    stats_df = cache_stats()
+    if stats_df.empty:
+        st.write("Cache is empty.")
+    else:
+        st.dataframe(stats_df, hide_index=True)
+    if st.button("Clear stage cache"):
+        clear_cache()
+        st.rerun()
+
+if EMBEDDING_SERVICE_URL:
+    with st.sidebar.expander("🧮 Embedding Service"):
+        st.caption(f"Shared model at `{EMBEDDING_SERVICE_URL}`")
+        try:
+            st.json(RemoteEmbeddingModel(EMBEDDING_SERVICE_URL).stats())
+        except Exception as e:
+            st.write(f"Service not reachable: {e}")
+
+# -----------------------------------------------------------------
+# --- SIDEBAR - BACKGROUND JOBS ---
+# -----------------------------------------------------------------
+st.sidebar.title("⏳ Background Jobs")
+# A job whose worker died would otherwise show as running (and be polled) forever
+reap_stale_jobs()
+jobs_df = list_jobs(run_id=st.session_state.run_id)
+
+if jobs_df.empty:
+    st.sidebar.write("No background jobs for this run. Start workers with `python job_runner.py`.")
+else:
+    for _, job in jobs_df.iterrows():
+        st.sidebar.markdown(f"**{job['job_type']}** · `{job['status']}` · {job['stage']}")
+        if job["status"] in ACTIVE_STATUSES:
+            st.sidebar.progress(float(job["progress"] or 0.0), text=job["message"] or job["stage"])
+        elif job["status"] == "failed":
+            st.sidebar.error(job["message"])
+            if job["job_type"] == JOB_TYPE_CONSOLIDATION and "QuotaExhaustedError" in str(job["message"]):
+                if st.sidebar.button("Resume run", key=f"resume_job_{job['job_id']}"):
+                    # Same payload + same run_id: the worker skips checkpointed clusters
+                    failed_job = get_job(job["job_id"])
+                    enqueue_job(failed_job["run_id"], JOB_TYPE_CONSOLIDATION, failed_job["payload"])
+                    st.rerun()
+        else:
+            st.sidebar.caption(job["message"])
+            if st.sidebar.button("Load results", key=f"load_job_{job['job_id']}"):
+                table_name = "step_3_history" if job["job_type"] == JOB_TYPE_CONSOLIDATION else "step_4_history"
+                result_df = load_run_data(table_name, job["run_id"])
+                if result_df is not None:
+                    # The job's items are stored under the job's run_id
+                    result_df = expand_items(result_df, job["run_id"], ITEM_TEXT_COLUMNS[table_name])
+                    if job["job_type"] == JOB_TYPE_CONSOLIDATION:
+                        # Step 4 and the treemap read the consolidation report from disk
+                        result_df.to_csv("feedback_consolidation.csv", index=False)
+                st.session_state["loaded_job_result"] = (job["job_type"], result_df)
+
+auto_refresh_jobs = st.sidebar.checkbox("Auto-refresh job status", value=True)
+if st.sidebar.button("Refresh job status"):
+    st.rerun()
+
+
+def poll_jobs():
+    """
+    Reruns the script while this run has queued/running jobs so the sidebar
+    progress stays current without the user clicking anything. Jobs are
+    re-read here, so a job queued earlier in this same rerun counts.
+    """
+    if not auto_refresh_jobs:
+        return
+    jobs = list_jobs(run_id=st.session_state.run_id)
+    if not jobs.empty and jobs["status"].isin(ACTIVE_STATUSES).any():
+        time.sleep(POLL_INTERVAL_SECONDS)
+        st.rerun()
+
+
+def stop_and_poll():
+    """st.stop() for the main page that keeps polling background jobs."""
+    poll_jobs()
+    st.stop()
+
+if "loaded_job_result" in st.session_state:
+    loaded_type, loaded_df = st.session_state["loaded_job_result"]
+    st.subheader(f"📥 Background Job Result ({loaded_type})")
+    if loaded_df is None or loaded_df.empty:
+        st.warning("The job finished but saved no rows.")
+    else:
+        st.dataframe(loaded_df, use_container_width=True)
+
+# -----------------------------------------------------------------
+# --- 🔎 Search past feedback ---
+# -----------------------------------------------------------------
+with st.expander("🔎 Have we heard this before? Search all past feedback and clusters"):
+    search_col_1, search_col_2 = st.columns([5, 1])
+    search_query = search_col_1.text_input("Describe the request", placeholder="e.g. Cucumber support for Playwright")
+    search_k = search_col_2.number_input("Results", min_value=1, max_value=100, value=10)
+    if search_query:
+        with run_context(st.session_state.run_id):
+            search_start = time.perf_counter()
+            search_df = search(search_query, k=int(search_k))
+            search_ms = (time.perf_counter() - search_start) * 1000
+        if search_df.empty:
+            st.write("Nothing indexed yet. Saved Step 3 runs are added automatically.")
+        else:
+            st.caption(f"{search_ms:.0f} ms")
+            st.dataframe(search_df, use_container_width=True, hide_index=True)
+
+    pending_runs = unindexed_run_ids()
+    if pending_runs and st.button(f"Index {len(pending_runs)} run(s) saved before search existed"):
+        search_progress = st.progress(0.0)
+        added = backfill_index(progress_callback=lambda done, total: search_progress.progress(done / total))
+        st.success(f"Indexed {added} new texts.")
+
 # -----------------------------------------------------------------
 # --- Step 1: Upload Feedback CSV ---
 # -----------------------------------------------------------------
@@ -141,18 +283,25 @@ uploaded_file = st.file_uploader("Upload your feedback CSV file", type=["csv", "
 
 if uploaded_file:
     try:
+        parse_start = time.perf_counter()
         if uploaded_file.name.endswith(".csv"):
             feedback_df = pd.read_csv(uploaded_file)
         else:
             feedback_df = pd.read_excel(uploaded_file)
+        # The script re-parses the upload on every rerun; record it once per file
+        upload_signature = (st.session_state.run_id, uploaded_file.name, uploaded_file.size)
+        if st.session_state.get("parsed_upload") != upload_signature:
+            record_metric("file_parse", (time.perf_counter() - parse_start) * 1000, run_id=st.session_state.run_id,
+                          items=len(feedback_df), bytes=uploaded_file.size)
+            st.session_state["parsed_upload"] = upload_signature
         st.success("✅ Feedback file uploaded")
         st.dataframe(feedback_df.head())
     except Exception as e:
         st.error(f"Error reading file: {e}")
-        st.stop()
+        stop_and_poll()
 else:
     st.info("Please upload a feedback CSV/XLSX to begin.")
-    st.stop()
+    stop_and_poll()
 
 # -----------------------------------------------------------------
 # --- Step 2: Fetch Jira Issues ---
@@ -193,19 +342,21 @@ if st.button("Fetch Jira Issues"):
     else:
         with st.spinner("Fetching Jira issues (will use cache if JQL is unchanged)..."):
             try:
-                jira_df = fetch_jira_issues(jql_to_run)
+                with run_context(st.session_state.run_id):
+                    jira_df = fetch_jira_issues(jql_to_run)
                 if jira_df is None or jira_df.empty:
                     st.warning("No Jira issues returned for this JQL. Try adjusting the JQL or check Jira permissions.")
                 else:
                     st.success(f"Fetched {len(jira_df)} Jira issues")
                     st.dataframe(jira_df.head())
-                    # --- FIX ---
-                    csv_data = jira_df.to_csv(index=False).encode('utf-8')
-                    st.download_button(
-                        label="⬇️ Download Jira Results (CSV)",
-                        data=csv_data,
-                        file_name="jira_dealblockers.csv",
-                        mime='text/csv')
+                    # Built once per fetched result and streamed from disk
+                    jira_export = build_export(jira_df, st.session_state.run_id, "jira_dealblockers", "csv")
+                    with open(jira_export, "rb") as f:
+                        st.download_button(
+                            label="⬇️ Download Jira Results (CSV)",
+                            data=f,
+                            file_name="jira_dealblockers.csv",
+                            mime='text/csv')
             except Exception as e:
                 st.error(f"Error fetching Jira issues: {e}")
 
@@ -220,117 +371,373 @@ selected_columns = st.multiselect(
     default=[feedback_df.columns[0]] if len(feedback_df.columns) > 0 else [],
 )
 
+NO_TIMESTAMP_COLUMN = "(none: date the run is saved)"
+timestamp_column = st.selectbox(
+    "Feedback timestamp column (for trends):",
+    options=[NO_TIMESTAMP_COLUMN] + feedback_df.columns.tolist(),
+    help="Dates each feedback item in the Cluster Trends chart, e.g. Slack `ts` or Jira `Created`. "
+         "Epoch seconds and date strings are both understood."
+)
+
 user_context = st.text_area(
     "Add Context (Optional):",
     placeholder="e.g., 'Focus on mobile performance' or 'We are a gaming company'. This will influence both grouping and labeling."
 )
 
+context_mode = st.radio(
+    "How context influences grouping:",
+    options=CONTEXT_MODES,
+    index=CONTEXT_MODES.index(DEFAULT_CONTEXT_MODE),
+    horizontal=True,
+    help="prefix: re-encode every item with the context prepended (slowest). "
+         "blend / projection: reuse cached item embeddings and encode only the context."
+)
+
+distance_threshold = st.slider(
+    "Clustering Distance Threshold",
+    min_value=0.05,
+    max_value=0.95,
+    value=DISTANCE_THRESHOLD,
+    step=0.01,
+    help="Lower = tighter, more numerous clusters. The merge tree is cached, so re-cutting it is instant."
+)
+
+reuse_previous_summaries = st.checkbox(
+    "Reuse summaries of clusters that barely changed since the previous run", value=True,
+    help="Clusters whose items overlap a cluster of the last saved run (same context) by at least the "
+         "threshold below keep its label, category and reasoning; only the counts and issue keys are updated."
+)
+carry_forward_threshold = st.slider(
+    "Membership overlap needed to reuse a summary (Jaccard)",
+    min_value=0.5, max_value=1.0, value=CARRY_FORWARD_THRESHOLD, step=0.05
+) if reuse_previous_summaries else None
+
+labeler = st.radio(
+    "Cluster labels",
+    [LABELER_GEMINI, LABELER_LOCAL],
+    format_func={
+        LABELER_GEMINI: "Gemini summaries",
+        LABELER_LOCAL: "Local keywords (no LLM, instant)",
+    }.get,
+    horizontal=True,
+    help="Local labels use each cluster's most distinctive keywords (c-TF-IDF) as the label and its most "
+         "representative item as the reasoning. Good for a quick overview or when Gemini is unavailable."
+)
+local_fallback = st.checkbox(
+    "Fall back to local labels when Gemini fails", value=LOCAL_FALLBACK,
+    disabled=labeler == LABELER_LOCAL,
+    help="Clusters Gemini can't summarize (quota exhausted, unparseable answers) get local labels instead of "
+         "an error row. 'Resume run' retries them with Gemini later."
+)
+
+low_memory = st.checkbox(
+    "Low-memory mode (large backfills)",
+    value=LOW_MEMORY_MODE,
+    help="Keeps embeddings as float16 on disk and clusters them block by block with a greedy centroid pass. "
+         "Use it for very large files; the threshold tuning curve is not available in this mode."
+)
+
+# --- Threshold tuning: cluster count vs threshold from the cached merge tree ---
+if "step_3_tree" in st.session_state and not low_memory:
+    tree, n_items, tree_input, tree_context = st.session_state["step_3_tree"]
+    with st.expander("📉 Tune clustering threshold", expanded=False):
+        curve_df = cluster_count_curve(tree, n_items, np.round(np.arange(0.05, 0.951, 0.01), 2))
+        current_count = int(cluster_count_curve(tree, n_items, [distance_threshold])["clusters"].iloc[0])
+        st.write(f"**{current_count}** clusters from {n_items} feedback items at threshold {distance_threshold:.2f}. "
+                 "Re-run the report to apply a new threshold (no re-embedding needed).")
+        fig = px.line(curve_df, x="threshold", y="clusters", markers=True)
+        fig.add_vline(x=distance_threshold, line_dash="dash")
+        fig.update_layout(margin=dict(t=30, l=25, r=25, b=25), height=300)
+        st.plotly_chart(fig, use_container_width=True)
+
+        if tree_context and tree_context.strip():
+            if st.button("Compare context modes on this data"):
+                with st.spinner("Clustering with every context mode..."):
+                    st.dataframe(
+                        compare_context_modes(tree_input, "combined_text", tree_context, distance_threshold),
+                        hide_index=True
+                    )
+                st.caption("ari_vs_prefix: agreement with the prefix grouping (1.0 = identical).")
+
+def export_controls(name, table_name, label):
+    """
+    Download of this run's saved result in a chosen format. The file is only
+    built when asked for, once per saved version, and only read for the
+    download right after "Prepare" is clicked.
+    """
+    run_id = st.session_state.run_id
+    saved_at = get_run_timestamp(table_name, run_id)
+    if saved_at is None:
+        return
+    format_col, button_col = st.columns([1, 3])
+    fmt = format_col.selectbox("Export format", list(EXPORT_FORMATS), key=f"export_format_{name}")
+    # Streamlit reads a download_button's whole file into memory each time it
+    # is rendered, so the button only exists in the rerun of this click
+    if not button_col.button(f"Prepare {fmt} export", key=f"export_build_{name}"):
+        return
+    path = get_export(run_id, name, fmt, saved_at)
+    if path is None:
+        try:
+            with st.spinner(f"Building {fmt} export..."):
+                saved_df = expand_items(load_run_data(table_name, run_id), run_id, ITEM_TEXT_COLUMNS[table_name])
+                path = build_export(saved_df, run_id, name, fmt, version=saved_at)
+        except ValueError as e:
+            st.error(str(e))
+            return
+    extension, mime = EXPORT_FORMATS[fmt]
+    with open(path, "rb") as f:
+        button_col.download_button(
+            label=f"{label} ({fmt})", data=f, file_name=f"{name}{extension}", mime=mime,
+            key=f"export_download_{name}"
+        )
+
+
+def show_consolidation_result(clustered_df, quota_error=None, timestamps_by_text=None):
+    """Displays, saves and offers the download of a Step 3 result, and adds it to the trend rollups."""
+    if quota_error is not None:
+        st.warning(f"⚠️ {quota_error}\n\nFinished summaries are checkpointed. Use 'Resume run' once quota is available.")
+    else:
+        st.success("✅ Feedback Consolidation Complete")
+    source_counts = summary_source_counts(clustered_df)
+    carried_forward, fallback = source_counts["carried_forward"], source_counts["local_fallback"]
+    if carried_forward:
+        st.info(f"♻️ {carried_forward} of {sum(source_counts.values())} cluster summaries were reused from the "
+                f"previous run ({carried_forward} LLM calls saved).")
+
+    if clustered_df is None or clustered_df.empty:
+        st.warning("No clusters generated. Check if selected columns contain meaningful text.")
+        return
+
+    failed = int((clustered_df["cluster_label"] == FAILED_SUMMARY_LABEL).sum())
+    if quota_error is None and failed == 0 and fallback == 0:
+        st.session_state.pop("step_3_resume", None)
+    elif failed:
+        st.warning(f"{failed} cluster(s) failed to summarize. 'Resume run' retries only those.")
+    elif fallback:
+        st.warning(f"{fallback} cluster(s) got local keyword labels because Gemini failed. "
+                   "'Resume run' retries only those with Gemini.")
+
+    st.subheader("🧠 Feedback Clusters Summary (Current Run)")
+    # Clusters reference their items by id; the texts are only joined in here
+    expanded_df = expand_items(clustered_df, st.session_state.run_id)
+    expanded_df.to_csv("feedback_consolidation.csv", index=False)
+    
+    clustered_df_display = expanded_df.copy()
+    clustered_df_display["feedback_text"] = clustered_df_display["feedback_text"].apply(
+        lambda x: str(x)[:250] + "..." if len(str(x)) > 250 else str(x)
+    )
+    st.dataframe(clustered_df_display, use_container_width=True)
+
+    # --- SAVE TO DB ---
+    save_run_data(clustered_df, "step_3_history", st.session_state.run_id)
+    update_trends(st.session_state.run_id, clustered_df, timestamps_by_text)
+    try:
+        index_step_3_run(st.session_state.run_id, clustered_df)
+    except Exception as e:
+        st.warning(f"Saved, but could not add this run to the search index: {e}")
+    st.toast(f"Saved results to history! Sidebar will update on next refresh.")
+
+run_step_3_in_background = st.checkbox(
+    "Run in background worker", key="step_3_background",
+    help="Queue this run for `job_runner.py` instead of computing it in this browser session."
+)
+
 if st.button("Generate Feedback Consolidation Report", type="primary"):
     if selected_columns:
         try:
-            feedback_df["combined_text"] = feedback_df[selected_columns] \
-                .astype(str).apply(lambda row: " ".join([v for v in row if v and v.lower() != "nan"]), axis=1)
-
-            with st.spinner("Step 1/2: Finding semantic clusters (using cache)..."):
+            # Build the text column in its own frame: adding it to feedback_df in
+            # place would change the uploaded data on every rerun.
+            step_3_input = pd.DataFrame({
+                "combined_text": feedback_df[selected_columns]
+                    .astype(str).apply(lambda row: " ".join([v for v in row if v and v.lower() != "nan"]), axis=1)
+            })
+
+            timestamps_by_text = None
+            if timestamp_column != NO_TIMESTAMP_COLUMN:
+                timestamps_by_text = item_timestamps(step_3_input["combined_text"], feedback_df[timestamp_column])
+
+            if run_step_3_in_background:
+                job_id = enqueue_job(st.session_state.run_id, JOB_TYPE_CONSOLIDATION, {
+                    "texts": step_3_input["combined_text"].tolist(),
+                    "user_context": user_context,
+                    "distance_threshold": distance_threshold,
+                    "context_mode": context_mode,
+                    "low_memory": low_memory,
+                    "carry_forward_threshold": carry_forward_threshold,
+                    "labeler": labeler,
+                    "local_fallback": local_fallback,
+                    "timestamps": None if timestamp_column == NO_TIMESTAMP_COLUMN
+                                  else feedback_df[timestamp_column].astype(str).tolist(),
+                })
+                st.success(f"✅ Queued consolidation job `{job_id}`. Track it under Background Jobs in the sidebar.")
+                stop_and_poll()
+
+            with st.spinner("Step 1/2: Finding semantic clusters (using cache)..."), run_context(st.session_state.run_id), \
+                    profile_stage(st.session_state.run_id, "step_3_clustering", enabled=profiling_on):
                 feedback_groups = get_semantic_clusters(
-                    feedback_df, "combined_text", grouping_context=user_context
+                    step_3_input, "combined_text", grouping_context=user_context,
+                    distance_threshold=distance_threshold, context_mode=context_mode, low_memory=low_memory
                 )
+                if low_memory:
+                    st.session_state.pop("step_3_tree", None)
+                else:
+                    # Cache hit: get_semantic_clusters just built this tree
+                    st.session_state["step_3_tree"] = (
+                        get_linkage_tree(step_3_input, "combined_text", grouping_context=user_context, context_mode=context_mode),
+                        len(step_3_input), step_3_input, user_context
+                    )
                 if not feedback_groups:
                     st.error("Clustering failed to produce any groups.")
-                    st.stop()
-
-            with st.spinner(f"Step 2/2: Using Gemini to summarize {len(feedback_groups)} clusters (using cache)..."):
-                clustered_df = summarize_clusters(
-                    feedback_groups, labeling_context=user_context
-                )
-            
-            st.success("✅ Feedback Consolidation Complete")
-
-            if not clustered_df.empty:
-                st.subheader("🧠 Feedback Clusters Summary (Current Run)")
-                clustered_df.to_csv("feedback_consolidation.csv", index=False)
-                
-                clustered_df_display = clustered_df.copy()
-                clustered_df_display["feedback_text"] = clustered_df_display["feedback_text"].apply(
-                    lambda x: str(x)[:250] + "..." if len(str(x)) > 250 else str(x)
-                )
-                st.dataframe(clustered_df_display, use_container_width=True)
-                csv_data_3 = clustered_df.to_csv(index=False).encode('utf-8')
-                st.download_button(
-                    label="⬇️ Download Consolidated Feedback (CSV)",
-                    data=csv_data_3,
-                    file_name="feedback_consolidation.csv",
-                    mime='text/csv'
-                )
-                
-                # --- SAVE TO DB ---
-                save_run_data_db(clustered_df, "step_3_history", st.session_state.run_id)
-                st.toast(f"Saved results to history! Sidebar will update on next refresh.")
-
-            else:
-                st.warning("No clusters generated. Check if selected columns contain meaningful text.")
+                    stop_and_poll()
+                save_run_items(st.session_state.run_id, [t for texts in feedback_groups.values() for t in texts])
+                try:
+                    # Lets Step 4 match clusters on their centroids without re-encoding
+                    save_cluster_embeddings(
+                        st.session_state.run_id, step_3_input, "combined_text", feedback_groups,
+                        grouping_context=user_context, context_mode=context_mode, low_memory=low_memory
+                    )
+                except Exception as e:
+                    st.warning(f"Could not save the cluster embeddings (centroid matching is unavailable): {e}")
+
+            summarize_message = (
+                f"Step 2/2: Labeling {len(feedback_groups)} clusters locally..." if labeler == LABELER_LOCAL
+                else f"Step 2/2: Using Gemini to summarize {len(feedback_groups)} clusters (using cache)..."
+            )
+            # Local labels take their medoids from the embeddings clustering just used
+            medoid_fn = partial(
+                cluster_medoids, step_3_input, "combined_text", feedback_groups,
+                grouping_context=user_context, context_mode=context_mode, low_memory=low_memory
+            )
+            with st.spinner(summarize_message), \
+                    run_context(st.session_state.run_id), \
+                    profile_stage(st.session_state.run_id, "step_3_summarization", enabled=profiling_on):
+                try:
+                    clustered_df = summarize_clusters(
+                        feedback_groups, labeling_context=user_context, run_id=st.session_state.run_id,
+                        carry_forward_threshold=carry_forward_threshold, labeler=labeler,
+                        local_fallback=local_fallback, medoid_fn=medoid_fn
+                    )
+                    quota_error = None
+                except QuotaExhaustedError as e:
+                    clustered_df, quota_error = e.partial_df, e
+
+            # Keep what a resume needs; successful summaries are already checkpointed
+            st.session_state["step_3_resume"] = {
+                "groups": feedback_groups, "user_context": user_context, "timestamps": timestamps_by_text,
+                "medoid_fn": medoid_fn, "carry_forward_threshold": carry_forward_threshold
+            }
+            show_consolidation_result(clustered_df, quota_error, timestamps_by_text)
         except Exception as e:
             st.error(f"Error during classification: {e}")
     else:
         st.warning("Please select at least one column to classify.")
 
+if "step_3_resume" in st.session_state:
+    if st.button("▶️ Resume run", help="Re-summarize only the failed or missing clusters of this run and merge them in."):
+        resume = st.session_state["step_3_resume"]
+        with st.spinner(f"Resuming summarization of {len(resume['groups'])} clusters..."), run_context(st.session_state.run_id):
+            try:
+                clustered_df = resume_summary_run(
+                    resume["groups"], st.session_state.run_id, labeling_context=resume["user_context"],
+                    carry_forward_threshold=resume.get("carry_forward_threshold", carry_forward_threshold),
+                    local_fallback=local_fallback, medoid_fn=resume.get("medoid_fn")
+                )
+                quota_error = None
+            except QuotaExhaustedError as e:
+                clustered_df, quota_error = e.partial_df, e
+        show_consolidation_result(clustered_df, quota_error, resume.get("timestamps"))
+
+export_controls("feedback_consolidation", "step_3_history", "⬇️ Download Consolidated Feedback")
+
 # -----------------------------------------------------------------
 # --- 🗺️ Visualize Clusters ---
 # -----------------------------------------------------------------
 st.subheader("🗺️ Visualize Clusters")
-# ... (This section is unchanged) ...
+
+@st.cache_data(max_entries=20)
+def load_treemap_data(run_id, saved_at, max_leaves):
+    """
+    Builds the treemap rows for one run. Cached per run_id; saved_at (the
+    run's save timestamp) invalidates the entry when the run is re-saved.
+    """
+    clustered_df = expand_items(load_run_data("step_3_history", run_id), run_id)
+    if clustered_df is None:
+        # Runs loaded from an older session only exist on disk
+        clustered_df = pd.read_csv("feedback_consolidation.csv")
+    treemap_df, aggregated = build_treemap_frame(clustered_df, max_leaves=max_leaves)
+    return clustered_df, treemap_df, aggregated
+
+max_treemap_leaves = st.number_input(
+    "Max individual feedback boxes (above this, clusters are shown as counts)",
+    min_value=100, value=TREEMAP_MAX_LEAVES, step=500
+)
+
 if st.button("Generate Mindmap / Treemap"):
+    st.session_state["show_treemap"] = True
+
+if st.session_state.get("show_treemap"):
     try:
-        clustered_df = pd.read_csv("feedback_consolidation.csv")
+        clustered_df, treemap_df, aggregated = load_treemap_data(
+            st.session_state.run_id,
+            get_run_timestamp("step_3_history", st.session_state.run_id),
+            int(max_treemap_leaves)
+        )
         
         if 'category' not in clustered_df.columns or 'cluster_label' not in clustered_df.columns or 'feedback_text' not in clustered_df.columns:
             st.error("Could not find 'category', 'cluster_label', or 'feedback_text' in the saved data.")
+        elif treemap_df.empty:
+            st.warning("No individual feedback items to display.")
         else:
-            treemap_data = []
-            for _, row in clustered_df.iterrows():
-                try:
-                    feedback_texts = str(row['feedback_text']).split(' | ')
-                except Exception:
-                    feedback_texts = ["Error parsing feedback"]
-                
-                for text in feedback_texts:
-                    if text.strip():
-                        treemap_data.append({
-                            'category': row['category'],
-                            'cluster_label': row['cluster_label'],
-                            'reasoning': row['reasoning'],
-                            'individual_feedback': text.strip(),
-                            'size': 1
-                        })
-
-            if not treemap_data:
-                st.warning("No individual feedback items to display.")
-                st.stop()
-                
-            treemap_df = pd.DataFrame(treemap_data)
-            
-            st.info("Generating interactive treemap... You can click to zoom. Boxes are sized equally.")
-            fig = px.treemap(
-                treemap_df,
-                path=[px.Constant("All Feedback"), 'category', 'cluster_label', 'individual_feedback'],
-                values='size',
-                color='category',
-                hover_data={
-                    'reasoning': True,
-                    'cluster_label': True,
-                    'individual_feedback': True,
-                    'size': False
-                }
+            if aggregated:
+                st.info(f"More than {int(max_treemap_leaves)} feedback items: boxes are clusters sized by item count. "
+                        "Pick a cluster below to see its individual items.")
+            else:
+                st.info("Generating interactive treemap... You can click to zoom. Boxes are sized equally.")
+            st.plotly_chart(treemap_figure(treemap_df, aggregated=aggregated), use_container_width=True)
+
+            # --- Drill-down: load a single cluster's items on demand ---
+            drill_label = st.selectbox(
+                "Drill into a cluster:",
+                options=["(none)"] + sorted(clustered_df["cluster_label"].astype(str).unique().tolist())
             )
-            fig.update_traces(hovertemplate='<b>Cluster:</b> %{customdata[1]}<br><b>Feedback:</b> %{customdata[2]}<br><b>Reasoning:</b> %{customdata[0]}<extra></extra>')
-            fig.update_layout(margin = dict(t=50, l=25, r=25, b=25))
-            st.plotly_chart(fig, use_container_width=True)
+            if drill_label != "(none)":
+                items_df = cluster_items(clustered_df, drill_label)
+                st.write(f"{len(items_df)} feedback item(s) in **{drill_label}**")
+                st.dataframe(items_df[["individual_feedback"]], use_container_width=True, hide_index=True)
 
     except FileNotFoundError:
         st.error("Please run Step 3 'Generate Feedback Consolidation Report' first to create the data.")
     except Exception as e:
         st.error(f"An error occurred while generating the treemap: {e}")
 
+# -----------------------------------------------------------------
+# --- 📈 Cluster Trends ---
+# -----------------------------------------------------------------
+st.subheader("📈 Cluster Trends")
+
+trend_clusters_df = load_trend_clusters(limit=200)
+if trend_clusters_df.empty:
+    st.write("No trends yet. Every saved Step 3 run adds its clusters here.")
+else:
+    trend_labels = dict(zip(
+        trend_clusters_df["trend_key"],
+        trend_clusters_df["label"].astype(str) + " (" + trend_clusters_df["total_items"].astype(str) + ")"
+    ))
+    trend_col_1, trend_col_2 = st.columns([4, 1])
+    chosen_trends = trend_col_1.multiselect(
+        "Clusters", options=list(trend_labels), default=list(trend_labels)[:5], format_func=trend_labels.get
+    )
+    granularity = trend_col_2.radio("Per", TREND_GRANULARITIES, index=1, horizontal=True)
+    trend_df = trend_frame(chosen_trends, granularity)
+    if trend_df.empty:
+        st.write("No items for the selected clusters.")
+    else:
+        trend_df["cluster"] = trend_df["trend_key"].map(trend_labels)
+        fig = px.line(trend_df, x="bucket", y="item_count", color="cluster", markers=True,
+                      labels={"bucket": granularity, "item_count": "new feedback items"})
+        fig.update_layout(margin=dict(t=30, l=25, r=25, b=25), height=350, legend_title_text="")
+        st.plotly_chart(fig, use_container_width=True)
+
 # -----------------------------------------------------------------
 # --- Step 4: Map Feedback → Jira Dealblockers (clustered) ---
 # -----------------------------------------------------------------
@@ -346,53 +753,189 @@ match_threshold = st.slider(
     value=0.7,  # <-- Default value
     step=0.05
 )
-st.info("This step reads the saved files from Step 2 and 3 and maps them using both explicit keys and semantic search.")
+st.info("This step reads the saved files from Step 2 and 3 and maps them using both explicit keys and semantic search. "
+        "Once scored, moving the threshold slider re-filters the results instantly.")
+
+use_rerank = st.checkbox(
+    "Rerank candidates with the cross-encoder",
+    help="Two-stage matching: the bi-encoder retrieves the top-k Jira issues per cluster and a local "
+         "cross-encoder re-scores only those. More accurate, slower."
+)
+if use_rerank:
+    rerank_col_1, rerank_col_2 = st.columns(2)
+    rerank_top_k = rerank_col_1.number_input("Candidates per cluster (k)", min_value=1, max_value=100, value=RERANK_TOP_K)
+    rerank_batch_size = rerank_col_2.number_input("Cross-encoder batch size", min_value=1, max_value=512, value=RERANK_BATCH_SIZE)
+
+    with st.expander("🎯 Evaluate reranking on labelled history"):
+        st.caption("Uses the semantic matches in step_4_mapping_history.csv as labels (add an is_correct column to "
+                   "use only reviewed rows) against the current jira_dealblockers.csv.")
+        if st.button("Run evaluation"):
+            try:
+                eval_jira = pd.read_csv("jira_dealblockers.csv")
+                labelled_df = build_labelled_sample(eval_jira)
+                with st.spinner(f"Scoring {len(labelled_df)} labelled clusters both ways..."), \
+                        run_context(st.session_state.run_id):
+                    eval_df = evaluate_rerank(labelled_df, eval_jira, top_k=int(rerank_top_k), batch_size=int(rerank_batch_size))
+                if eval_df.empty:
+                    st.warning("No labelled rows match the current Jira snapshot.")
+                else:
+                    st.dataframe(eval_df, hide_index=True)
+            except FileNotFoundError as e:
+                st.error(f"Missing file for evaluation: {e}")
+
+match_mode = st.radio(
+    "Match clusters on", MATCH_MODES, horizontal=True,
+    format_func=lambda mode: {MATCH_MODE_TEXT: "Summary text (re-encoded)",
+                              MATCH_MODE_CENTROID: "Member centroid (from Step 3)"}[mode],
+    help="Centroid matching compares Jira with the mean embedding of each cluster's feedback, saved by Step 3, "
+         "so no feedback text is encoded here. Its scores run on a different scale than summary text: "
+         "check the matches-per-threshold table before trusting the 0.7 default."
+)
+
+with st.expander("⚖️ Compare summary-text vs centroid matching"):
+    st.caption("Scores this run's clusters both ways against the current jira_dealblockers.csv. Clusters that "
+               "mention a Jira key (hidden from both modes) and saved semantic mappings serve as labels.")
+    if st.button("Run comparison"):
+        compare_feedback = load_run_data("step_3_history", st.session_state.run_id)
+        compare_centroids = centroids_for(compare_feedback, st.session_state.run_id)
+        if compare_centroids is None:
+            st.warning("This run has no saved Step 3 result with cluster embeddings. Run Step 3 first.")
+        else:
+            try:
+                compare_jira = pd.read_csv("jira_dealblockers.csv")
+                with st.spinner(f"Scoring {len(compare_feedback)} clusters both ways..."), run_context(st.session_state.run_id):
+                    compare_df = evaluate_match_modes(
+                        compare_feedback, compare_jira, compare_centroids,
+                        gold_keys=match_mode_gold_keys(compare_feedback, compare_jira)
+                    )
+                st.dataframe(compare_df, hide_index=True)
+            except FileNotFoundError as e:
+                st.error(f"Missing file for comparison: {e}")
+
+run_step_4_in_background = st.checkbox(
+    "Run in background worker", key="step_4_background",
+    help="Queue this run for `job_runner.py` instead of computing it in this browser session."
+)
 
 if st.button("Run Mapping with Dealblockers"):
-    try:
-        feedback_consolidation = pd.read_csv("feedback_consolidation.csv")
-    except FileNotFoundError:
-        st.error("Feedback consolidation report not found. Run Step 3 first.")
-        st.stop()
+    # Prefer this run's saved Step 3 result: it keeps issue_keys as native
+    # lists, whereas the CSV only has their string form.
+    feedback_consolidation = load_run_data("step_3_history", st.session_state.run_id)
+    if feedback_consolidation is None:
+        try:
+            feedback_consolidation = pd.read_csv("feedback_consolidation.csv")
+        except FileNotFoundError:
+            st.error("Feedback consolidation report not found. Run Step 3 first.")
+            stop_and_poll()
 
     try:
         jira_dealblockers = pd.read_csv("jira_dealblockers.csv")
     except FileNotFoundError:
         st.error("Jira dealblockers CSV not found. Run Step 2 (Fetch Jira Issues) first.")
-        st.stop()
-
-    with st.spinner("Mapping consolidated feedback clusters to Jira dealblockers (using cache)..."):
+        stop_and_poll()
+
+    centroids = None
+    if match_mode == MATCH_MODE_CENTROID:
+        centroids = centroids_for(feedback_consolidation, st.session_state.run_id)
+        if centroids is None:
+            st.warning("No saved cluster embeddings for this run; matching on summary text instead.")
+
+    if run_step_4_in_background:
+        job_id = enqueue_job(st.session_state.run_id, JOB_TYPE_MAPPING, {
+            "feedback_records": feedback_consolidation.to_dict(orient="records"),
+            "jira_records": jira_dealblockers.to_dict(orient="records"),
+            "similarity_threshold": match_threshold,
+            "rerank": use_rerank,
+            "rerank_top_k": int(rerank_top_k) if use_rerank else RERANK_TOP_K,
+            "rerank_batch_size": int(rerank_batch_size) if use_rerank else RERANK_BATCH_SIZE,
+            "match_mode": match_mode,
+        })
+        st.success(f"✅ Queued mapping job `{job_id}`. Track it under Background Jobs in the sidebar.")
+        stop_and_poll()
+
+    with st.spinner("Scoring consolidated feedback clusters against Jira dealblockers (using cache)..."):
         try:
-            mapped_df = map_feedback_to_dealblockers(
-                feedback_consolidation, 
-                jira_dealblockers,
-                similarity_threshold=match_threshold  # <-- Pass the slider value
-            )
-            if mapped_df is None or mapped_df.empty:
-                st.warning("No mappings were found.")
-            else:
-                st.success("✅ Mapping complete")
-                st.subheader("🗺️ Mapped Results (Current Run)")
+            # Scores don't depend on the threshold; the slider only filters them below
+            with run_context(st.session_state.run_id), \
+                    profile_stage(st.session_state.run_id, "step_4_mapping", enabled=profiling_on):
+                if use_rerank:
+                    candidates = compute_reranked_candidates(
+                        feedback_consolidation, jira_dealblockers, top_k=int(rerank_top_k), batch_size=int(rerank_batch_size),
+                        centroids=centroids
+                    )
+                else:
+                    candidates = compute_candidate_scores(feedback_consolidation, jira_dealblockers, centroids=centroids)
+            st.session_state["step_4_candidates"] = (candidates, feedback_consolidation, jira_dealblockers)
+            st.session_state.pop("step_4_saved_threshold", None)
+        except Exception as e:
+            st.error(f"Error mapping feedback and Jira issues: {e}")
 
-                mapped_df_display = mapped_df.copy()
-                
-               # if "original_feedback_texts" in mapped_df_display.columns:
-                 #   mapped_df_display["original_feedback_texts"] = mapped_df_display["original_feedback_texts"].apply(
-                 #       lambda x: str(x)[:250] + "..." if len(str(x)) > 250 else str(x)
-                 #   )
-                
-                st.dataframe(mapped_df_display.head(100), use_container_width=True)
-
-                csv_data_4 = mapped_df.to_csv(index=False).encode('utf-8')
-                st.download_button(
-                    label="⬇️ Download Mapped Feedback → Dealblockers CSV",
-                    data=csv_data_4,
-                    file_name="mapped_feedback_dealblockers.csv",
-                    mime='text/csv')
-                
-                # --- SAVE TO DB ---
-                save_run_data_db(mapped_df, "step_4_history", st.session_state.run_id)
+if "step_4_candidates" in st.session_state:
+    candidates, feedback_consolidation, jira_dealblockers = st.session_state["step_4_candidates"]
+    try:
+        mapped_df = filter_candidates(
+            candidates,
+            feedback_consolidation, 
+            jira_dealblockers,
+            similarity_threshold=match_threshold  # <-- Pass the slider value
+        )
+
+        if "rerank_ms_per_cluster" in candidates.attrs:
+            st.caption(f"Cross-encoder reranking added {candidates.attrs['rerank_ms_per_cluster']:.1f} ms per cluster.")
+
+        with st.expander("📊 Matches kept per threshold"):
+            counts_df = threshold_match_counts(candidates, np.round(np.arange(0.5, 0.951, 0.05), 2))
+            st.dataframe(counts_df, hide_index=True, use_container_width=True)
+
+        if mapped_df is None or mapped_df.empty:
+            st.warning("No mappings were found at this threshold.")
+        else:
+            st.success(f"✅ Mapping complete: {len(mapped_df)} matches at threshold {match_threshold:.2f}")
+            st.subheader("🗺️ Mapped Results (Current Run)")
+
+            mapped_df_display = expand_items(
+                mapped_df, st.session_state.run_id, ITEM_TEXT_COLUMNS["step_4_history"]
+            ).copy()
+            
+           # if "original_feedback_texts" in mapped_df_display.columns:
+             #   mapped_df_display["original_feedback_texts"] = mapped_df_display["original_feedback_texts"].apply(
+             #       lambda x: str(x)[:250] + "..." if len(str(x)) > 250 else str(x)
+             #   )
+            
+            st.dataframe(mapped_df_display.head(100), use_container_width=True)
+
+            # --- SAVE TO DB (once per threshold, not on every rerun) ---
+            if st.session_state.get("step_4_saved_threshold") != match_threshold:
+                save_run_data(mapped_df, "step_4_history", st.session_state.run_id)
+                index_step_4_run(st.session_state.run_id, mapped_df)
+                st.session_state["step_4_saved_threshold"] = match_threshold
                 st.toast(f"Saved mapping results to history! Sidebar will update on next refresh.")
 
-        except Exception as e:
-            st.error(f"Error mapping feedback and Jira issues: {e}")
\ No newline at end of file
+            export_controls("mapped_feedback_dealblockers", "step_4_history", "⬇️ Download Mapped Feedback → Dealblockers")
+
+            with st.expander("📤 Write back to Jira"):
+                st.caption("Pushes each mapped issue's total request count, linked feedback keys and best match "
+                           "score to Jira (custom fields if configured, otherwise one sync comment). "
+                           "Unchanged values are skipped.")
+                writeback_dry_run = st.checkbox("Dry run (only show the planned calls)", value=True)
+                if st.button("Write back mapping results"):
+                    try:
+                        with st.spinner("Reading current Jira values..."), run_context(st.session_state.run_id):
+                            writeback_df = write_back_mapping(
+                                expand_items(mapped_df, st.session_state.run_id, ITEM_TEXT_COLUMNS["step_4_history"]),
+                                dry_run=writeback_dry_run
+                            )
+                        st.dataframe(writeback_df, hide_index=True, use_container_width=True)
+                        errors = int((writeback_df["status"] == "error").sum()) if not writeback_df.empty else 0
+                        if errors:
+                            st.error(f"{errors} Jira call(s) failed; see the detail column.")
+                    except Exception as e:
+                        st.error(f"Error writing back to Jira: {e}")
+
+    except Exception as e:
+        st.error(f"Error mapping feedback and Jira issues: {e}")
+
+# -----------------------------------------------------------------
+# --- Poll background jobs ---
+# -----------------------------------------------------------------
+poll_jobs()
@@ -1,8 +1,7 @@
 import streamlit as st
 import pandas as pd
-import json
-import re
-from classifier import analyze_texts_batch
+from classifier_gemini import analyze_texts_batch
+from llm_providers import parse_json
 
 st.set_page_config(page_title="Feedback Intelligence Analyzer", layout="wide")
 st.title("💡 Product Feedback Intelligence System")
@@ -32,16 +31,13 @@ if uploaded_file:
 
             parsed_rows = []
 
-            def parse_json(text):
-                try:
-                    clean = re.sub(r"^```json\s*|\s*```$", "", text.strip())
-                    return json.loads(clean)
-                except Exception:
-                    return []
-
             for r in results:
                 if isinstance(r, str):
-                    parsed_rows.extend(parse_json(r))
+                    try:
+                        parsed, _ = parse_json(r)
+                    except ValueError:
+                        continue
+                    parsed_rows.extend(parsed if isinstance(parsed, list) else [parsed])
                 elif isinstance(r, list):
                     parsed_rows.extend(r)
 
@@ -5,18 +5,56 @@ import time
 import pandas as pd
 from tqdm import tqdm
 from dotenv import load_dotenv
-import streamlit as st 
 
-# Gemini client
-import google.generativeai as genai
+from history_db import (
+    save_summary_checkpoint, load_summary_checkpoints, load_previous_run_data, save_run_artifact, load_run_artifacts,
+    item_id, parse_item_ids, cluster_key
+)
+from stage_cache import cached_stage
+from issue_keys import extract_cluster_issue_keys
+from telemetry import record_metric
+from local_labeler import label_clusters_locally
+from llm_providers import complete, parse_json, GEMINI_MODEL, LLM_PROVIDER_ORDER, RateLimitError
 
 load_dotenv()
 
-genai.configure(
-    api_key=os.getenv("GOOGLE_API_KEY")
-) 
+MODEL = GEMINI_MODEL
 
-MODEL = "models/gemini-flash-latest"
+FAILED_SUMMARY_LABEL = "Error: Failed to Summarize"
+
+# A cluster whose membership overlaps a cluster of the previous run by at
+# least this Jaccard similarity (on item hashes) reuses that cluster's label,
+# category and reasoning instead of calling Gemini. Above 0.5 a previous
+# cluster can be reused by at most one new cluster. None disables it.
+CARRY_FORWARD_THRESHOLD = float(os.getenv("SUMMARY_CARRY_FORWARD_THRESHOLD", "0.8"))
+
+# Labeling backends: Gemini summaries, or local extractive labels
+# (c-TF-IDF keywords + medoid text, see local_labeler.py)
+LABELER_GEMINI = "gemini"
+LABELER_LOCAL = "local"
+LABELERS = (LABELER_GEMINI, LABELER_LOCAL)
+
+# With the Gemini labeler, clusters Gemini fails on (quota exhausted or
+# unparseable after retries) get local labels instead of an error row.
+LOCAL_FALLBACK = os.getenv("SUMMARY_LOCAL_FALLBACK", "1") != "0"
+
+# Where each row's summary came from (the summary_source column)
+SUMMARY_SOURCE_LLM = "llm"
+SUMMARY_SOURCE_CARRIED = "carried_forward"
+SUMMARY_SOURCE_LOCAL = "local"
+SUMMARY_SOURCE_LOCAL_FALLBACK = "local_fallback"
+
+
+class QuotaExhaustedError(RuntimeError):
+    """
+    Raised when every LLM provider rejects a call for quota/rate-limit
+    reasons (see llm_providers). summarize_clusters attaches the clusters finished so far as partial_df.
+    """
+    def __init__(self, message, partial_df=None, completed=0, total=0):
+        super().__init__(message)
+        self.partial_df = partial_df
+        self.completed = completed
+        self.total = total
 
 
 # --- 1. MODIFY THE PROMPT ---
@@ -30,7 +68,6 @@ Your job is to analyze all of the following feedback items and return a single J
 - **category**: The best fit: <Bug|Feature Request|UX Issue|Performance|SDK Coverage|Billing|Other>
 - **priority_score**: An integer (1-5) for the whole cluster's urgency.
 - **reasoning**: A one-line summary of the core request or problem.
-- **issue_keys**: An array of all Jira keys found in the texts. These keys follow a `[PROJECT]-[NUMBER]` format (e.g., "PRDFBK-4676", "SDK-123"). Systematically extract ALL strings that match this `[ALL_CAPS_LETTERS]-[NUMBERS]` pattern, even if they appear multiple times.
 In addition to the above, also keep the following in mind when analyzing the group: {user_context_section}
 
 Here is the group of feedback items:
@@ -39,10 +76,58 @@ Here is the group of feedback items:
 Return ONLY the single JSON object, nothing else.
 """
 
+SUMMARY_CATEGORIES = ["Bug", "Feature Request", "UX Issue", "Performance", "SDK Coverage", "Billing", "Other"]
+
+# Passed to the providers' structured-output modes (Gemini enforces it;
+# Groq and local servers only guarantee a JSON object)
+SUMMARY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "cluster_label": {"type": "string"},
+        "category": {"type": "string", "enum": SUMMARY_CATEGORIES},
+        "priority_score": {"type": "integer"},
+        "reasoning": {"type": "string"},
+    },
+    "required": ["cluster_label", "category", "priority_score", "reasoning"],
+}
+
+
+def _repair_summary(parsed):
+    """
+    Fits a parsed answer to SUMMARY_SCHEMA: unwraps a one-item list, maps
+    the category onto SUMMARY_CATEGORIES, clamps priority_score to 1-5 and
+    fills missing fields with defaults. Returns (summary, repaired). Raises
+    ValueError when there is no cluster_label to keep, so the call is retried.
+    """
+    repaired = False
+    if isinstance(parsed, list) and parsed and isinstance(parsed[0], dict):
+        parsed, repaired = parsed[0], True
+    if not isinstance(parsed, dict):
+        raise ValueError(f"Expected a JSON object, got {type(parsed).__name__}.")
+    label = parsed.get("cluster_label")
+    if not isinstance(label, str) or not label.strip():
+        raise ValueError("LLM response has no cluster_label.")
+
+    categories = {c.lower(): c for c in SUMMARY_CATEGORIES}
+    category = categories.get(str(parsed.get("category", "")).strip().lower(), "Other")
+    try:
+        priority = min(5, max(1, int(round(float(parsed.get("priority_score"))))))
+    except (TypeError, ValueError):
+        priority = 1
+    reasoning = parsed.get("reasoning")
+    reasoning = reasoning.strip() if isinstance(reasoning, str) else ""
+
+    summary = {"cluster_label": label.strip(), "category": category, "priority_score": priority, "reasoning": reasoning}
+    repaired = repaired or any(parsed.get(k) != v for k, v in summary.items())
+    return summary, repaired
+
 # --- 2. MODIFY THIS FUNCTION SIGNATURE ---
 def get_summary_for_group(texts, labeling_context="", model_name=MODEL, max_retries=2, sleep_between_retries=2.0):
     """
-    Calls Gemini with the summary prompt for a single group of texts.
+    Calls the LLM (Gemini first, falling back across llm_providers on
+    429s and timeouts) with the summary prompt for a single group of texts.
+    The answer is requested in SUMMARY_SCHEMA and repaired locally when
+    malformed; the call is retried only when repair fails.
     """
     
     # --- 3. ADD THIS LOGIC to dynamically build the prompt ---
@@ -62,82 +147,350 @@ def get_summary_for_group(texts, labeling_context="", model_name=MODEL, max_retr
     raw = None 
     for attempt in range(max_retries + 1):
         try:
-            model = genai.GenerativeModel(model_name=model_name)
-            resp = model.generate_content(batch_prompt)
-            
-            raw = resp.text if hasattr(resp, "text") else getattr(resp.parts[0], "text", str(resp.parts))
-            
-            start = raw.find("{")
-            end = raw.rfind("}") + 1
-            if start != -1 and end != -1:
-                json_text = raw[start:end]
-            else:
-                json_text = raw
-                
-            parsed = json.loads(json_text)
-            return parsed
-        
+            response = complete(batch_prompt, models={"gemini": model_name}, response_schema=SUMMARY_SCHEMA)
+            raw = response["text"]
+        except RateLimitError as e:
+            # Every provider is out of quota: retrying (or moving on to the
+            # next cluster) cannot succeed.
+            raise QuotaExhaustedError(str(e)) from e
         except Exception as e:
+            # Recorded by the provider as an llm_call error; not a parse failure
+            last_err = e
+            print(f"Error summarizing group (attempt {attempt+1}): {e}")
+            time.sleep(sleep_between_retries * (1 + attempt))
+            continue
+
+        try:
+            parsed, json_repaired = parse_json(raw)
+            summary, fields_repaired = _repair_summary(parsed)
+            record_metric(
+                "summary_parse", retries=int(attempt > 0), provider=response["provider"],
+                repaired=int(json_repaired or fields_repaired), parse_failed=0
+            )
+            return summary
+        except ValueError as e:
+            record_metric(
+                "summary_parse", status="error", retries=int(attempt > 0), provider=response["provider"],
+                repaired=0, parse_failed=1, error=type(e).__name__
+            )
             last_err = e
             print(f"Error parsing group (attempt {attempt+1}): {e}\nRaw output: {raw}")
             time.sleep(sleep_between_retries * (1 + attempt))
             continue
             
     return {
-        "cluster_label": "Error: Failed to Summarize",
+        "cluster_label": FAILED_SUMMARY_LABEL,
         "category": "Other",
         "priority_score": 1,
         "reasoning": f"Error classifying batch: {last_err}",
         "issue_keys": []
     }
 
-# --- 4. MODIFY THIS FUNCTION SIGNATURE ---
-@st.cache_data
-def summarize_clusters(cluster_groups, labeling_context=""):
+def _summary_cache_key(texts, labeling_context=""):
+    return (cluster_key(texts), labeling_context or "", MODEL, LLM_PROVIDER_ORDER, GEMINI_SUMMARY_PROMPT, SUMMARY_SCHEMA)
+
+
+@cached_stage("summaries", _summary_cache_key,
+              cacheable=lambda summary: summary.get("cluster_label") != FAILED_SUMMARY_LABEL)
+def cached_summary_for_group(texts, labeling_context=""):
     """
-    Receives a dict of {cluster_id: [texts]} from the mapper.
-    Calls Gemini to summarize each group.
-    Returns a consolidated pandas.DataFrame.
+    get_summary_for_group, cached per cluster membership. Only the LLM's
+    answer is cached: anything tied to a run (checkpoints, carry-forward,
+    summary_source) is added by the caller. Failed summaries and quota
+    errors are never cached.
+    """
+    return get_summary_for_group(texts, labeling_context=labeling_context)
+
+
+# -------------------------
+# Carry-forward from the previous run
+# -------------------------
+def _item_ids(row):
+    """
+    A saved cluster's item ids. Rows saved before items were stored by
+    reference carry the ' | '-joined feedback_text instead.
+    """
+    if "item_ids" in row:
+        return set(parse_item_ids(row["item_ids"]))
+    return {item_id(t) for t in str(row.get("feedback_text", "")).split(" | ") if t.strip()}
+
+
+def _run_labeling_context(run_id):
+    artifacts = load_run_artifacts(run_id, kind="step_3_context")
+    if artifacts.empty:
+        return ""
+    return json.loads(artifacts["meta_json"].iloc[0]).get("labeling_context", "")
+
+
+def match_previous_clusters(cluster_groups, previous_df, threshold):
+    """
+    Returns {cluster_id: (previous_row, jaccard)} for every new cluster whose
+    best-overlapping previous cluster reaches threshold. Uses an inverted
+    index from item hash to previous cluster, so the cost is linear in the
+    number of items rather than clusters x clusters.
+    """
+    if previous_df is None or previous_df.empty or not {"item_ids", "feedback_text"} & set(previous_df.columns):
+        return {}
+    previous_rows = previous_df[previous_df["cluster_label"] != FAILED_SUMMARY_LABEL].to_dict(orient="records")
+    previous_sets = [_item_ids(row) for row in previous_rows]
+    owner = {}
+    for idx, hashes in enumerate(previous_sets):
+        for h in hashes:
+            owner.setdefault(h, idx)
+
+    matches = {}
+    for cluster_id, texts in cluster_groups.items():
+        hashes = {item_id(t) for t in texts if t.strip()}
+        if not hashes:
+            continue
+        overlap = pd.Series([owner[h] for h in hashes if h in owner], dtype="int64").value_counts()
+        if overlap.empty:
+            continue
+        best_idx, shared = int(overlap.index[0]), int(overlap.iloc[0])
+        jaccard = shared / (len(hashes) + len(previous_sets[best_idx]) - shared)
+        if jaccard >= threshold:
+            matches[cluster_id] = (previous_rows[best_idx], jaccard)
+    return matches
+
+
+def _carried_summaries(cluster_groups, labeling_context, run_id, threshold):
+    """
+    Summaries reusable from the previous run with the same labeling context,
+    as (previous_run_id, {cluster_id: summary}). request_count, issue_keys
+    and item_ids are always recomputed from the new membership by the caller.
+    Evaluated on every call, against the run that is the previous one now.
+    """
+    if not run_id:
+        return None, {}
+    previous_run_id, previous_df = load_previous_run_data("step_3_history", run_id)
+    if threshold is None or previous_run_id is None or _run_labeling_context(previous_run_id) != (labeling_context or ""):
+        return previous_run_id, {}
+    carried = {}
+    for cluster_id, (row, jaccard) in match_previous_clusters(cluster_groups, previous_df, threshold).items():
+        carried[cluster_id] = {
+            "cluster_label": row.get("cluster_label"),
+            "category": row.get("category"),
+            "priority_score": row.get("priority_score"),
+            "reasoning": row.get("reasoning"),
+            "summary_source": f"{SUMMARY_SOURCE_CARRIED}:{previous_run_id}",
+            "carried_jaccard": round(jaccard, 3),
+        }
+    return previous_run_id, carried
+
+
+def _is_stale_carry(summary, previous_run_id):
+    """
+    True for a summary carried forward from a run other than previous_run_id
+    (e.g. a checkpoint written before that run was deleted or superseded);
+    it must not be reused as if it were still carried from the previous run.
+    """
+    source = str(summary.get("summary_source", ""))
+    return source.startswith(f"{SUMMARY_SOURCE_CARRIED}:") and source != f"{SUMMARY_SOURCE_CARRIED}:{previous_run_id}"
+
+
+# Member texts are referenced by item_ids (history_db.item_id); they are
+# stored once per run in run_items and only expanded for display and export
+CONSOLIDATED_COLUMNS = (
+    "cluster_label", "category", "priority_score", "request_count",
+    "reasoning", "issue_keys", "item_ids", "summary_source"
+)
+
+
+def _build_consolidated_df(agg_rows, with_cluster_ids=False):
+    """Turns per-cluster summary dicts into the sorted Step 3 report."""
+    consolidated_df = pd.DataFrame(agg_rows)
+    if consolidated_df.empty:
+        return consolidated_df
+
+    # Re-order columns for clarity
+    columns = CONSOLIDATED_COLUMNS + ("cluster_id",) if with_cluster_ids else CONSOLIDATED_COLUMNS
+    final_cols = [c for c in columns if c in consolidated_df.columns]
+    
+    consolidated_df = consolidated_df[final_cols] 
+
+    consolidated_df = consolidated_df.sort_values(
+        by=["priority_score", "request_count"], 
+        ascending=[False, False]
+    ).reset_index(drop=True)
+
+    return consolidated_df
+
+
+def summarize_clusters_with_checkpoints(cluster_groups, labeling_context="", run_id=None, progress_callback=None,
+                                        carry_forward_threshold=CARRY_FORWARD_THRESHOLD, labeler=LABELER_GEMINI,
+                                        local_fallback=LOCAL_FALLBACK, use_cache=False, medoid_fn=None,
+                                        with_cluster_ids=False):
+    """
+    Core of summarize_clusters. With use_cache, Gemini summaries go through
+    cached_summary_for_group. with_cluster_ids adds a cluster_id column (the
+    keys of cluster_groups) for callers that map rows back to their input.
+
+    When a run_id is given, every successful per-cluster summary is
+    checkpointed in history.db as it completes, and clusters that already
+    have a checkpoint for this run are not sent to Gemini again. That makes
+    calling this a second time with the same run_id a resume: only failed or
+    missing clusters are re-summarized and merged into the result.
+
+    Clusters that barely changed since the previous run (see
+    CARRY_FORWARD_THRESHOLD) reuse its summary instead of calling Gemini.
+
+    With labeler="local" the remaining clusters are labeled locally (no LLM).
+    medoid_fn() returns their {cluster_id: medoid text} from the clustering
+    embeddings (see mapper.cluster_medoids); it is only called once a
+    cluster is actually labeled locally.
+    Otherwise, with local_fallback, clusters Gemini fails on are labeled
+    locally and marked "local_fallback" (never checkpointed, so a resume
+    retries them with Gemini). Without local_fallback, raises
+    QuotaExhaustedError (with the partial result attached) as soon as Gemini
+    reports quota exhaustion instead of failing every remaining cluster.
     """
     if not cluster_groups:
         return pd.DataFrame()
+    if labeler not in LABELERS:
+        raise ValueError(f"Unknown labeler '{labeler}'. Use one of {LABELERS}.")
+
+    local_summaries = {}
+
+    def local_summary(cluster_id, source):
+        # Computed for all clusters at once on first use: c-TF-IDF needs them all
+        if not local_summaries:
+            local_summaries.update(label_clusters_locally(cluster_groups, medoids=medoid_fn() if medoid_fn else None))
+        return dict(local_summaries[cluster_id], summary_source=source)
+
+    checkpoints = load_summary_checkpoints(run_id) if run_id else {}
+    previous_run_id, carried = _carried_summaries(cluster_groups, labeling_context, run_id, carry_forward_threshold)
+    checkpoints = {key: summary for key, summary in checkpoints.items() if not _is_stale_carry(summary, previous_run_id)}
+    # Read by the next run's carry-forward; updated if the context changed under the same run_id
+    if run_id and (load_run_artifacts(run_id, kind="step_3_context").empty
+                   or _run_labeling_context(run_id) != (labeling_context or "")):
+        save_run_artifact(run_id, "step_3_context", "labeling_context", None, {"labeling_context": labeling_context or ""})
+
+    # Issue keys are extracted locally (regex) rather than by the LLM
+    cluster_issue_keys = extract_cluster_issue_keys(cluster_groups)
 
     agg_rows = []
+    total = len(cluster_groups)
+    quota_error = None
+    summarization_start = time.perf_counter()
     
-    for cluster_id, texts in tqdm(cluster_groups.items(), desc="Summarizing clusters with Gemini"):
+    for done, (cluster_id, texts) in enumerate(tqdm(cluster_groups.items(), desc="Summarizing clusters with Gemini"), start=1):
+        if progress_callback is not None:
+            progress_callback(done - 1, total)
         if not texts:
             continue
 
-        # --- 5. PASS THE CONTEXT DOWN ---
-        summary = get_summary_for_group(texts, labeling_context=labeling_context)
+        key = cluster_key(texts)
+        if key in checkpoints:
+            summary = dict(checkpoints[key])
+        elif cluster_id in carried:
+            summary = dict(carried[cluster_id])
+            if run_id:
+                save_summary_checkpoint(run_id, key, summary)
+        elif labeler == LABELER_LOCAL:
+            summary = local_summary(cluster_id, SUMMARY_SOURCE_LOCAL)
+        elif quota_error is not None:
+            # Quota already gone: don't call Gemini again for the rest
+            summary = local_summary(cluster_id, SUMMARY_SOURCE_LOCAL_FALLBACK)
+        else:
+            # --- 5. PASS THE CONTEXT DOWN ---
+            try:
+                summarize = cached_summary_for_group if use_cache else get_summary_for_group
+                summary = dict(summarize(texts, labeling_context=labeling_context))
+            except QuotaExhaustedError as e:
+                quota_error = e
+                if not local_fallback:
+                    break
+                summary = local_summary(cluster_id, SUMMARY_SOURCE_LOCAL_FALLBACK)
+            else:
+                summary["summary_source"] = SUMMARY_SOURCE_LLM
+                if summary.get("cluster_label") == FAILED_SUMMARY_LABEL:
+                    if local_fallback:
+                        summary = local_summary(cluster_id, SUMMARY_SOURCE_LOCAL_FALLBACK)
+                elif run_id:
+                    save_summary_checkpoint(run_id, key, summary)
         
         # Combine with cluster data
         summary["request_count"] = len(texts)
-        summary["feedback_text"] = " | ".join(texts) 
+        summary["item_ids"] = [item_id(t) for t in texts]
         
         summary.setdefault("cluster_label", "Untitled Cluster")
         summary.setdefault("category", "Other")
         summary.setdefault("priority_score", 1)
         summary.setdefault("reasoning", "")
-        if summary.get("issue_keys") is None:
-            summary["issue_keys"] = []
+        summary.setdefault("summary_source", SUMMARY_SOURCE_LLM)
+        summary.pop("carried_jaccard", None)
+        summary["issue_keys"] = cluster_issue_keys.get(cluster_id, [])
+        summary["cluster_id"] = cluster_id
 
         agg_rows.append(summary)
 
-    consolidated_df = pd.DataFrame(agg_rows)
+    consolidated_df = _build_consolidated_df(agg_rows, with_cluster_ids=with_cluster_ids)
+    fallback_rows = sum(row["summary_source"] == SUMMARY_SOURCE_LOCAL_FALLBACK for row in agg_rows)
+    record_metric(
+        "summarization", (time.perf_counter() - summarization_start) * 1000,
+        status="ok" if quota_error is None else "quota_exhausted",
+        items=len(agg_rows), checkpointed=len(checkpoints), carried_forward=len(carried),
+        labeler=labeler, local_fallback=fallback_rows
+    )
 
-    # Re-order columns for clarity
-    cols = [
-        "cluster_label", "category", "priority_score", "request_count", 
-        "reasoning", "issue_keys", "feedback_text"
-    ]
-    final_cols = [c for c in cols if c in consolidated_df.columns]
-    
-    consolidated_df = consolidated_df[final_cols] 
+    if quota_error is not None and not local_fallback:
+        raise QuotaExhaustedError(
+            f"LLM quota exhausted on every provider after {len(agg_rows)} of {total} clusters: {quota_error}",
+            partial_df=consolidated_df, completed=len(agg_rows), total=total
+        )
 
-    consolidated_df = consolidated_df.sort_values(
-        by=["priority_score", "request_count"], 
-        ascending=[False, False]
-    ).reset_index(drop=True)
+    if progress_callback is not None:
+        progress_callback(total, total)
+
+    return consolidated_df
+
+
+def summarize_clusters(cluster_groups, labeling_context="", run_id=None, progress_callback=None,
+                       carry_forward_threshold=CARRY_FORWARD_THRESHOLD, labeler=LABELER_GEMINI,
+                       local_fallback=LOCAL_FALLBACK, medoid_fn=None):
+    """
+    Receives a dict of {cluster_id: [texts]} from the mapper.
+    Calls Gemini to summarize each group.
+    Returns a consolidated pandas.DataFrame.
+
+    Same as summarize_clusters_with_checkpoints, except that Gemini
+    summaries come from the stage cache when the same cluster was summarized
+    before (see cached_summary_for_group). Checkpoints, carry-forward and
+    the run's labeling context are still handled on every call.
+
+    progress_callback(done, total) is called after each cluster; the
+    background worker uses it to report progress.
+    """
+    return summarize_clusters_with_checkpoints(
+        cluster_groups, labeling_context=labeling_context, run_id=run_id, progress_callback=progress_callback,
+        carry_forward_threshold=carry_forward_threshold, labeler=labeler, local_fallback=local_fallback,
+        use_cache=True, medoid_fn=medoid_fn
+    )
 
-    return consolidated_df
\ No newline at end of file
+
+def summary_source_counts(consolidated_df):
+    """Rows per summary source (llm, carried_forward, local, local_fallback) of a Step 3 result."""
+    counts = {source: 0 for source in (SUMMARY_SOURCE_LLM, SUMMARY_SOURCE_CARRIED,
+                                       SUMMARY_SOURCE_LOCAL, SUMMARY_SOURCE_LOCAL_FALLBACK)}
+    if consolidated_df is None or consolidated_df.empty or "summary_source" not in consolidated_df.columns:
+        return counts
+    # carried_forward:<run_id> counts as carried_forward
+    sources = consolidated_df["summary_source"].astype(str).str.split(":").str[0]
+    counts.update(sources.value_counts().to_dict())
+    return counts
+
+
+def resume_summary_run(cluster_groups, run_id, labeling_context="", progress_callback=None,
+                       carry_forward_threshold=CARRY_FORWARD_THRESHOLD, local_fallback=LOCAL_FALLBACK, medoid_fn=None):
+    """
+    Re-summarizes only the failed, fallback or missing clusters of an
+    interrupted run and merges them with its checkpointed summaries. Failed
+    summaries are never cached, so those clusters always reach Gemini again.
+    Pass the run's carry_forward_threshold so resumed clusters carry labels
+    forward the same way.
+    """
+    return summarize_clusters_with_checkpoints(
+        cluster_groups, labeling_context=labeling_context, run_id=run_id, progress_callback=progress_callback,
+        carry_forward_threshold=carry_forward_threshold, local_fallback=local_fallback, use_cache=True,
+        medoid_fn=medoid_fn
+    )
@@ -1,12 +1,10 @@
-import os
 import json
 import math
 import re
 from tqdm import tqdm
-import google.generativeai as genai
 import pandas as pd  # ✅ Added missing import
 
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+from llm_providers import complete, provider_order
 
 MODEL = "models/gemini-2.5-pro"
 
@@ -35,8 +33,7 @@ def chunk_list(lst, n):
         yield lst[i:i + n]
 
 def analyze_texts_batch(feedback_items, issue_keys=None, batch_size=20):
-    """Analyze batches of feedback using Gemini 2.5 Pro"""
-    model = genai.GenerativeModel(model_name=MODEL)
+    """Analyze batches of feedback using Gemini 2.5 Pro (falling back to the other providers on 429s)"""
     results = []
 
     if not feedback_items:
@@ -58,11 +55,8 @@ def analyze_texts_batch(feedback_items, issue_keys=None, batch_size=20):
         prompt = f"{system_prompt}\n\nAnalyze the following feedback entries:\n\n{joined_text}"
 
         try:
-            response = model.generate_content(prompt)
-            if hasattr(response, "text"):
-                results.append(response.text)
-            else:
-                results.append("Error: No text in response")
+            response = complete(prompt, providers=provider_order("gemini"), models={"gemini": MODEL})
+            results.append(response["text"] or "Error: No text in response")
         except Exception as e:
             results.append(f"Error in batch {batch_index}: {e}")
             continue
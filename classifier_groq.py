@@ -1,12 +1,9 @@
-import os
-import json
-import time
 from tqdm import tqdm
-from groq import Groq
 from dotenv import load_dotenv
 
+from llm_providers import complete, parse_json, provider_order
+
 load_dotenv()
-client = Groq(api_key=os.getenv("GROQ_API_KEY"))
 
 SYSTEM_PROMPT = """
 You are a Product Feedback Intelligence Assistant.
@@ -55,18 +52,17 @@ def analyze_texts_batch(texts):
     for text in tqdm(texts, desc="Classifying feedback"):
         try:
             prompt = f"{SYSTEM_PROMPT}\n{EXAMPLE_PROMPT}\nInput: \"{text}\"\nOutput:"
-            resp = client.chat.completions.create(
-                model="llama-3.1-8b-instant",  # fast + accurate
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.2,
+            resp = complete(
+                prompt, temperature=0.2, providers=provider_order("groq"),
+                models={"groq": "llama-3.1-8b-instant"},  # fast + accurate
             )
-            result_text = resp.choices[0].message.content.strip()
+            result_text = resp["text"].strip()
 
-            # Extract JSON
-            start, end = result_text.find("{"), result_text.rfind("}") + 1
-            if start != -1 and end != -1:
-                json_text = result_text[start:end]
-                parsed = json.loads(json_text)
+            try:
+                parsed, _ = parse_json(result_text)
+            except ValueError:
+                parsed = None
+            if parsed is not None:
                 results.append(parsed)
             else:
                 results.append({
@@ -80,7 +76,6 @@ def analyze_texts_batch(texts):
                     "priority": "Low",
                     "explanation": "Could not parse model output"
                 })
-            time.sleep(0.1)
         except Exception as e:
             results.append({
                 "category": "Other",
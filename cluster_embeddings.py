@@ -0,0 +1,126 @@
+# cluster_embeddings.py
+"""
+Per-cluster embeddings saved with each Step 3 run, for Step 4 to reuse.
+
+Step 3 already embeds every feedback item; the normalized mean of a
+cluster's members on those embeddings (its centroid) is saved as a run artifact so Step 4 can
+match the cluster against Jira without encoding its reasoning again
+(MATCH_MODE_CENTROID in mapper.py). With SAVE_MEMBER_EMBEDDINGS=1 the
+float16 member embeddings are saved too.
+
+Files live in cluster_embeddings/<run_id>/ and are listed in run_artifacts
+(kind "cluster_embeddings"), one pair per clustering of the run. Clusters are
+keyed by their membership (history_db.cluster_key over the member texts),
+so saved Step 3 rows are matched after expanding their item_ids.
+
+Only saving needs the embedding model: mapper is imported there, so the
+job worker and the streaming service can look centroids up without
+loading it.
+"""
+import os
+import json
+from datetime import datetime
+import numpy as np
+
+from history_db import save_run_artifact, load_run_artifacts, expand_items, cluster_key
+from low_memory import LOW_MEMORY_MODE
+
+# -------------------------
+# Config
+# -------------------------
+CLUSTER_EMBEDDINGS_DIR = os.getenv("CLUSTER_EMBEDDINGS_DIR", os.path.abspath("cluster_embeddings"))
+SAVE_MEMBER_EMBEDDINGS = os.getenv("SAVE_MEMBER_EMBEDDINGS", "").strip().lower() in ("1", "true", "yes", "on")
+ARTIFACT_KIND = "cluster_embeddings"
+
+
+def membership_key(feedback_text):
+    """Key of a saved Step 3 row's cluster, from its ' | '-joined feedback_text."""
+    return cluster_key(str(feedback_text).split(" | "))
+
+
+def save_cluster_embeddings(run_id, feedback_df, text_column, cluster_groups, grouping_context="", context_mode=None,
+                            low_memory=LOW_MEMORY_MODE, with_members=SAVE_MEMBER_EMBEDDINGS):
+    """
+    Computes and saves the centroids (and optionally member embeddings) of a
+    get_semantic_clusters result, from the embeddings it clustered on (pass
+    the same grouping_context and context_mode). Returns the centroids file path.
+    """
+    from mapper import get_cluster_embeddings, EMBED_MODEL, DEFAULT_CONTEXT_MODE
+
+    context_mode = context_mode or DEFAULT_CONTEXT_MODE
+    cluster_ids, centroids, members = get_cluster_embeddings(
+        feedback_df, text_column, cluster_groups, grouping_context=grouping_context, context_mode=context_mode,
+        low_memory=low_memory, with_members=with_members
+    )
+    keys = np.array([membership_key(" | ".join(cluster_groups[cid])) for cid in cluster_ids])
+
+    run_dir = os.path.join(CLUSTER_EMBEDDINGS_DIR, run_id)
+    os.makedirs(run_dir, exist_ok=True)
+    stamp = datetime.now().strftime('%H%M%S_%f')
+    path = os.path.join(run_dir, f"centroids_{stamp}.npz")
+    np.savez(path, keys=keys, centroids=centroids.astype(np.float32))
+
+    meta = {"clusters": len(keys), "dim": int(centroids.shape[1]) if centroids.size else 0, "model": EMBED_MODEL,
+            "context_mode": context_mode if grouping_context and grouping_context.strip() else None}
+    if members is not None:
+        # One float16 matrix with per-cluster offsets (CSR layout)
+        counts = [len(members[cid]) for cid in cluster_ids]
+        members_path = os.path.join(run_dir, f"members_{stamp}.npz")
+        np.savez(
+            members_path, keys=keys, offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+            embeddings=np.concatenate([members[cid] for cid in cluster_ids]) if cluster_ids else np.empty((0, 0), np.float16)
+        )
+        meta["members_path"] = members_path
+        meta["members"] = int(sum(counts))
+
+    save_run_artifact(run_id, ARTIFACT_KIND, "centroids", path, meta)
+    return path
+
+
+def _artifacts(run_id):
+    """The run's saved embeddings whose files still exist, newest first."""
+    artifacts = load_run_artifacts(run_id, kind=ARTIFACT_KIND)
+    return artifacts[artifacts["path"].map(lambda p: bool(p) and os.path.exists(p))]
+
+
+def load_cluster_centroids(run_id):
+    """
+    {membership key: centroid} over every clustering saved for the run (a
+    threshold change re-clusters under the same run_id), or {} if none.
+    """
+    centroids = {}
+    for path in _artifacts(run_id)["path"]:
+        with np.load(path) as data:
+            for key, centroid in zip(data["keys"].tolist(), data["centroids"]):
+                centroids.setdefault(key, centroid)
+    return centroids
+
+
+def load_member_embeddings(run_id):
+    """{membership key: float16 member embeddings} of the run's newest clustering, if it saved them, else {}."""
+    artifacts = _artifacts(run_id)
+    members_path = None if artifacts.empty else json.loads(artifacts["meta_json"].iloc[0]).get("members_path")
+    if not members_path or not os.path.exists(members_path):
+        return {}
+    with np.load(members_path) as data:
+        offsets, embeddings = data["offsets"], data["embeddings"]
+        return {key: embeddings[offsets[i]:offsets[i + 1]] for i, key in enumerate(data["keys"].tolist())}
+
+
+def centroids_for(feedback_df, run_id):
+    """
+    The run's centroids aligned with the rows of its saved Step 3 result
+    (NaN rows for clusters without one, e.g. after a re-cluster that was not
+    saved), or None if the run has no saved embeddings.
+    """
+    centroids = load_cluster_centroids(run_id)
+    if not centroids or feedback_df is None or feedback_df.empty:
+        return None
+    feedback_df = expand_items(feedback_df, run_id)
+    dim = len(next(iter(centroids.values())))
+    aligned = np.full((len(feedback_df), dim), np.nan, dtype=np.float32)
+    for row, feedback_text in enumerate(feedback_df["feedback_text"]):
+        centroid = centroids.get(membership_key(feedback_text))
+        if centroid is not None:
+            aligned[row] = centroid
+    return aligned
@@ -0,0 +1,294 @@
+# embedding_service.py
+"""
+Shared local embedding service.
+
+Every Streamlit server process (and every job worker) otherwise loads its
+own copy of local_model, and concurrent sessions each run small encode
+calls. This service holds ONE model instance and coalesces the texts of
+all concurrent requests into dynamically sized batches: the batcher takes
+whatever is queued, waits at most MAX_WAIT_MS for more, and encodes up to
+MAX_BATCH_SIZE texts in one call.
+
+Run it with:
+
+    python embedding_service.py [--port 8765] [--max-batch 256] [--max-wait-ms 10]
+
+and point the app at it with EMBEDDING_SERVICE_URL=http://127.0.0.1:8765.
+mapper.load_embedding_model() then returns a RemoteEmbeddingModel, whose
+.encode() matches SentenceTransformer.encode for the arguments used here.
+
+Endpoints:
+    POST /encode  {"texts": [...], "normalize": true}
+                  -> raw little-endian float32, shape in the X-Shape header
+    GET  /stats   queue depth, batch sizes, request latency percentiles
+    GET  /health
+"""
+import os
+import json
+import time
+import queue
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import requests
+
+# -------------------------
+# Config
+# -------------------------
+EMBEDDING_SERVICE_URL = os.getenv("EMBEDDING_SERVICE_URL", "")
+EMBED_MODEL_PATH = os.getenv("EMBED_MODEL_PATH", os.path.abspath("local_model"))
+SERVICE_HOST = os.getenv("EMBEDDING_SERVICE_HOST", "127.0.0.1")
+SERVICE_PORT = int(os.getenv("EMBEDDING_SERVICE_PORT", "8765"))
+MAX_BATCH_SIZE = int(os.getenv("EMBEDDING_MAX_BATCH", "256"))
+MAX_WAIT_MS = float(os.getenv("EMBEDDING_MAX_WAIT_MS", "10"))
+# The client splits large encode() calls into requests of this many texts
+CLIENT_CHUNK_SIZE = 1024
+CLIENT_TIMEOUT_SECONDS = 300
+LATENCY_WINDOW = 1000
+
+
+# -------------------------
+# Batcher
+# -------------------------
+class _Pending:
+    """One queued request: its texts, and a slot the batcher fills in."""
+    __slots__ = ("texts", "normalize", "enqueued_at", "done", "result", "error")
+
+    def __init__(self, texts, normalize):
+        self.texts = texts
+        self.normalize = normalize
+        self.enqueued_at = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:
+    """Coalesces concurrent encode requests into batched model.encode calls."""
+
+    def __init__(self, model, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._queued_texts = 0
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._batch_sizes = deque(maxlen=LATENCY_WINDOW)
+        self._totals = {"requests": 0, "texts": 0, "batches": 0, "encode_seconds": 0.0, "errors": 0}
+        self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._thread.start()
+
+    def encode(self, texts, normalize=True):
+        """Blocks until the texts have been encoded as part of some batch."""
+        pending = _Pending(list(texts), normalize)
+        with self._lock:
+            self._queued_texts += len(pending.texts)
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        size = len(batch[0].texts)
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                pending = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(pending)
+            size += len(pending.texts)
+        return batch, size
+
+    def _run(self):
+        while True:
+            batch, size = self._collect_batch()
+            with self._lock:
+                self._queued_texts -= size
+            texts = [t for pending in batch for t in pending.texts]
+            start = time.perf_counter()
+            try:
+                # Normalize per request below, so mixed requests share a batch
+                embeddings = np.asarray(
+                    self.model.encode(texts, batch_size=self.max_batch_size, show_progress_bar=False),
+                    dtype=np.float32
+                )
+                error = None
+            except Exception as e:
+                embeddings, error = None, e
+            encode_seconds = time.perf_counter() - start
+
+            offset = 0
+            finished = time.perf_counter()
+            for pending in batch:
+                if error is None:
+                    rows = embeddings[offset:offset + len(pending.texts)]
+                    offset += len(pending.texts)
+                    if pending.normalize:
+                        norms = np.linalg.norm(rows, axis=1, keepdims=True)
+                        rows = rows / np.where(norms == 0, 1.0, norms)
+                    pending.result = rows
+                else:
+                    pending.error = error
+                pending.done.set()
+
+            with self._lock:
+                self._totals["requests"] += len(batch)
+                self._totals["texts"] += size
+                self._totals["batches"] += 1
+                self._totals["encode_seconds"] += encode_seconds
+                self._totals["errors"] += 0 if error is None else len(batch)
+                self._batch_sizes.append(size)
+                self._latencies.extend(finished - pending.enqueued_at for pending in batch)
+
+    def stats(self):
+        """Queue depth, batch size and request latency (ms) over the recent window."""
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            batch_sizes = np.array(self._batch_sizes)
+            totals = dict(self._totals)
+            queued_texts = self._queued_texts
+        return {
+            "queue_depth_requests": self._queue.qsize(),
+            "queue_depth_texts": queued_texts,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            **totals,
+            "encode_seconds": round(totals["encode_seconds"], 3),
+            "mean_batch_size": round(float(batch_sizes.mean()), 1) if len(batch_sizes) else None,
+            "latency_ms_p50": round(float(np.percentile(latencies, 50)), 1) if len(latencies) else None,
+            "latency_ms_p95": round(float(np.percentile(latencies, 95)), 1) if len(latencies) else None,
+            "latency_ms_max": round(float(latencies.max()), 1) if len(latencies) else None,
+        }
+
+
+# -------------------------
+# HTTP server
+# -------------------------
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive for the pooled client session
+    batcher = None
+
+    def _send(self, status, body, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send(200, json.dumps(self.batcher.stats()).encode("utf-8"))
+        elif self.path == "/health":
+            self._send(200, b'{"status": "ok"}')
+        else:
+            self._send(404, b'{"error": "not found"}')
+
+    def do_POST(self):
+        if self.path != "/encode":
+            self._send(404, b'{"error": "not found"}')
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            texts = [str(t) for t in payload["texts"]]
+            embeddings = self.batcher.encode(texts, normalize=bool(payload.get("normalize", False)))
+        except Exception as e:
+            self._send(500, json.dumps({"error": f"{type(e).__name__}: {e}"}).encode("utf-8"))
+            return
+        embeddings = np.ascontiguousarray(embeddings, dtype="<f4")
+        self._send(200, embeddings.tobytes(), "application/octet-stream",
+                   {"X-Shape": f"{embeddings.shape[0]},{embeddings.shape[1] if embeddings.ndim == 2 else 0}"})
+
+    def log_message(self, format, *args):
+        pass  # one line per request would drown the batcher's own output
+
+
+def serve(model, host=SERVICE_HOST, port=SERVICE_PORT, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+    """Runs the service until interrupted."""
+    handler = type("EmbeddingHandler", (_Handler,), {"batcher": MicroBatcher(model, max_batch_size, max_wait_ms)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    print(f"Embedding service on http://{host}:{port} (max batch {max_batch_size}, max wait {max_wait_ms} ms)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# -------------------------
+# Client
+# -------------------------
+class RemoteEmbeddingModel:
+    """
+    Drop-in for the SentenceTransformer calls in mapper.py: encode() posts
+    the texts to the service and returns a float32 array.
+
+    One instance is shared by every Streamlit session (st.cache_resource),
+    and requests.Session is not thread-safe, so each thread gets its own
+    session (and connection pool).
+    """
+
+    def __init__(self, url=EMBEDDING_SERVICE_URL, chunk_size=CLIENT_CHUNK_SIZE):
+        self.url = url.rstrip("/")
+        self.chunk_size = chunk_size
+        self._local = threading.local()
+
+    @property
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def encode(self, sentences, normalize_embeddings=False, show_progress_bar=False, batch_size=None, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        chunks = []
+        for start in range(0, len(texts), self.chunk_size):
+            response = self._session.post(
+                f"{self.url}/encode",
+                json={"texts": texts[start:start + self.chunk_size], "normalize": bool(normalize_embeddings)},
+                timeout=CLIENT_TIMEOUT_SECONDS,
+            )
+            if response.status_code != 200:
+                raise RuntimeError(f"Embedding service error {response.status_code}: {response.text[:200]}")
+            rows, dim = (int(v) for v in response.headers["X-Shape"].split(","))
+            chunks.append(np.frombuffer(response.content, dtype="<f4").reshape(rows, dim))
+        embeddings = np.concatenate(chunks) if chunks else np.empty((0, 0), dtype=np.float32)
+        return embeddings[0] if single else embeddings
+
+    def health(self):
+        """True if the service answers /health."""
+        try:
+            return self._session.get(f"{self.url}/health", timeout=2).status_code == 200
+        except requests.RequestException:
+            return False
+
+    def stats(self):
+        return self._session.get(f"{self.url}/stats", timeout=5).json()
+
+
+if __name__ == "__main__":
+    import argparse
+    from sentence_transformers import SentenceTransformer
+
+    parser = argparse.ArgumentParser(description="Shared local embedding service with dynamic micro-batching.")
+    parser.add_argument("--host", default=SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH_SIZE, help="Most texts encoded in one batch.")
+    parser.add_argument("--max-wait-ms", type=float, default=MAX_WAIT_MS, help="Longest a request waits for a batch to fill.")
+    parser.add_argument("--model-path", default=EMBED_MODEL_PATH)
+    args = parser.parse_args()
+
+    serve(SentenceTransformer(args.model_path), args.host, args.port, args.max_batch, args.max_wait_ms)
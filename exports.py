@@ -0,0 +1,111 @@
+# exports.py
+"""
+Lazy, cached result exports.
+
+Download buttons used to serialize the whole result with to_csv() on every
+script rerun, whether or not anyone downloaded it. Here an export is built
+only when asked for, written once to exports/<run_id>/<name>_<version>.<ext>,
+and reused until the data changes (a new version). Streamlit reads a
+download_button's file into memory whenever the button is rendered, so the
+app only renders it in the rerun of an explicit "Prepare export" click.
+"""
+import os
+import time
+import shutil
+
+from stage_cache import fingerprint
+from telemetry import record_metric
+
+# -------------------------
+# Config
+# -------------------------
+EXPORT_DIR = os.getenv("EXPORT_DIR", os.path.abspath("exports"))
+
+# format -> (file extension, MIME type)
+EXPORT_FORMATS = {
+    "csv": (".csv", "text/csv"),
+    "csv.gz": (".csv.gz", "application/gzip"),
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+    "xlsx": (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
+XLSX_MAX_ROWS = 1_048_575  # Excel's sheet limit, minus the header row
+
+
+def export_path(run_id, name, fmt, version):
+    """Where the export of (run_id, name, version) in fmt lives."""
+    extension, _ = EXPORT_FORMATS[fmt]
+    return os.path.join(EXPORT_DIR, run_id, f"{name}_{fingerprint(version)[:12]}{extension}")
+
+
+def _parquet_safe(df):
+    # Object columns can mix lists and their stringified form (e.g.
+    # issue_keys loaded from CSV vs from the DB); Arrow needs one type.
+    df = df.copy()
+    for column in df.columns[df.dtypes == object]:
+        if df[column].map(type).nunique() > 1:
+            df[column] = df[column].astype(str)
+    return df
+
+
+def _excel_safe(df):
+    # Excel cells can't hold lists (issue_keys); write their text form
+    df = df.copy()
+    for column in df.columns[df.dtypes == object]:
+        if df[column].map(lambda v: isinstance(v, (list, tuple, dict))).any():
+            df[column] = df[column].astype(str)
+    return df
+
+
+def _write(df, path, fmt):
+    if fmt == "csv":
+        df.to_csv(path, index=False)
+    elif fmt == "csv.gz":
+        df.to_csv(path, index=False, compression="gzip")
+    elif fmt == "parquet":
+        _parquet_safe(df).to_parquet(path, index=False)
+    elif fmt == "xlsx":
+        if len(df) > XLSX_MAX_ROWS:
+            raise ValueError(f"{len(df)} rows don't fit in one Excel sheet; use CSV or Parquet.")
+        _excel_safe(df).to_excel(path, index=False, engine="openpyxl")
+    else:
+        raise ValueError(f"Unknown export format '{fmt}'. Use one of {list(EXPORT_FORMATS)}.")
+
+
+def get_export(run_id, name, fmt, version):
+    """The path of an already built export, or None."""
+    path = export_path(run_id, name, fmt, version)
+    return path if os.path.exists(path) else None
+
+
+def build_export(df, run_id, name, fmt, version=None):
+    """
+    Writes df as an export (once) and returns its path. version identifies
+    the data (e.g. its save timestamp); by default the frame is fingerprinted.
+    """
+    if version is None:
+        version = fingerprint(df)
+    path = export_path(run_id, name, fmt, version)
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Same extension as the target: the Excel writer picks its format from it
+    tmp_path = os.path.join(os.path.dirname(path), f".tmp{os.getpid()}_{os.path.basename(path)}")
+    start = time.perf_counter()
+    try:
+        _write(df, tmp_path, fmt)
+        os.replace(tmp_path, path)  # readers never see a half-written file
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    record_metric(
+        f"export:{fmt}", (time.perf_counter() - start) * 1000, run_id=run_id,
+        items=len(df), bytes=os.path.getsize(path)
+    )
+    return path
+
+
+def clear_exports(run_id=None):
+    """Deletes the exports of one run (or all of them)."""
+    target = os.path.join(EXPORT_DIR, run_id) if run_id else EXPORT_DIR
+    shutil.rmtree(target, ignore_errors=True)
@@ -0,0 +1,700 @@
+# history_db.py
+import os
+import json
+import uuid
+import queue
+import atexit
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import Future
+from io import StringIO
+from contextlib import contextmanager
+from datetime import datetime
+import pandas as pd
+
+# -------------------------
+# Config
+# -------------------------
+# Both the Streamlit app and the background worker (job_runner.py) read and
+# write the same SQLite file, so all access goes through this module.
+DB_PATH = os.getenv("HISTORY_DB_PATH", os.path.abspath("history.db"))
+
+HISTORY_TABLES = ("step_3_history", "step_4_history")
+
+# Saved Step 3 clusters and Step 4 mappings reference their feedback items
+# by id (item_ids); this is the column the texts are expanded into
+ITEM_TEXT_COLUMNS = {"step_3_history": "feedback_text", "step_4_history": "original_feedback_texts"}
+
+# How long a connection waits for another process's write lock before
+# raising "database is locked".
+BUSY_TIMEOUT_MS = int(os.getenv("HISTORY_DB_BUSY_TIMEOUT_MS", "30000"))
+
+# Saves from every session in this process go through one writer thread,
+# so concurrent Streamlit sessions never compete for SQLite's write lock.
+# Set HISTORY_DB_WRITE_QUEUE=0 to write directly from the calling thread.
+WRITE_QUEUE_ENABLED = os.getenv("HISTORY_DB_WRITE_QUEUE", "1") != "0"
+# Pending saves the writer folds into one transaction
+WRITE_BATCH_MAX = 64
+
+
+def new_run_id():
+    """A collision-free run id: second resolution plus a random suffix."""
+    return f"run_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT_MS / 1000)
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS};")
+    # Durable at every WAL checkpoint; a power loss can only drop the last
+    # few commits, never corrupt the file.
+    conn.execute("PRAGMA synchronous = NORMAL;")
+    return conn
+
+
+@contextmanager
+def get_connection():
+    """
+    Yields a connection to the history database. The transaction is
+    committed on success, rolled back on error, and the connection closed.
+    """
+    conn = _connect()
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+# -------------------------
+# Single writer queue
+# -------------------------
+_writer = {"pid": None, "queue": None, "thread": None}
+_writer_lock = threading.Lock()
+
+
+def _writer_loop(write_queue):
+    conn = _connect()
+    conn.isolation_level = None  # transactions are managed explicitly below
+    while True:
+        batch = [write_queue.get()]
+        while len(batch) < WRITE_BATCH_MAX:
+            try:
+                batch.append(write_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        # One transaction for the whole batch; each save gets a savepoint so
+        # a failing one doesn't take the others down with it.
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE;")
+            for write_fn, future in batch:
+                conn.execute("SAVEPOINT save;")
+                try:
+                    write_fn(conn)
+                    conn.execute("RELEASE save;")
+                    results.append((future, None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO save;")
+                    conn.execute("RELEASE save;")
+                    results.append((future, e))
+            conn.execute("COMMIT;")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK;")
+            results = [(future, e) for _, future in batch]
+
+        for future, error in results:
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+        for _ in batch:
+            write_queue.task_done()
+
+
+def _get_write_queue():
+    # Started lazily and per process: a forked job worker must not inherit
+    # the parent's queue without the thread that drains it.
+    with _writer_lock:
+        if _writer["pid"] != os.getpid():
+            write_queue = queue.Queue()
+            thread = threading.Thread(target=_writer_loop, args=(write_queue,), name="history-db-writer", daemon=True)
+            thread.start()
+            _writer.update(pid=os.getpid(), queue=write_queue, thread=thread)
+        return _writer["queue"]
+
+
+def _submit_write(write_fn, wait=True):
+    """
+    Runs write_fn(conn) on the writer thread (or directly if the queue is
+    disabled). With wait=True, blocks until it is committed and re-raises
+    its error; otherwise returns the Future.
+    """
+    if not WRITE_QUEUE_ENABLED:
+        with get_connection() as conn:
+            write_fn(conn)
+        return None
+    future = Future()
+    _get_write_queue().put((write_fn, future))
+    if wait:
+        future.result()
+    return future
+
+
+def flush_writes():
+    """Blocks until every queued save of this process is committed."""
+    if _writer["pid"] == os.getpid():
+        _writer["queue"].join()
+
+
+atexit.register(flush_writes)
+
+
+def init_db():
+    """Create the history tables in the database if they don't exist."""
+    with get_connection() as conn:
+        # WAL lets readers run while a save is in progress (and vice versa).
+        # The mode is stored in the database file, so this is a one-off.
+        conn.execute("PRAGMA journal_mode = WAL;")
+        conn.execute("CREATE TABLE IF NOT EXISTS step_3_history (run_id TEXT, run_timestamp TEXT, data_json TEXT);")
+        conn.execute("CREATE TABLE IF NOT EXISTS step_4_history (run_id TEXT, run_timestamp TEXT, data_json TEXT);")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                run_id TEXT,
+                job_type TEXT,
+                status TEXT,
+                stage TEXT,
+                progress REAL,
+                message TEXT,
+                payload_json TEXT,
+                created_at TEXT,
+                started_at TEXT,
+                finished_at TEXT,
+                worker TEXT,
+                heartbeat_at TEXT,
+                attempts INTEGER DEFAULT 0
+            );
+        """)
+        # Columns added after the jobs table was first shipped
+        job_columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for column, definition in (("heartbeat_at", "TEXT"), ("attempts", "INTEGER DEFAULT 0")):
+            if column not in job_columns:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at);")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS summary_checkpoints (
+                run_id TEXT,
+                cluster_key TEXT,
+                summary_json TEXT,
+                created_at TEXT,
+                PRIMARY KEY (run_id, cluster_key)
+            );
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS stage_metrics (
+                run_id TEXT,
+                stage TEXT,
+                started_at TEXT,
+                duration_ms REAL,
+                status TEXT,
+                attrs_json TEXT
+            );
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_stage_metrics_run ON stage_metrics (run_id);")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS run_artifacts (
+                run_id TEXT,
+                kind TEXT,
+                name TEXT,
+                path TEXT,
+                created_at TEXT,
+                meta_json TEXT
+            );
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS trend_clusters (
+                trend_key TEXT PRIMARY KEY,
+                label TEXT,
+                label_norm TEXT,
+                total_items INTEGER,
+                first_run_id TEXT,
+                last_run_id TEXT,
+                updated_at TEXT
+            );
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_trend_clusters_label ON trend_clusters (label_norm);")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_trend_clusters_total ON trend_clusters (total_items DESC);")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS trend_items (
+                item_hash INTEGER PRIMARY KEY,
+                trend_key TEXT,
+                run_id TEXT,
+                day TEXT
+            );
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS search_entries (
+                row INTEGER PRIMARY KEY,
+                text_hash INTEGER UNIQUE,
+                kind TEXT,
+                text TEXT
+            );
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS search_occurrences (
+                row INTEGER,
+                run_id TEXT,
+                cluster_label TEXT,
+                mapped_issue_key TEXT,
+                PRIMARY KEY (row, run_id, cluster_label)
+            );
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_search_occurrences_run ON search_occurrences (run_id, cluster_label);")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS run_items (
+                run_id TEXT,
+                item_id INTEGER,
+                text TEXT,
+                PRIMARY KEY (run_id, item_id)
+            ) WITHOUT ROWID;
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS trend_rollups (
+                trend_key TEXT,
+                granularity TEXT,
+                bucket TEXT,
+                item_count INTEGER,
+                PRIMARY KEY (trend_key, granularity, bucket)
+            );
+        """)
+
+
+def save_run_data(df, table_name, run_id):
+    """Saves a dataframe to the database for a specific run_id."""
+    if df is None or df.empty:
+        return
+    if table_name not in HISTORY_TABLES:
+        raise ValueError(f"Unknown history table '{table_name}'.")
+
+    data_json = df.to_json(orient='records')
+    timestamp = datetime.now().isoformat()
+
+    def write(conn):
+        conn.execute(f"DELETE FROM {table_name} WHERE run_id = ?", (run_id,))
+        conn.execute(
+            f"INSERT INTO {table_name} (run_id, run_timestamp, data_json) VALUES (?, ?, ?)",
+            (run_id, timestamp, data_json)
+        )
+    _submit_write(write)
+
+
+def load_run_data(table_name, run_id):
+    """Loads the saved dataframe for one run_id, or None if it has no data."""
+    if table_name not in HISTORY_TABLES:
+        raise ValueError(f"Unknown history table '{table_name}'.")
+    with get_connection() as conn:
+        row = conn.execute(
+            f"SELECT data_json FROM {table_name} WHERE run_id = ? ORDER BY run_timestamp DESC LIMIT 1",
+            (run_id,)
+        ).fetchone()
+    if row is None:
+        return None
+    return pd.read_json(StringIO(row[0]), orient='records')
+
+
+def load_previous_run_data(table_name, run_id):
+    """(run_id, DataFrame) of the most recently saved run other than run_id, or (None, None)."""
+    if table_name not in HISTORY_TABLES:
+        raise ValueError(f"Unknown history table '{table_name}'.")
+    with get_connection() as conn:
+        row = conn.execute(
+            f"SELECT run_id, data_json FROM {table_name} WHERE run_id != ? ORDER BY run_timestamp DESC LIMIT 1",
+            (run_id or "",)
+        ).fetchone()
+    if row is None:
+        return None, None
+    return row[0], pd.read_json(StringIO(row[1]), orient='records')
+
+
+def get_run_timestamp(table_name, run_id):
+    """The save timestamp of a run's data (None if unsaved); cheap cache-buster for UI caches."""
+    if table_name not in HISTORY_TABLES:
+        raise ValueError(f"Unknown history table '{table_name}'.")
+    with get_connection() as conn:
+        row = conn.execute(
+            f"SELECT MAX(run_timestamp) FROM {table_name} WHERE run_id = ?", (run_id,)
+        ).fetchone()
+    return row[0] if row else None
+
+
+def load_all_history():
+    """Loads all run data from the database."""
+    with get_connection() as conn:
+        try:
+            hist_3 = pd.read_sql("SELECT * FROM step_3_history", conn)
+        except Exception as e:
+            print(f"No Step 3 history or error: {e}")
+            hist_3 = pd.DataFrame(columns=['run_id', 'run_timestamp', 'data_json'])
+
+        try:
+            hist_4 = pd.read_sql("SELECT * FROM step_4_history", conn)
+        except Exception as e:
+            print(f"No Step 4 history or error: {e}")
+            hist_4 = pd.DataFrame(columns=['run_id', 'run_timestamp', 'data_json'])
+
+    return hist_3, hist_4
+
+
+def clear_all_history():
+    """Deletes all data from the history tables."""
+    def write(conn):
+        conn.execute("DELETE FROM step_3_history;")
+        conn.execute("DELETE FROM step_4_history;")
+        conn.execute("DELETE FROM summary_checkpoints;")
+        conn.execute("DELETE FROM stage_metrics;")
+        conn.execute("DELETE FROM run_artifacts;")
+        conn.execute("DELETE FROM trend_clusters;")
+        conn.execute("DELETE FROM trend_items;")
+        conn.execute("DELETE FROM trend_rollups;")
+        conn.execute("DELETE FROM search_entries;")
+        conn.execute("DELETE FROM search_occurrences;")
+        conn.execute("DELETE FROM run_items;")
+    _submit_write(write)
+
+
+# -------------------------
+# Feedback items, stored once per run
+# -------------------------
+def item_id(text):
+    """Content id of a feedback item: signed 64-bit hash of its text (fits SQLite's INTEGER)."""
+    return int.from_bytes(hashlib.blake2b(str(text).encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+
+def cluster_key(texts):
+    """Stable id for a cluster's membership, used to key summary checkpoints and saved cluster embeddings."""
+    return hashlib.sha1("\n".join(sorted(texts)).encode("utf-8")).hexdigest()[:16]
+
+
+def parse_item_ids(value):
+    """An item_ids cell as a list of ints (native list, or its JSON/str form from a CSV)."""
+    if isinstance(value, (list, tuple)):
+        return [int(i) for i in value]
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return []
+    try:
+        return [int(i) for i in json.loads(str(value))]
+    except (ValueError, TypeError):
+        return []
+
+
+def save_run_items(run_id, texts):
+    """Stores a run's feedback items, once per distinct text; items already stored are kept."""
+    rows = [(run_id, item_id(text), text) for text in dict.fromkeys(texts)]
+    _submit_write(lambda conn: conn.executemany(
+        "INSERT OR IGNORE INTO run_items (run_id, item_id, text) VALUES (?, ?, ?)", rows
+    ))
+
+
+def load_run_items(run_id, item_ids=None):
+    """{item_id: text} for a run, optionally only for the given ids."""
+    with get_connection() as conn:
+        if item_ids is None:
+            return dict(conn.execute("SELECT item_id, text FROM run_items WHERE run_id = ?", (run_id,)).fetchall())
+        ids = list(dict.fromkeys(int(i) for i in item_ids))
+        items = {}
+        for start in range(0, len(ids), _SQL_PARAMS_CHUNK):
+            chunk = ids[start:start + _SQL_PARAMS_CHUNK]
+            items.update(conn.execute(
+                f"SELECT item_id, text FROM run_items WHERE run_id = ? AND item_id IN ({','.join('?' * len(chunk))})",
+                (run_id, *chunk)
+            ).fetchall())
+    return items
+
+
+def expand_items(df, run_id, text_column="feedback_text"):
+    """
+    A copy of a saved result with its item_ids replaced by the ' | '-joined
+    texts in text_column, for display and export. Frames without item_ids
+    (saved before items were stored by reference, or read back from a CSV
+    export) are returned as they are.
+    """
+    if df is None or df.empty or "item_ids" not in df.columns:
+        return df
+    id_lists = df["item_ids"].map(parse_item_ids)
+    texts = load_run_items(run_id, [i for ids in id_lists for i in ids])
+    position = df.columns.get_loc("item_ids")
+    expanded = df.drop(columns="item_ids")
+    expanded.insert(position, text_column, [" | ".join(texts.get(i, "") for i in ids) for ids in id_lists])
+    return expanded
+
+
+# -------------------------
+# Per-cluster summary checkpoints (Step 3 resume)
+# -------------------------
+def save_summary_checkpoint(run_id, cluster_key, summary):
+    """Stores one successful cluster summary as soon as it completes."""
+    row = (run_id, cluster_key, json.dumps(summary), datetime.now().isoformat())
+    _submit_write(lambda conn: conn.execute(
+        "INSERT OR REPLACE INTO summary_checkpoints (run_id, cluster_key, summary_json, created_at) VALUES (?, ?, ?, ?)",
+        row
+    ))
+
+
+def load_summary_checkpoints(run_id):
+    """Returns {cluster_key: summary_dict} for every checkpointed cluster of a run."""
+    with get_connection() as conn:
+        rows = conn.execute(
+            "SELECT cluster_key, summary_json FROM summary_checkpoints WHERE run_id = ?", (run_id,)
+        ).fetchall()
+    return {key: json.loads(summary_json) for key, summary_json in rows}
+
+
+# -------------------------
+# Per-stage performance metrics (see telemetry.py)
+# -------------------------
+def save_stage_metrics(rows):
+    """Inserts metric rows: (run_id, stage, started_at, duration_ms, status, attrs_json)."""
+    if not rows:
+        return
+    rows = list(rows)
+    # Metrics are never read back by the run that writes them, so there is
+    # no need to wait for the commit.
+    _submit_write(lambda conn: conn.executemany(
+        "INSERT INTO stage_metrics (run_id, stage, started_at, duration_ms, status, attrs_json) VALUES (?, ?, ?, ?, ?, ?)",
+        rows
+    ), wait=False)
+
+
+def load_stage_metrics(run_ids=None):
+    """Loads raw metric rows for the given run_ids (all runs if None)."""
+    query = "SELECT run_id, stage, started_at, duration_ms, status, attrs_json FROM stage_metrics"
+    params = []
+    if run_ids is not None:
+        run_ids = list(run_ids)
+        if not run_ids:
+            return pd.DataFrame(columns=["run_id", "stage", "started_at", "duration_ms", "status", "attrs_json"])
+        query += f" WHERE run_id IN ({', '.join('?' for _ in run_ids)})"
+        params = run_ids
+    with get_connection() as conn:
+        return pd.read_sql(query, conn, params=params)
+
+
+# -------------------------
+# Files attached to a run (profiles, ...)
+# -------------------------
+def save_run_artifact(run_id, kind, name, path, meta=None):
+    """Records a file produced for a run."""
+    row = (run_id, kind, name, path, datetime.now().isoformat(), json.dumps(meta or {}))
+    _submit_write(lambda conn: conn.execute(
+        "INSERT INTO run_artifacts (run_id, kind, name, path, created_at, meta_json) VALUES (?, ?, ?, ?, ?, ?)",
+        row
+    ))
+
+
+def load_run_artifacts(run_id, kind=None):
+    """Lists the artifacts of a run (optionally of one kind), newest first."""
+    query = "SELECT run_id, kind, name, path, created_at, meta_json FROM run_artifacts WHERE run_id = ?"
+    params = [run_id]
+    if kind:
+        query += " AND kind = ?"
+        params.append(kind)
+    query += " ORDER BY created_at DESC"
+    with get_connection() as conn:
+        return pd.read_sql(query, conn, params=params)
+
+
+def latest_artifact_run_id(kind):
+    """The run that most recently saved an artifact of this kind, or None."""
+    with get_connection() as conn:
+        row = conn.execute(
+            "SELECT run_id FROM run_artifacts WHERE kind = ? ORDER BY created_at DESC LIMIT 1", (kind,)
+        ).fetchone()
+    return row[0] if row else None
+
+
+# -------------------------
+# Trend rollups (see trends.py)
+# -------------------------
+_SQL_PARAMS_CHUNK = 900
+
+
+def _trend_owners(conn, item_hashes):
+    """{item_hash: trend_key} for the items already counted."""
+    owners = {}
+    for start in range(0, len(item_hashes), _SQL_PARAMS_CHUNK):
+        chunk = item_hashes[start:start + _SQL_PARAMS_CHUNK]
+        owners.update(conn.execute(
+            f"SELECT item_hash, trend_key FROM trend_items WHERE item_hash IN ({', '.join('?' for _ in chunk)})", chunk
+        ).fetchall())
+    return owners
+
+
+def save_trend_items(run_id, clusters, match_threshold):
+    """
+    Adds one run's clusters to the trend rollups, in one transaction.
+    clusters: [{"key", "label", "label_norm", "items": [(item_hash, day, week), ...]}].
+
+    A cluster keeps the trend identity that already owns at least
+    match_threshold of its items, else the identity with the same
+    normalized label, else its own key becomes a new identity. Only items
+    not counted before are added, so re-saving a run (or re-uploading the
+    same feedback) never double counts.
+    """
+    now = datetime.now().isoformat()
+
+    def write(conn):
+        for cluster in clusters:
+            items = list({h: (h, day, week) for h, day, week in cluster["items"]}.values())
+            if not items:
+                continue
+            owners = _trend_owners(conn, [h for h, _, _ in items])
+
+            trend_key = None
+            if owners:
+                owner_counts = pd.Series(list(owners.values())).value_counts()
+                if owner_counts.iloc[0] / len(items) >= match_threshold:
+                    trend_key = owner_counts.index[0]
+            if trend_key is None:
+                row = conn.execute(
+                    "SELECT trend_key FROM trend_clusters WHERE label_norm = ? ORDER BY total_items DESC LIMIT 1",
+                    (cluster["label_norm"],)
+                ).fetchone()
+                trend_key = row[0] if row else cluster["key"]
+
+            new_items = [(h, day, week) for h, day, week in items if h not in owners]
+            conn.executemany(
+                "INSERT OR IGNORE INTO trend_items (item_hash, trend_key, run_id, day) VALUES (?, ?, ?, ?)",
+                [(h, trend_key, run_id, day) for h, day, _ in new_items]
+            )
+            for granularity, position in (("day", 1), ("week", 2)):
+                counts = pd.Series([item[position] for item in new_items], dtype=object).value_counts()
+                conn.executemany(
+                    """
+                    INSERT INTO trend_rollups (trend_key, granularity, bucket, item_count) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (trend_key, granularity, bucket) DO UPDATE SET item_count = item_count + excluded.item_count
+                    """,
+                    [(trend_key, granularity, bucket, int(n)) for bucket, n in counts.items()]
+                )
+            conn.execute(
+                """
+                INSERT INTO trend_clusters (trend_key, label, label_norm, total_items, first_run_id, last_run_id, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (trend_key) DO UPDATE SET
+                    label = excluded.label, label_norm = excluded.label_norm,
+                    total_items = total_items + excluded.total_items,
+                    last_run_id = excluded.last_run_id, updated_at = excluded.updated_at
+                """,
+                (trend_key, cluster["label"], cluster["label_norm"], len(new_items), run_id, run_id, now)
+            )
+    _submit_write(write)
+
+
+def load_trend_clusters(limit=50):
+    """The trend identities with the most items: trend_key, label, total_items, first/last run."""
+    with get_connection() as conn:
+        return pd.read_sql(
+            "SELECT trend_key, label, total_items, first_run_id, last_run_id, updated_at FROM trend_clusters "
+            "ORDER BY total_items DESC LIMIT ?",
+            conn, params=[int(limit)]
+        )
+
+
+def load_trend_rollups(trend_keys, granularity="week"):
+    """Item counts per bucket for the given trend identities (primary-key lookups only)."""
+    trend_keys = list(trend_keys)
+    if not trend_keys:
+        return pd.DataFrame(columns=["trend_key", "bucket", "item_count"])
+    with get_connection() as conn:
+        return pd.read_sql(
+            "SELECT trend_key, bucket, item_count FROM trend_rollups "
+            f"WHERE granularity = ? AND trend_key IN ({', '.join('?' for _ in trend_keys)}) ORDER BY bucket",
+            conn, params=[granularity] + trend_keys
+        )
+
+
+# -------------------------
+# Load test: python history_db.py --sessions 32 --processes 2
+# -------------------------
+def _simulated_session(rounds, rows_per_save):
+    """One user: a few full runs of save Step 3 -> checkpoints -> metrics -> read back -> save Step 4."""
+    import time
+    latencies, errors = [], []
+    for _ in range(rounds):
+        run_id = new_run_id()
+        frame = pd.DataFrame({"cluster_label": [f"{run_id}-{i}" for i in range(rows_per_save)], "request_count": 1})
+        try:
+            start = time.perf_counter()
+            save_run_data(frame, "step_3_history", run_id)
+            for i in range(10):
+                save_summary_checkpoint(run_id, f"c{i}", {"cluster_label": str(i)})
+            save_stage_metrics([(run_id, "load_test", datetime.now().isoformat(), 1.0, "ok", "{}")] * 20)
+            loaded = load_run_data("step_3_history", run_id)
+            if loaded is None or len(loaded) != rows_per_save or loaded["cluster_label"].iloc[0] != f"{run_id}-0":
+                raise AssertionError(f"Step 3 data of {run_id} missing or overwritten")
+            save_run_data(frame, "step_4_history", run_id)
+            latencies.append(time.perf_counter() - start)
+        except Exception as e:
+            errors.append(f"{type(e).__name__}: {e}")
+    return latencies, errors
+
+
+def _run_sessions(n_sessions, rounds, rows_per_save):
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=n_sessions) as pool:
+        results = list(pool.map(lambda _: _simulated_session(rounds, rows_per_save), range(n_sessions)))
+    flush_writes()
+    return [l for r in results for l in r[0]], [e for r in results for e in r[1]]
+
+
+if __name__ == "__main__":
+    import argparse
+    import tempfile
+    import time
+    import numpy as np
+    from multiprocessing import Pool
+
+    parser = argparse.ArgumentParser(description="Concurrent-session load test for the history database.")
+    parser.add_argument("--sessions", type=int, default=16, help="Simulated sessions (threads) per process.")
+    parser.add_argument("--processes", type=int, default=1, help="Server processes sharing the database file.")
+    parser.add_argument("--rounds", type=int, default=5, help="Runs saved per session.")
+    parser.add_argument("--rows", type=int, default=200, help="Rows per saved DataFrame.")
+    parser.add_argument("--no-queue", action="store_true", help="Write directly from each session (old behaviour).")
+    parser.add_argument("--no-wal", action="store_true", help="Keep the default rollback journal.")
+    args = parser.parse_args()
+
+    DB_PATH = os.path.join(tempfile.mkdtemp(), "history_load_test.db")
+    WRITE_QUEUE_ENABLED = not args.no_queue
+    # Pool workers started with spawn re-import this module, so they read the settings from the environment
+    os.environ["HISTORY_DB_PATH"] = DB_PATH
+    os.environ["HISTORY_DB_WRITE_QUEUE"] = "1" if WRITE_QUEUE_ENABLED else "0"
+    init_db()
+    if args.no_wal:
+        with get_connection() as conn:
+            conn.execute("PRAGMA journal_mode = DELETE;")
+
+    start = time.perf_counter()
+    if args.processes > 1:
+        with Pool(args.processes) as pool:
+            results = pool.starmap(_run_sessions, [(args.sessions, args.rounds, args.rows)] * args.processes)
+    else:
+        results = [_run_sessions(args.sessions, args.rounds, args.rows)]
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([l for r in results for l in r[0]])
+    errors = [e for r in results for e in r[1]]
+    with get_connection() as conn:
+        runs_saved = conn.execute("SELECT COUNT(DISTINCT run_id) FROM step_4_history").fetchone()[0]
+    expected = args.sessions * args.processes * args.rounds
+
+    print(f"{args.processes} process(es) x {args.sessions} sessions x {args.rounds} runs, "
+          f"queue={'on' if WRITE_QUEUE_ENABLED else 'off'}, wal={'off' if args.no_wal else 'on'}")
+    print(f"  runs saved: {runs_saved}/{expected}, errors: {len(errors)}, wall: {elapsed:.1f} s, "
+          f"throughput: {len(latencies) / elapsed:.1f} runs/s")
+    if len(latencies):
+        print(f"  per-run latency: p50 {np.percentile(latencies, 50) * 1000:.0f} ms, "
+              f"p95 {np.percentile(latencies, 95) * 1000:.0f} ms, max {latencies.max() * 1000:.0f} ms")
+    for error in sorted(set(errors))[:5]:
+        print(f"  {error}")
@@ -0,0 +1,131 @@
+# integrations/fake_jira_server.py
+"""
+Local stand-in for the Jira Cloud endpoints this app uses, for testing the
+Step 2 fetch and the Step 4 write-back without touching a real instance.
+
+    python integrations/fake_jira_server.py [--port 8089] [--issues jira_dealblockers.csv] [--latency-ms 50]
+    JIRA_BASE_URL=http://127.0.0.1:8089 JIRA_EMAIL=x JIRA_API_TOKEN=x streamlit run app.py
+
+Issues are seeded from a CSV with "Issue Key" and "Summary" columns and
+kept in memory. GET /_calls returns the number of calls per endpoint and
+the peak number of concurrent requests; POST /_reset clears them.
+"""
+import os
+import time
+import argparse
+import threading
+from collections import Counter
+import pandas as pd
+from flask import Flask, jsonify, request
+
+app = Flask(__name__)
+
+ISSUES = {}
+CALLS = Counter()
+LATENCY_SECONDS = 0.0
+_state = {"in_flight": 0, "peak_in_flight": 0}
+_lock = threading.Lock()
+
+
+def seed_issues(csv_path):
+    df = pd.read_csv(csv_path)
+    for row in df.to_dict(orient="records"):
+        ISSUES[row["Issue Key"]] = {
+            "summary": row.get("Summary"),
+            "status": {"name": row.get("Status") or "Open"},
+            "priority": {"name": row.get("Priority") or "Medium"},
+            "reporter": {"displayName": row.get("Reporter") or "Fake Reporter"},
+            "description": row.get("Description"),
+            "comment": {"comments": []},
+        }
+
+
+@app.before_request
+def _track():
+    CALLS[request.endpoint] += 1
+    with _lock:
+        _state["in_flight"] += 1
+        _state["peak_in_flight"] = max(_state["peak_in_flight"], _state["in_flight"])
+    if LATENCY_SECONDS:
+        time.sleep(LATENCY_SECONDS)
+
+
+@app.teardown_request
+def _untrack(_exc):
+    with _lock:
+        _state["in_flight"] -= 1
+
+
+def _issue_json(key, fields=None):
+    issue = ISSUES[key]
+    if fields:
+        issue = {f: issue.get(f) for f in fields}
+    return {"key": key, "fields": issue}
+
+
+@app.post("/rest/api/3/search/jql")
+def search():
+    payload = request.get_json(force=True)
+    keys = list(ISSUES)[: int(payload.get("maxResults", 50))]
+    return jsonify({"issues": [_issue_json(k) for k in keys]})
+
+
+@app.post("/rest/api/3/issue/bulkfetch")
+def bulkfetch():
+    payload = request.get_json(force=True)
+    keys = payload.get("issueIdsOrKeys", [])
+    if len(keys) > 100:
+        return jsonify({"errorMessages": ["At most 100 issues per request."]}), 400
+    found = [k for k in keys if k in ISSUES]
+    return jsonify({
+        "issues": [_issue_json(k, payload.get("fields")) for k in found],
+        "issueErrors": [{"issueIdOrKey": k, "errorMessages": ["Issue does not exist"]} for k in keys if k not in ISSUES],
+    })
+
+
+@app.get("/rest/api/3/issue/<key>")
+def get_issue(key):
+    if key not in ISSUES:
+        return jsonify({"errorMessages": ["Issue does not exist"]}), 404
+    return jsonify(_issue_json(key))
+
+
+@app.put("/rest/api/3/issue/<key>")
+def edit_issue(key):
+    if key not in ISSUES:
+        return jsonify({"errorMessages": ["Issue does not exist"]}), 404
+    ISSUES[key].update(request.get_json(force=True).get("fields", {}))
+    return "", 204
+
+
+@app.post("/rest/api/3/issue/<key>/comment")
+def add_comment(key):
+    if key not in ISSUES:
+        return jsonify({"errorMessages": ["Issue does not exist"]}), 404
+    comment = {"id": str(sum(len(i["comment"]["comments"]) for i in ISSUES.values()) + 1), **request.get_json(force=True)}
+    ISSUES[key]["comment"]["comments"].append(comment)
+    return jsonify(comment), 201
+
+
+@app.get("/_calls")
+def calls():
+    return jsonify({"calls": dict(CALLS), "peak_in_flight": _state["peak_in_flight"]})
+
+
+@app.post("/_reset")
+def reset():
+    CALLS.clear()
+    _state["peak_in_flight"] = 0
+    return "", 204
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in Jira server.")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--issues", default=os.path.abspath("jira_dealblockers.csv"), help="CSV to seed issues from.")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Added latency per request.")
+    args = parser.parse_args()
+
+    seed_issues(args.issues)
+    LATENCY_SECONDS = args.latency_ms / 1000
+    app.run(port=args.port, threaded=True)
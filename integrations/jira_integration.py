@@ -0,0 +1,278 @@
+# integrations/jira_integration.py
+"""
+Writes Step 4 mapping results back to the mapped Jira issues.
+
+For every mapped issue the rows of the mapping are rolled up into: the
+total request_count, the linked feedback keys (PRDFBK-...) and the best
+match score. These go into custom fields when their ids are configured
+(JIRA_REQUEST_COUNT_FIELD, JIRA_FEEDBACK_KEYS_FIELD, JIRA_MATCH_SCORE_FIELD),
+otherwise into one marked comment per issue.
+
+Current values are read in bulk (POST /rest/api/3/issue/bulkfetch, 100
+issues per call) so unchanged fields, and comments identical to the last
+sync comment, are skipped without a write. Jira's bulk edit endpoint sets
+the same value on every selected issue, and here every issue gets its own
+numbers, so the writes are per-issue PUT/POST calls, run with bounded
+concurrency over one pooled session. dry_run=True returns the planned calls
+without sending them.
+
+Test it against the local stand-in: python integrations/fake_jira_server.py
+and JIRA_BASE_URL=http://127.0.0.1:8089.
+"""
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dotenv import load_dotenv
+
+from issue_keys import extract_issue_keys, parse_issue_keys
+from telemetry import track_stage
+
+load_dotenv()
+
+JIRA_BASE_URL = os.getenv("JIRA_BASE_URL")
+JIRA_EMAIL = os.getenv("JIRA_EMAIL")
+JIRA_API_TOKEN = os.getenv("JIRA_API_TOKEN")
+
+# Custom field ids (e.g. "customfield_10801"); empty means "use a comment"
+REQUEST_COUNT_FIELD = os.getenv("JIRA_REQUEST_COUNT_FIELD", "")
+FEEDBACK_KEYS_FIELD = os.getenv("JIRA_FEEDBACK_KEYS_FIELD", "")
+MATCH_SCORE_FIELD = os.getenv("JIRA_MATCH_SCORE_FIELD", "")
+
+FEEDBACK_KEY_PROJECT = os.getenv("FEEDBACK_KEY_PROJECT", "PRDFBK")
+WRITEBACK_CONCURRENCY = int(os.getenv("JIRA_WRITEBACK_CONCURRENCY", "4"))
+BULK_FETCH_SIZE = 100  # Jira's limit for /issue/bulkfetch
+REQUEST_TIMEOUT_SECONDS = 30
+COMMENT_MARKER = "[feedback-sync]"
+# The session only retries idempotent methods. POSTs (the read-only
+# bulkfetch, and comments after checking they weren't already stored) are
+# retried explicitly, up to POST_RETRIES times
+RETRY_STATUSES = (429, 503)
+POST_RETRIES = 3
+
+
+# -------------------------
+# Session
+# -------------------------
+def make_session(concurrency=WRITEBACK_CONCURRENCY, email=JIRA_EMAIL, api_token=JIRA_API_TOKEN):
+    """
+    A pooled session sized for the write concurrency, retrying 429/503 with
+    Retry-After for idempotent methods (GET, PUT, ...) only: a comment POST
+    answered with a 503 may already be stored.
+    """
+    session = requests.Session()
+    retry = Retry(
+        total=3, backoff_factor=0.5, status_forcelist=RETRY_STATUSES,
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS, respect_retry_after_header=True, raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(concurrency, 1), max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Accept": "application/json", "Content-Type": "application/json"})
+    if email and api_token:
+        session.auth = (email, api_token)
+    return session
+
+
+def _retry_delay(response, attempt):
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (AttributeError, TypeError, ValueError):
+        return 0.5 * 2 ** attempt
+
+
+# -------------------------
+# Plan
+# -------------------------
+def build_writeback_rows(mapped_df, feedback_project=FEEDBACK_KEY_PROJECT):
+    """One row per mapped Jira issue: request_count (sum), feedback_keys, match_score (max)."""
+    columns = ["issue_key", "request_count", "feedback_keys", "match_score"]
+    if mapped_df is None or mapped_df.empty:
+        return pd.DataFrame(columns=columns)
+
+    texts = mapped_df.get("original_feedback_texts", pd.Series([""] * len(mapped_df))).fillna("").astype(str)
+    extracted = mapped_df.get("extracted_feedback_keys", pd.Series([[]] * len(mapped_df)))
+    prefix = f"{feedback_project}-"
+    row_keys = [
+        [k for k in dict.fromkeys(found + parse_issue_keys(listed)) if k.startswith(prefix)]
+        for found, listed in zip(extract_issue_keys(texts), extracted)
+    ]
+
+    grouped = mapped_df.assign(_keys=row_keys).groupby("mapped_issue_key", sort=True)
+    return pd.DataFrame({
+        "issue_key": list(grouped.groups),
+        "request_count": grouped["request_count"].sum().astype(int).to_numpy(),
+        "feedback_keys": grouped["_keys"].agg(lambda lists: sorted({k for keys in lists for k in keys})).to_numpy(),
+        "match_score": grouped["match_score"].max().astype(float).round(3).to_numpy(),
+    })[columns]
+
+
+def _field_values(row):
+    values = {}
+    if REQUEST_COUNT_FIELD:
+        values[REQUEST_COUNT_FIELD] = int(row["request_count"])
+    if FEEDBACK_KEYS_FIELD:
+        values[FEEDBACK_KEYS_FIELD] = ", ".join(row["feedback_keys"])
+    if MATCH_SCORE_FIELD:
+        values[MATCH_SCORE_FIELD] = float(row["match_score"])
+    return values
+
+
+def _comment_text(row):
+    """The sync comment for values not stored in fields (deterministic, so repeats can be detected)."""
+    parts = []
+    if not REQUEST_COUNT_FIELD:
+        parts.append(f"{int(row['request_count'])} customer request(s)")
+    if not FEEDBACK_KEYS_FIELD:
+        parts.append(f"linked feedback: {', '.join(row['feedback_keys']) or 'none'}")
+    if not MATCH_SCORE_FIELD:
+        parts.append(f"match score {float(row['match_score']):.3f}")
+    return f"{COMMENT_MARKER} " + "; ".join(parts) if parts else None
+
+
+def _adf(text):
+    """Atlassian Document Format body for a one-paragraph comment."""
+    return {"type": "doc", "version": 1, "content": [{"type": "paragraph", "content": [{"type": "text", "text": text}]}]}
+
+
+def _adf_text(body):
+    if isinstance(body, str):
+        return body
+    if isinstance(body, dict):
+        return body.get("text", "") + "".join(_adf_text(node) for node in body.get("content", []))
+    return ""
+
+
+def _last_sync_comment(fields):
+    comments = (fields.get("comment") or {}).get("comments", [])
+    synced = [_adf_text(c.get("body")) for c in comments if COMMENT_MARKER in _adf_text(c.get("body"))]
+    return synced[-1] if synced else None
+
+
+def fetch_current_values(session, issue_keys, base_url=JIRA_BASE_URL):
+    """{issue_key: fields} for the write-back fields (and comments), via bulkfetch."""
+    fields = [f for f in (REQUEST_COUNT_FIELD, FEEDBACK_KEYS_FIELD, MATCH_SCORE_FIELD) if f] + ["comment"]
+    current = {}
+    for start in range(0, len(issue_keys), BULK_FETCH_SIZE):
+        chunk = list(issue_keys[start:start + BULK_FETCH_SIZE])
+        with track_stage("jira_bulkfetch", items=len(chunk)):
+            # A read despite being a POST, so safe to retry
+            for attempt in range(POST_RETRIES + 1):
+                response = session.post(
+                    f"{base_url}/rest/api/3/issue/bulkfetch",
+                    json={"issueIdsOrKeys": chunk, "fields": fields},
+                    timeout=REQUEST_TIMEOUT_SECONDS,
+                )
+                if response.status_code not in RETRY_STATUSES or attempt == POST_RETRIES:
+                    break
+                time.sleep(_retry_delay(response, attempt))
+            response.raise_for_status()
+        for issue in response.json().get("issues", []):
+            current[issue["key"]] = issue.get("fields", {})
+    return current
+
+
+def plan_writeback(rows, current):
+    """
+    The calls needed to bring each issue up to date, skipping fields that
+    already hold the value and comments identical to the last sync comment.
+    Returns a list of {"issue_key", "action", "method", "path", "body", "changes"}.
+    """
+    calls = []
+    for row in rows.to_dict(orient="records"):
+        key = row["issue_key"]
+        if key not in current:
+            calls.append({"issue_key": key, "action": "missing", "method": None, "path": None, "body": None,
+                          "changes": "issue not found or not visible"})
+            continue
+        fields = current[key]
+
+        changed = {f: v for f, v in _field_values(row).items() if fields.get(f) != v}
+        if changed:
+            calls.append({"issue_key": key, "action": "update_fields", "method": "PUT",
+                          "path": f"/rest/api/3/issue/{key}", "body": {"fields": changed},
+                          "changes": ", ".join(f"{f}: {fields.get(f)!r} -> {v!r}" for f, v in changed.items())})
+
+        text = _comment_text(row)
+        if text is not None and _last_sync_comment(fields) != text:
+            calls.append({"issue_key": key, "action": "add_comment", "method": "POST",
+                          "path": f"/rest/api/3/issue/{key}/comment", "body": {"body": _adf(text)}, "changes": text})
+
+        if not changed and (text is None or _last_sync_comment(fields) == text):
+            calls.append({"issue_key": key, "action": "skip", "method": None, "path": None, "body": None,
+                          "changes": "already up to date"})
+    return calls
+
+
+# -------------------------
+# Execute
+# -------------------------
+def _comment_already_posted(session, base_url, call):
+    try:
+        current = fetch_current_values(session, [call["issue_key"]], base_url=base_url)
+    except requests.RequestException:
+        return False
+    return _last_sync_comment(current.get(call["issue_key"], {})) == call["changes"]
+
+
+def _send(session, base_url, call):
+    # PUTs are retried by the session; a comment POST is only retried after
+    # checking that Jira didn't store it before answering 429/503 or dropping
+    # the connection, so a retry never duplicates the sync comment
+    retries = POST_RETRIES if call["action"] == "add_comment" else 0
+    for attempt in range(retries + 1):
+        try:
+            response, error = session.request(call["method"], f"{base_url}{call['path']}", json=call["body"],
+                                              timeout=REQUEST_TIMEOUT_SECONDS), None
+        except requests.RequestException as e:
+            response, error = None, e
+        if attempt == retries or (response is not None and response.status_code not in RETRY_STATUSES):
+            break
+        if _comment_already_posted(session, base_url, call):
+            return {"status": "ok", "http_status": None if response is None else response.status_code,
+                    "detail": "comment was stored despite the error; not re-posted"}
+        time.sleep(_retry_delay(response, attempt))
+
+    if error is not None:
+        return {"status": "error", "http_status": None, "detail": str(error)}
+    ok = response.status_code < 300
+    return {"status": "ok" if ok else "error", "http_status": response.status_code,
+            "detail": "" if ok else response.text[:200]}
+
+
+def write_back_mapping(mapped_df, dry_run=True, base_url=JIRA_BASE_URL, concurrency=WRITEBACK_CONCURRENCY, session=None):
+    """
+    Pushes request counts, feedback keys and match scores of a Step 4
+    mapping to Jira. Returns a DataFrame with one row per planned call:
+    issue_key, action, changes, status ("planned" in dry-run mode).
+    """
+    if not base_url:
+        raise ValueError("Missing JIRA_BASE_URL.")
+    base_url = base_url.rstrip("/")
+    rows = build_writeback_rows(mapped_df)
+    if rows.empty:
+        return pd.DataFrame(columns=["issue_key", "action", "changes", "status", "http_status", "detail"])
+
+    session = session or make_session(concurrency)
+    current = fetch_current_values(session, rows["issue_key"].tolist(), base_url=base_url)
+    calls = plan_writeback(rows, current)
+
+    to_send = [c for c in calls if c["method"]]
+    if dry_run:
+        results = [{"status": "planned", "http_status": None, "detail": f"{c['method']} {c['path']} {json.dumps(c['body'])}"}
+                   for c in to_send]
+    else:
+        with track_stage("jira_writeback", items=len(to_send), concurrency=concurrency):
+            with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as pool:
+                results = list(pool.map(lambda c: _send(session, base_url, c), to_send))
+
+    result_by_call = {id(c): r for c, r in zip(to_send, results)}
+    report = []
+    for call in calls:
+        outcome = result_by_call.get(id(call), {"status": call["action"], "http_status": None, "detail": ""})
+        report.append({"issue_key": call["issue_key"], "action": call["action"], "changes": call["changes"], **outcome})
+    return pd.DataFrame(report)
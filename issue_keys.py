@@ -0,0 +1,61 @@
+# issue_keys.py
+import re
+import ast
+import pandas as pd
+
+# Jira keys look like PROJECT-123 (e.g. "PRDFBK-4676", "SDK-123"). The
+# project part is an upper-case letter followed by upper-case letters or
+# digits. Values that are not real keys ("UTF-8") can match, but Step 4
+# only uses keys that exist in the fetched Jira issues.
+ISSUE_KEY_PATTERN = r"\b[A-Z][A-Z0-9]+-\d+\b"
+ISSUE_KEY_REGEX = re.compile(ISSUE_KEY_PATTERN)
+
+
+def extract_issue_keys(texts):
+    """Returns the list of keys found in each text (vectorized over the list)."""
+    return pd.Series(list(texts), dtype=object).astype(str).str.findall(ISSUE_KEY_PATTERN).tolist()
+
+
+def extract_cluster_issue_keys(cluster_groups):
+    """
+    Returns {cluster_id: [keys]} with every distinct key mentioned by a
+    cluster's feedback, in order of first appearance. One str.findall over
+    all texts, then explode + groupby, instead of asking the LLM.
+    """
+    cluster_ids = [cid for cid, texts in cluster_groups.items() for _ in texts]
+    texts = [t for group in cluster_groups.values() for t in group]
+    if not texts:
+        return {cid: [] for cid in cluster_groups}
+
+    found = (
+        pd.Series(texts, index=cluster_ids, dtype=object).astype(str)
+        .str.findall(ISSUE_KEY_PATTERN)
+        .explode()
+        .dropna()
+    )
+    keys_by_cluster = found.groupby(level=0, sort=False).agg(lambda keys: list(dict.fromkeys(keys))).to_dict()
+    return {cid: keys_by_cluster.get(cid, []) for cid in cluster_groups}
+
+
+def parse_issue_keys(value):
+    """
+    Normalizes an 'issue_keys' value to a list: native lists pass through;
+    the stringified form written to CSVs ("['SDK-1']") is parsed safely.
+    """
+    if isinstance(value, list):
+        return value
+    if isinstance(value, (tuple, set)):
+        return list(value)
+    issue_keys_str = str(value)
+
+    # Handle cases where the value is None, NaN, or an empty string
+    if issue_keys_str.lower() in ('', 'nan', 'none', 'null', '[]'):
+        return []
+    try:
+        # Try to evaluate the string as a Python literal
+        issue_keys = ast.literal_eval(issue_keys_str)
+    except (ValueError, SyntaxError):
+        # Fail safely to an empty list
+        return []
+    # Ensure the result is actually a list
+    return list(issue_keys) if isinstance(issue_keys, (list, tuple)) else []
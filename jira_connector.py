@@ -4,6 +4,8 @@ import pandas as pd
 from dotenv import load_dotenv
 import streamlit as st  
 
+from telemetry import track_stage
+
 load_dotenv()
 
 JIRA_BASE_URL = os.getenv("JIRA_BASE_URL")
@@ -43,9 +45,11 @@ def fetch_jira_issues(jql_query):
     }
 
     try:
-        response = requests.post(url, headers=headers, json=payload, auth=auth)
-        response.raise_for_status()
-        data = response.json()
+        with track_stage("jira_fetch_page", page=1) as page_metrics:
+            response = requests.post(url, headers=headers, json=payload, auth=auth)
+            response.raise_for_status()
+            data = response.json()
+            page_metrics["items"] = len(data.get("issues", []))
 
         if "issues" not in data:
             raise ValueError(f"Unexpected Jira response format: {data}")
@@ -0,0 +1,338 @@
+# job_runner.py
+"""
+Background job subsystem for the long-running pipeline steps.
+
+The Streamlit app only *queues* work in the `jobs` table of history.db and
+polls it for status. One or more worker processes started with
+
+    python job_runner.py --workers 2
+
+claim queued jobs, run clustering / summarization / mapping, report stage
+progress back into the table and save their results under the job's run_id
+(step_3_history / step_4_history), exactly like an inline run would.
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import argparse
+import threading
+import traceback
+import multiprocessing
+from datetime import datetime, timedelta
+import pandas as pd
+from dotenv import load_dotenv
+
+from history_db import get_connection, init_db, save_run_data, save_run_items
+from telemetry import run_context
+from trends import item_timestamps, update_trends
+
+load_dotenv()
+
+POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL", "2.0"))
+# A running job's worker touches heartbeat_at this often; a job whose
+# heartbeat is older than JOB_STALE_SECONDS lost its worker and is re-queued
+# (at most JOB_MAX_ATTEMPTS claims in total, then marked failed)
+HEARTBEAT_INTERVAL_SECONDS = float(os.getenv("JOB_HEARTBEAT_INTERVAL", "15"))
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "120"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "2"))
+
+JOB_TYPE_CONSOLIDATION = "consolidation"  # Step 3: clustering + summarization
+JOB_TYPE_MAPPING = "mapping"              # Step 4: mapping to Jira dealblockers
+
+ACTIVE_STATUSES = ("queued", "running")
+
+
+# -------------------------
+# Job table helpers (used by app.py and the worker)
+# -------------------------
+def _row_to_job(row):
+    keys = [
+        "job_id", "run_id", "job_type", "status", "stage", "progress", "message",
+        "payload_json", "created_at", "started_at", "finished_at", "worker", "heartbeat_at", "attempts"
+    ]
+    job = dict(zip(keys, row))
+    job["payload"] = json.loads(job.pop("payload_json") or "{}")
+    return job
+
+
+def enqueue_job(run_id, job_type, payload):
+    """Adds a job to the queue and returns its job_id."""
+    job_id = uuid.uuid4().hex
+    with get_connection() as conn:
+        conn.execute(
+            "INSERT INTO jobs (job_id, run_id, job_type, status, stage, progress, message, payload_json, created_at) "
+            "VALUES (?, ?, ?, 'queued', 'queued', 0.0, '', ?, ?)",
+            (job_id, run_id, job_type, json.dumps(payload), datetime.now().isoformat())
+        )
+    return job_id
+
+
+def get_job(job_id):
+    """Returns a single job as a dict, or None."""
+    with get_connection() as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+    return _row_to_job(row) if row else None
+
+
+def list_jobs(run_id=None, limit=20):
+    """Returns the most recent jobs (optionally for one run) as a DataFrame, without payloads."""
+    query = ("SELECT job_id, run_id, job_type, status, stage, progress, message, created_at, started_at, finished_at, worker "
+             "FROM jobs")
+    params = []
+    if run_id:
+        query += " WHERE run_id = ?"
+        params.append(run_id)
+    query += " ORDER BY created_at DESC LIMIT ?"
+    params.append(int(limit))
+    with get_connection() as conn:
+        return pd.read_sql(query, conn, params=params)
+
+
+def update_job(job_id, **fields):
+    """Updates status/stage/progress/message columns of a job."""
+    allowed = {"status", "stage", "progress", "message", "started_at", "finished_at", "worker", "heartbeat_at"}
+    fields = {k: v for k, v in fields.items() if k in allowed}
+    if not fields:
+        return
+    assignments = ", ".join(f"{k} = ?" for k in fields)
+    with get_connection() as conn:
+        conn.execute(f"UPDATE jobs SET {assignments} WHERE job_id = ?", (*fields.values(), job_id))
+
+
+def _reap_stale_jobs(conn, stale_seconds):
+    """
+    Re-queues running jobs whose worker stopped sending heartbeats (killed,
+    OOM, machine restart), or fails them once they used up JOB_MAX_ATTEMPTS.
+    A re-queued consolidation job resumes from its summary checkpoints.
+    """
+    cutoff = (datetime.now() - timedelta(seconds=stale_seconds)).isoformat()
+    stale = "status = 'running' AND COALESCE(heartbeat_at, started_at) < ?"
+    conn.execute(
+        f"UPDATE jobs SET status = 'failed', finished_at = ?, "
+        f"message = 'Worker ' || COALESCE(worker, '?') || ' stopped responding (attempt ' || attempts || ')' "
+        f"WHERE {stale} AND attempts >= ?",
+        (datetime.now().isoformat(), cutoff, JOB_MAX_ATTEMPTS)
+    )
+    conn.execute(
+        f"UPDATE jobs SET status = 'queued', stage = 'queued', progress = 0.0, "
+        f"message = 'Re-queued: worker ' || COALESCE(worker, '?') || ' stopped responding' "
+        f"WHERE {stale}",
+        (cutoff,)
+    )
+
+
+def reap_stale_jobs(stale_seconds=JOB_STALE_SECONDS):
+    """Re-queues or fails running jobs that lost their worker (see _reap_stale_jobs)."""
+    with get_connection() as conn:
+        _reap_stale_jobs(conn, stale_seconds)
+
+
+def claim_next_job(worker_name, stale_seconds=JOB_STALE_SECONDS):
+    """
+    Atomically moves the oldest queued job to 'running' and returns it.
+    BEGIN IMMEDIATE takes the write lock up front, so two workers can
+    never claim the same job.
+    """
+    with get_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        _reap_stale_jobs(conn, stale_seconds)
+        row = conn.execute(
+            "SELECT job_id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return None
+        now = datetime.now().isoformat()
+        conn.execute(
+            "UPDATE jobs SET status = 'running', stage = 'starting', started_at = ?, heartbeat_at = ?, worker = ?, "
+            "attempts = COALESCE(attempts, 0) + 1 WHERE job_id = ?",
+            (now, now, worker_name, row[0])
+        )
+        job_row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (row[0],)).fetchone()
+    return _row_to_job(job_row)
+
+
+# -------------------------
+# Job execution
+# -------------------------
+def _progress_reporter(job_id, stage, start, end):
+    """Returns a callback(done, total) that maps sub-progress into [start, end]."""
+    def report(done, total):
+        fraction = (done / total) if total else 1.0
+        update_job(job_id, stage=stage, progress=round(start + (end - start) * fraction, 3),
+                   message=f"{stage}: {done}/{total}")
+    return report
+
+
+def run_consolidation_job(job):
+    """Step 3: cluster the uploaded feedback and summarize each cluster."""
+    # Imported here so the app can import this module without loading models.
+    from functools import partial
+    from mapper import get_semantic_clusters, cluster_medoids, DISTANCE_THRESHOLD, DEFAULT_CONTEXT_MODE
+    from search_index import index_step_3_run
+    from cluster_embeddings import save_cluster_embeddings
+    from classifier import (
+        summarize_clusters_with_checkpoints, QuotaExhaustedError, CARRY_FORWARD_THRESHOLD, LABELER_GEMINI, LOCAL_FALLBACK
+    )
+
+    job_id, payload = job["job_id"], job["payload"]
+    feedback_df = pd.DataFrame({"combined_text": payload.get("texts", [])})
+    user_context = payload.get("user_context", "")
+
+    update_job(job_id, stage="clustering", progress=0.05, message="Finding semantic clusters")
+    feedback_groups = get_semantic_clusters(
+        feedback_df, "combined_text", grouping_context=user_context,
+        distance_threshold=payload.get("distance_threshold", DISTANCE_THRESHOLD),
+        context_mode=payload.get("context_mode", DEFAULT_CONTEXT_MODE),
+        low_memory=payload.get("low_memory", False)
+    )
+    if not feedback_groups:
+        raise ValueError("Clustering failed to produce any groups.")
+    save_run_items(job["run_id"], [t for texts in feedback_groups.values() for t in texts])
+    save_cluster_embeddings(
+        job["run_id"], feedback_df, "combined_text", feedback_groups, grouping_context=user_context,
+        context_mode=payload.get("context_mode", DEFAULT_CONTEXT_MODE), low_memory=payload.get("low_memory", False)
+    )
+
+    update_job(job_id, stage="summarizing", progress=0.3, message=f"Summarizing {len(feedback_groups)} clusters")
+    # Summaries are checkpointed under the run_id, so re-queuing the same
+    # payload after a quota failure only summarizes the missing clusters.
+    try:
+        clustered_df = summarize_clusters_with_checkpoints(
+            feedback_groups, labeling_context=user_context, run_id=job["run_id"],
+            carry_forward_threshold=payload.get("carry_forward_threshold", CARRY_FORWARD_THRESHOLD),
+            labeler=payload.get("labeler", LABELER_GEMINI),
+            local_fallback=payload.get("local_fallback", LOCAL_FALLBACK),
+            medoid_fn=partial(
+                cluster_medoids, feedback_df, "combined_text", feedback_groups, grouping_context=user_context,
+                context_mode=payload.get("context_mode", DEFAULT_CONTEXT_MODE), low_memory=payload.get("low_memory", False)
+            ),
+            progress_callback=_progress_reporter(job_id, "summarizing", 0.3, 0.95)
+        )
+    except QuotaExhaustedError as e:
+        save_run_data(e.partial_df, "step_3_history", job["run_id"])
+        raise
+
+    update_job(job_id, stage="saving", progress=0.97, message="Saving results")
+    save_run_data(clustered_df, "step_3_history", job["run_id"])
+    timestamps = payload.get("timestamps")
+    update_trends(
+        job["run_id"], clustered_df,
+        item_timestamps(feedback_df["combined_text"], timestamps) if timestamps else None
+    )
+    index_step_3_run(job["run_id"], clustered_df)
+    return f"{len(clustered_df)} clusters saved"
+
+
+def run_mapping_job(job):
+    """Step 4: map consolidated clusters to the fetched Jira dealblockers."""
+    from mapper import map_feedback_to_dealblockers, MATCH_MODE_CENTROID
+    from search_index import index_step_4_run
+    from cluster_embeddings import centroids_for
+
+    job_id, payload = job["job_id"], job["payload"]
+    feedback_consolidation = pd.DataFrame(payload.get("feedback_records", []))
+    jira_dealblockers = pd.DataFrame(payload.get("jira_records", []))
+
+    centroids = None
+    if payload.get("match_mode") == MATCH_MODE_CENTROID:
+        # Falls back to summary text for clusters without a saved centroid
+        centroids = centroids_for(feedback_consolidation, job["run_id"])
+
+    update_job(job_id, stage="mapping", progress=0.1, message="Mapping clusters to Jira dealblockers")
+    mapped_df = map_feedback_to_dealblockers(
+        feedback_consolidation,
+        jira_dealblockers,
+        similarity_threshold=payload.get("similarity_threshold", 0.7),
+        rerank=payload.get("rerank", False),
+        centroids=centroids,
+        **{key: payload[key] for key in ("rerank_top_k", "rerank_batch_size") if key in payload}
+    )
+
+    update_job(job_id, stage="saving", progress=0.95, message="Saving results")
+    save_run_data(mapped_df, "step_4_history", job["run_id"])
+    index_step_4_run(job["run_id"], mapped_df)
+    return f"{0 if mapped_df is None else len(mapped_df)} mappings saved"
+
+
+JOB_HANDLERS = {
+    JOB_TYPE_CONSOLIDATION: run_consolidation_job,
+    JOB_TYPE_MAPPING: run_mapping_job,
+}
+
+
+def _heartbeat(job_id, stop, interval):
+    while not stop.wait(interval):
+        try:
+            update_job(job_id, heartbeat_at=datetime.now().isoformat())
+        except Exception:
+            traceback.print_exc()
+
+
+def execute_job(job, heartbeat_interval=HEARTBEAT_INTERVAL_SECONDS):
+    """Runs one claimed job and records its final status."""
+    handler = JOB_HANDLERS.get(job["job_type"])
+    # A thread, so long LLM calls between progress updates still count as alive
+    stop_heartbeat = threading.Event()
+    threading.Thread(
+        target=_heartbeat, args=(job["job_id"], stop_heartbeat, heartbeat_interval), name="job-heartbeat", daemon=True
+    ).start()
+    try:
+        if handler is None:
+            raise ValueError(f"Unknown job type '{job['job_type']}'")
+        with run_context(job["run_id"]):
+            message = handler(job)
+        update_job(job["job_id"], status="done", stage="done", progress=1.0,
+                   message=message or "", finished_at=datetime.now().isoformat())
+    except Exception as e:
+        traceback.print_exc()
+        update_job(job["job_id"], status="failed", message=f"{type(e).__name__}: {e}",
+                   finished_at=datetime.now().isoformat())
+    finally:
+        stop_heartbeat.set()
+
+
+def worker_loop(worker_name=None, poll_interval=POLL_INTERVAL_SECONDS, once=False):
+    """Claims and executes jobs until interrupted (or the queue is empty if once=True)."""
+    worker_name = worker_name or f"{socket.gethostname()}:{os.getpid()}"
+    init_db()
+    print(f"[{worker_name}] Worker started, polling every {poll_interval}s")
+    while True:
+        job = claim_next_job(worker_name)
+        if job is None:
+            if once:
+                return
+            time.sleep(poll_interval)
+            continue
+        print(f"[{worker_name}] Running {job['job_type']} job {job['job_id']} for {job['run_id']}")
+        execute_job(job)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run background workers for the feedback pipeline.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL_SECONDS)
+    parser.add_argument("--once", action="store_true", help="Exit when the queue is empty")
+    args = parser.parse_args()
+
+    if args.workers <= 1:
+        worker_loop(poll_interval=args.poll_interval, once=args.once)
+        return
+
+    processes = [
+        multiprocessing.Process(target=worker_loop, kwargs={"poll_interval": args.poll_interval, "once": args.once})
+        for _ in range(args.workers)
+    ]
+    for p in processes:
+        p.start()
+    try:
+        for p in processes:
+            p.join()
+    except KeyboardInterrupt:
+        for p in processes:
+            p.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,463 @@
+# llm_providers.py
+"""
+One interface over the LLMs the app calls: Gemini, Groq and a local
+OpenAI-compatible server (Ollama, llama.cpp, vLLM, ...).
+
+    from llm_providers import complete
+    response = complete(prompt)          # {"text", "provider", "model", ...}
+
+- complete(prompt, response_schema=...) asks for JSON in the providers'
+  structured modes (Gemini: response_schema; Groq and local: JSON object
+  mode); parse_json() parses the answer, repairing the usual defects.
+- Clients are created once per process and reused (get_provider).
+- Each provider has its own concurrency limit (a semaphore), shared by
+  every session and worker thread of the process.
+- On a 429 / quota error or a timeout, complete() falls back to the next
+  provider in LLM_PROVIDER_ORDER (default gemini -> groq -> local).
+  Providers without credentials / a URL are skipped. Other errors are
+  raised straight away: another provider would not fix a bad prompt.
+- LLM_MODE=record appends every response (with its latency) to
+  LLM_RECORDINGS_PATH; LLM_MODE=replay answers from those recordings,
+  sleeping the recorded latency inside the recorded provider's semaphore,
+  so the whole pipeline can be benchmarked offline with realistic timing:
+
+    LLM_MODE=record streamlit run app.py     # one real run
+    LLM_MODE=replay streamlit run app.py     # offline, same latencies
+    python llm_providers.py --concurrency 4  # replay every recording, report throughput
+"""
+import os
+import re
+import json
+import time
+import threading
+import requests
+from dotenv import load_dotenv
+
+from stage_cache import fingerprint
+from telemetry import record_metric
+
+load_dotenv()
+
+# -------------------------
+# Config
+# -------------------------
+LLM_PROVIDER_ORDER = [p.strip() for p in os.getenv("LLM_PROVIDER_ORDER", "gemini,groq,local").split(",") if p.strip()]
+
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "models/gemini-flash-latest")
+GROQ_MODEL = os.getenv("GROQ_MODEL", "llama-3.1-8b-instant")
+LOCAL_LLM_URL = os.getenv("LOCAL_LLM_URL", "")  # e.g. http://127.0.0.1:11434/v1 (Ollama)
+LOCAL_LLM_MODEL = os.getenv("LOCAL_LLM_MODEL", "llama3.1")
+
+# Concurrent in-flight calls per provider, per process
+PROVIDER_CONCURRENCY = {
+    "gemini": int(os.getenv("GEMINI_CONCURRENCY", "4")),
+    "groq": int(os.getenv("GROQ_CONCURRENCY", "4")),
+    "local": int(os.getenv("LOCAL_LLM_CONCURRENCY", "2")),
+}
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+
+# "" (live), "record" or "replay"
+LLM_MODE = os.getenv("LLM_MODE", "")
+LLM_RECORDINGS_PATH = os.getenv("LLM_RECORDINGS_PATH", os.path.abspath("llm_recordings.jsonl"))
+# Multiplies recorded latencies on replay (0 = as fast as possible)
+LLM_REPLAY_LATENCY_SCALE = float(os.getenv("LLM_REPLAY_LATENCY_SCALE", "1.0"))
+
+
+class LLMError(RuntimeError):
+    """A provider call failed for a reason another attempt won't fix."""
+
+
+class RateLimitError(LLMError):
+    """429 / quota exhausted. complete() falls back to the next provider."""
+
+
+class LLMTimeoutError(LLMError):
+    """The provider didn't answer within LLM_TIMEOUT_SECONDS. complete() falls back to the next provider."""
+
+
+def _classify_error(err):
+    """Maps SDK / HTTP errors onto RateLimitError, LLMTimeoutError or LLMError."""
+    if isinstance(err, LLMError):
+        return err
+    name = type(err).__name__
+    message = str(err)
+    if name in ("ResourceExhausted", "RateLimitError", "TooManyRequests") or getattr(err, "status_code", None) == 429:
+        return RateLimitError(message)
+    if name in ("DeadlineExceeded", "APITimeoutError", "Timeout", "ReadTimeout", "ConnectTimeout", "TimeoutError"):
+        return LLMTimeoutError(message or "timed out")
+    if isinstance(err, ValueError):
+        # JSON parse errors ("... column 429") are not quota errors
+        return LLMError(message)
+    lowered = message.lower()
+    if "429" in lowered or "quota" in lowered:
+        return RateLimitError(message)
+    if "timed out" in lowered or "deadline" in lowered:
+        return LLMTimeoutError(message)
+    return LLMError(f"{name}: {message}")
+
+
+# -------------------------
+# Providers
+# -------------------------
+class Provider:
+    """
+    Base class: one long-lived client, a semaphore bounding concurrent
+    calls, and an "llm_call:<name>" metric per call.
+    Subclasses implement available() and _call().
+    """
+    name = None
+    default_model = None
+
+    def __init__(self, concurrency=None):
+        self.concurrency = concurrency or PROVIDER_CONCURRENCY.get(self.name, 1)
+        self.semaphore = threading.BoundedSemaphore(self.concurrency)
+
+    def available(self):
+        return True
+
+    def _call(self, prompt, system, temperature, model, response_schema):
+        """Returns (text, prompt_tokens, output_tokens)."""
+        raise NotImplementedError
+
+    def complete(self, prompt, system=None, temperature=None, model=None, response_schema=None):
+        model = model or self.default_model
+        with self.semaphore:
+            start = time.perf_counter()
+            try:
+                text, prompt_tokens, output_tokens = self._call(prompt, system, temperature, model, response_schema)
+            except Exception as e:
+                error = _classify_error(e)
+                record_metric(
+                    f"llm_call:{self.name}", (time.perf_counter() - start) * 1000, status="error", model=model,
+                    http_429=int(isinstance(error, RateLimitError)), timeout=int(isinstance(error, LLMTimeoutError)),
+                    error=type(e).__name__
+                )
+                raise error from e
+            latency_ms = (time.perf_counter() - start) * 1000
+        record_metric(
+            f"llm_call:{self.name}", latency_ms, model=model,
+            prompt_tokens=prompt_tokens, output_tokens=output_tokens
+        )
+        return {
+            "text": text, "provider": self.name, "model": model, "latency_ms": round(latency_ms, 1),
+            "prompt_tokens": prompt_tokens, "output_tokens": output_tokens,
+        }
+
+
+class GeminiProvider(Provider):
+    name = "gemini"
+    default_model = GEMINI_MODEL
+
+    def __init__(self, concurrency=None, api_key=None):
+        super().__init__(concurrency)
+        self.api_key = api_key or os.getenv("GOOGLE_API_KEY")
+        self._models = {}
+        self._lock = threading.Lock()
+        if self.api_key:
+            import google.generativeai as genai
+            genai.configure(api_key=self.api_key)
+            self._genai = genai
+
+    def available(self):
+        return bool(self.api_key)
+
+    def _model(self, model, system):
+        # GenerativeModel objects are cheap but not free; keep one per (model, system prompt)
+        with self._lock:
+            key = (model, system)
+            if key not in self._models:
+                self._models[key] = self._genai.GenerativeModel(model_name=model, system_instruction=system)
+            return self._models[key]
+
+    def _call(self, prompt, system, temperature, model, response_schema):
+        generation_config = {} if temperature is None else {"temperature": temperature}
+        if response_schema is not None:
+            generation_config.update(response_mime_type="application/json", response_schema=response_schema)
+        resp = self._model(model, system).generate_content(
+            prompt, generation_config=generation_config, request_options={"timeout": LLM_TIMEOUT_SECONDS}
+        )
+        usage = getattr(resp, "usage_metadata", None)
+        text = resp.text if hasattr(resp, "text") else getattr(resp.parts[0], "text", str(resp.parts))
+        return text, getattr(usage, "prompt_token_count", None), getattr(usage, "candidates_token_count", None)
+
+
+class GroqProvider(Provider):
+    name = "groq"
+    default_model = GROQ_MODEL
+
+    def __init__(self, concurrency=None, api_key=None):
+        super().__init__(concurrency)
+        self.api_key = api_key or os.getenv("GROQ_API_KEY")
+        self.client = None
+        if self.api_key:
+            from groq import Groq
+            # No SDK-level retries: a 429 should fall back to the next provider right away
+            self.client = Groq(api_key=self.api_key, timeout=LLM_TIMEOUT_SECONDS, max_retries=0)
+
+    def available(self):
+        return self.client is not None
+
+    def _call(self, prompt, system, temperature, model, response_schema):
+        messages = ([{"role": "system", "content": system}] if system else []) + [{"role": "user", "content": prompt}]
+        kwargs = {} if temperature is None else {"temperature": temperature}
+        if response_schema is not None:
+            # Groq's schema mode is limited to a few models; JSON mode works on all
+            kwargs["response_format"] = {"type": "json_object"}
+        resp = self.client.chat.completions.create(model=model, messages=messages, **kwargs)
+        usage = getattr(resp, "usage", None)
+        return (
+            resp.choices[0].message.content or "",
+            getattr(usage, "prompt_tokens", None), getattr(usage, "completion_tokens", None)
+        )
+
+
+class LocalProvider(Provider):
+    """Any OpenAI-compatible /chat/completions server at LOCAL_LLM_URL."""
+    name = "local"
+    default_model = LOCAL_LLM_MODEL
+
+    def __init__(self, concurrency=None, url=None):
+        super().__init__(concurrency)
+        self.url = (url or LOCAL_LLM_URL).rstrip("/")
+        self._session = requests.Session()
+
+    def available(self):
+        return bool(self.url)
+
+    def _call(self, prompt, system, temperature, model, response_schema):
+        messages = ([{"role": "system", "content": system}] if system else []) + [{"role": "user", "content": prompt}]
+        payload = {"model": model, "messages": messages}
+        if temperature is not None:
+            payload["temperature"] = temperature
+        if response_schema is not None:
+            payload["response_format"] = {"type": "json_object"}
+        try:
+            response = self._session.post(f"{self.url}/chat/completions", json=payload, timeout=LLM_TIMEOUT_SECONDS)
+        except requests.Timeout as e:
+            raise LLMTimeoutError(str(e)) from e
+        if response.status_code == 429:
+            raise RateLimitError(response.text[:200])
+        if response.status_code != 200:
+            raise LLMError(f"Local LLM error {response.status_code}: {response.text[:200]}")
+        body = response.json()
+        usage = body.get("usage") or {}
+        return body["choices"][0]["message"]["content"] or "", usage.get("prompt_tokens"), usage.get("completion_tokens")
+
+
+PROVIDER_CLASSES = {"gemini": GeminiProvider, "groq": GroqProvider, "local": LocalProvider}
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_provider(name):
+    """The process-wide provider (and client) for name, created on first use."""
+    with _providers_lock:
+        if name not in _providers:
+            if name not in PROVIDER_CLASSES:
+                raise ValueError(f"Unknown LLM provider '{name}'. Use one of {list(PROVIDER_CLASSES)}.")
+            _providers[name] = PROVIDER_CLASSES[name]()
+        return _providers[name]
+
+
+def provider_order(first=None):
+    """LLM_PROVIDER_ORDER, optionally with one provider moved to the front."""
+    if first is None:
+        return list(LLM_PROVIDER_ORDER)
+    return [first] + [p for p in LLM_PROVIDER_ORDER if p != first]
+
+
+# -------------------------
+# JSON answers
+# -------------------------
+_CODE_FENCE = re.compile(r"^\s*```[a-zA-Z]*\s*|\s*```\s*$")
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+_SMART_QUOTES = str.maketrans({"\u201c": '"', "\u201d": '"', "\u2018": "'", "\u2019": "'"})
+
+
+def _close_truncated(text):
+    """Closes the strings, objects and arrays left open by an answer cut off mid-way."""
+    stack, in_string, escaped = [], False, False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]" and stack:
+            stack.pop()
+    if in_string:
+        text += '"'
+    text = text.rstrip()
+    if text.endswith(","):
+        text = text[:-1]
+    elif text.endswith(":"):
+        text += " null"
+    return text + "".join(reversed(stack))
+
+
+def parse_json(text):
+    """
+    Parses an LLM's JSON answer. Returns (value, repaired): repaired is True
+    when the raw text wasn't valid JSON but became so after stripping code
+    fences and surrounding prose, straightening smart quotes, dropping
+    trailing commas or closing a truncated answer. Raises ValueError when
+    nothing parses.
+    """
+    if not text or not text.strip():
+        raise ValueError("Empty LLM response.")
+    try:
+        return json.loads(text), False
+    except ValueError:
+        pass
+
+    candidate = _CODE_FENCE.sub("", text.strip()).translate(_SMART_QUOTES)
+    starts = [i for i in (candidate.find("{"), candidate.find("[")) if i != -1]
+    if not starts:
+        raise ValueError(f"No JSON object in LLM response: {text[:200]!r}")
+    candidate = _TRAILING_COMMA.sub(r"\1", candidate[min(starts):])
+
+    decoder = json.JSONDecoder()
+    for attempt in (candidate, _close_truncated(candidate)):
+        try:
+            # raw_decode ignores whatever prose follows the JSON value
+            return decoder.raw_decode(attempt)[0], True
+        except ValueError as e:
+            error = e
+    raise ValueError(f"Unrepairable JSON in LLM response ({error}): {text[:200]!r}")
+
+
+# -------------------------
+# Record / replay
+# -------------------------
+_recordings = None
+_recordings_lock = threading.Lock()
+
+
+def _recording_key(prompt, system, temperature, response_schema):
+    # Provider and model stay out of the key: a replay answers whatever
+    # provider the cascade would have reached
+    return fingerprint((prompt, system or "", temperature, response_schema))
+
+
+def _load_recordings(path=None):
+    global _recordings
+    path = path or LLM_RECORDINGS_PATH
+    with _recordings_lock:
+        if _recordings is None:
+            _recordings = {}
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    for line in f:
+                        if line.strip():
+                            entry = json.loads(line)
+                            _recordings[entry["key"]] = entry
+        return _recordings
+
+
+def _record(key, response):
+    entry = {"key": key, **response}
+    with _recordings_lock:
+        with open(LLM_RECORDINGS_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+        if _recordings is not None:
+            _recordings[key] = entry
+
+
+def _replay(key):
+    entry = _load_recordings().get(key)
+    if entry is None:
+        raise LLMError(f"No recorded LLM response for this prompt in {LLM_RECORDINGS_PATH} (LLM_MODE=replay).")
+    provider = entry["provider"]
+    # The provider's own semaphore: replays keep its concurrency limit (no client is needed)
+    with get_provider(provider).semaphore:
+        start = time.perf_counter()
+        time.sleep(entry["latency_ms"] / 1000 * LLM_REPLAY_LATENCY_SCALE)
+        latency_ms = (time.perf_counter() - start) * 1000
+    record_metric(
+        f"llm_call:{provider}", latency_ms, model=entry.get("model"), replay=1,
+        prompt_tokens=entry.get("prompt_tokens"), output_tokens=entry.get("output_tokens")
+    )
+    return {k: v for k, v in entry.items() if k != "key"}
+
+
+# -------------------------
+# Entry point
+# -------------------------
+def complete(prompt, system=None, temperature=None, providers=None, models=None, response_schema=None):
+    """
+    Sends prompt to the first available provider of providers (default
+    LLM_PROVIDER_ORDER), falling back to the next on RateLimitError or
+    LLMTimeoutError. models optionally overrides the model per provider
+    name; response_schema (a JSON schema dict) requests JSON output in the
+    provider's structured mode. Returns {"text", "provider", "model", "latency_ms",
+    "prompt_tokens", "output_tokens"}; raises the last RateLimitError /
+    LLMTimeoutError when every provider failed that way.
+    """
+    key = _recording_key(prompt, system, temperature, response_schema)
+    if LLM_MODE == "replay":
+        return _replay(key)
+
+    models = models or {}
+    last_error = None
+    for name in providers or LLM_PROVIDER_ORDER:
+        provider = get_provider(name)
+        if not provider.available():
+            continue
+        try:
+            response = provider.complete(
+                prompt, system=system, temperature=temperature, model=models.get(name), response_schema=response_schema
+            )
+        except (RateLimitError, LLMTimeoutError) as e:
+            record_metric("llm_fallback", status="error", provider=name, reason=type(e).__name__)
+            last_error = e
+            continue
+        if LLM_MODE == "record":
+            _record(key, response)
+        return response
+
+    if last_error is not None:
+        raise last_error
+    raise LLMError(
+        f"No LLM provider available (tried {providers or LLM_PROVIDER_ORDER}); "
+        "set GOOGLE_API_KEY, GROQ_API_KEY or LOCAL_LLM_URL."
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+    from concurrent.futures import ThreadPoolExecutor
+    import numpy as np
+
+    parser = argparse.ArgumentParser(description="Replay every recorded LLM response and report throughput.")
+    parser.add_argument("--recordings", default=LLM_RECORDINGS_PATH)
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent callers.")
+    parser.add_argument("--latency-scale", type=float, default=LLM_REPLAY_LATENCY_SCALE)
+    args = parser.parse_args()
+
+    LLM_RECORDINGS_PATH = args.recordings
+    LLM_REPLAY_LATENCY_SCALE = args.latency_scale
+    keys = list(_load_recordings(args.recordings))
+    if not keys:
+        raise SystemExit(f"No recordings in {args.recordings}; run once with LLM_MODE=record.")
+
+    def timed_replay(key):
+        start = time.perf_counter()
+        _replay(key)
+        return (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        latencies = np.array(list(pool.map(timed_replay, keys)))
+    wall = time.perf_counter() - start
+    recorded = sum(_recordings[k]["latency_ms"] for k in keys) / 1000
+    print(f"{len(keys)} calls in {wall:.2f} s with {args.concurrency} callers "
+          f"({len(keys) / wall:.1f} calls/s; {recorded:.2f} s if sequential at recorded latency)")
+    print(f"latency ms p50 {np.percentile(latencies, 50):.0f}  p95 {np.percentile(latencies, 95):.0f}  "
+          f"max {latencies.max():.0f}")
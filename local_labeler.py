@@ -0,0 +1,123 @@
+# local_labeler.py
+"""
+LLM-free extractive labeling of clusters.
+
+Produces the same columns as the Gemini summaries in milliseconds per
+cluster, for a quick grouping overview or when Gemini is out of quota:
+
+- cluster_label:  the top class-based TF-IDF (c-TF-IDF) terms of the cluster,
+                  i.e. terms frequent in this cluster but rare in the others
+- reasoning:      the medoid feedback text (the item closest to the cluster's
+                  mean embedding), passed in from the embeddings clustering
+                  ran on (mapper.cluster_medoids); without them, the item
+                  containing most of the label terms
+- category:       keyword rules over the cluster's terms, else "Other"
+- priority_score: from cluster size (1 item -> 1, 16+ items -> 5)
+- issue_keys:     regex, like the LLM path
+"""
+import re
+import time
+import numpy as np
+from sklearn.feature_extraction.text import CountVectorizer
+
+from issue_keys import extract_cluster_issue_keys, ISSUE_KEY_PATTERN
+from telemetry import record_metric
+
+LABEL_TERMS = 3
+REASONING_MAX_CHARS = 300
+
+# First matching category wins; terms are matched against the cluster's top terms
+CATEGORY_KEYWORDS = [
+    ("Bug", ("bug", "error", "crash", "fail", "failing", "broken", "exception", "issue", "not working")),
+    ("Performance", ("slow", "latency", "performance", "timeout", "memory", "speed")),
+    ("Billing", ("billing", "invoice", "price", "pricing", "payment", "charge", "plan")),
+    ("SDK Coverage", ("sdk", "library", "framework", "language", "plugin", "integration")),
+    ("UX Issue", ("ui", "ux", "confusing", "button", "dashboard", "navigation", "layout")),
+    ("Feature Request", ("support", "add", "allow", "option", "feature", "ability", "request")),
+]
+
+
+def _class_tfidf_terms(cluster_docs, n_terms=LABEL_TERMS):
+    """
+    Top terms per cluster by c-TF-IDF: term frequency within the cluster's
+    joined text, weighted by log(1 + avg words per cluster / term frequency
+    across all clusters).
+    """
+    vectorizer = CountVectorizer(stop_words="english", ngram_range=(1, 2), token_pattern=r"(?u)\b[a-zA-Z][a-zA-Z0-9+#.]+\b")
+    try:
+        counts = vectorizer.fit_transform(cluster_docs)
+    except ValueError:  # only stop words / empty
+        return [[] for _ in cluster_docs]
+    terms = vectorizer.get_feature_names_out()
+
+    tf = counts.multiply(1 / np.maximum(counts.sum(axis=1), 1)).tocsr()
+    avg_words = counts.sum() / max(counts.shape[0], 1)
+    idf = np.log(1 + avg_words / np.maximum(np.asarray(counts.sum(axis=0)).ravel(), 1))
+    scores = tf.multiply(idf).tocsr()
+
+    top_terms = []
+    for row in range(scores.shape[0]):
+        start, end = scores.indptr[row], scores.indptr[row + 1]
+        idx, values = scores.indices[start:end], scores.data[start:end]
+        ranked = [terms[i] for i in idx[np.argsort(-values, kind="stable")]]
+        chosen = []
+        for term in ranked:
+            # Skip unigrams already covered by a chosen bigram (and vice versa)
+            if any(term in c.split() or c in term.split() for c in chosen):
+                continue
+            chosen.append(term)
+            if len(chosen) == n_terms:
+                break
+        top_terms.append(chosen)
+    return top_terms
+
+
+def _category(terms):
+    words = " ".join(terms).lower()
+    for category, keywords in CATEGORY_KEYWORDS:
+        if any(re.search(rf"\b{re.escape(k)}\b", words) for k in keywords):
+            return category
+    return "Other"
+
+
+def _term_medoid(texts, terms):
+    """The member containing most of the cluster's top terms (first one on ties); no embeddings needed."""
+    lowered = [t.lower() for t in texts]
+    scores = [sum(bool(re.search(rf"\b{re.escape(term)}\b", t)) for term in terms) for t in lowered]
+    return texts[int(np.argmax(scores))] if scores else ""
+
+
+def label_clusters_locally(cluster_groups, medoids=None):
+    """
+    Returns {cluster_id: summary dict} for every non-empty cluster, without
+    any LLM call. medoids is {cluster_id: medoid text} (see
+    mapper.cluster_medoids); clusters missing from it use _term_medoid.
+    """
+    groups = {cid: texts for cid, texts in cluster_groups.items() if texts}
+    if not groups:
+        return {}
+    start = time.perf_counter()
+
+    # Issue keys would dominate the keywords; they are reported separately
+    docs = [re.sub(ISSUE_KEY_PATTERN, " ", " ".join(texts)) for texts in groups.values()]
+    top_terms = _class_tfidf_terms(docs)
+    medoids = medoids or {}
+    issue_keys = extract_cluster_issue_keys(groups)
+
+    summaries = {}
+    for (cluster_id, texts), terms in zip(groups.items(), top_terms):
+        medoid = medoids.get(cluster_id)
+        medoid = " ".join(str(medoid if medoid is not None else _term_medoid(texts, terms)).split())
+        if len(medoid) > REASONING_MAX_CHARS:
+            medoid = medoid[:REASONING_MAX_CHARS].rsplit(" ", 1)[0] + "..."
+        label = " / ".join(t.title() for t in terms) if terms else " ".join(medoid.split()[:6])
+        summaries[cluster_id] = {
+            "cluster_label": label,
+            "category": _category(terms),
+            "priority_score": int(min(5, 1 + np.log2(len(texts)))),
+            "reasoning": medoid,
+            "issue_keys": issue_keys.get(cluster_id, []),
+        }
+
+    record_metric("local_labeling", (time.perf_counter() - start) * 1000, items=len(summaries))
+    return summaries
@@ -0,0 +1,297 @@
+# low_memory.py
+"""
+Low-memory mode for large backfills.
+
+The default pipeline keeps every embedding as float32 in RAM and builds an
+average-linkage tree over all pairwise distances, which is fine for a few
+thousand items but not for a 1M-item backfill (1.5 GB of embeddings per
+session, and ~4 TB for the condensed distance matrix). In low-memory mode:
+
+* embeddings are encoded in batches and appended to a float16 file on disk
+  (.embedding_store/<fingerprint>.f16, with a .json sidecar holding the shape);
+* consumers memory-map one block of rows at a time, upcast it to float32,
+  and unmap it again, so resident memory is bounded by the block size;
+* clustering is a greedy centroid ("leader") pass over those blocks: an
+  item joins the nearest running centroid if it is within the distance
+  threshold, otherwise it starts a new cluster. This is O(n * clusters)
+  instead of O(n^2) and is not identical to average linkage; cluster
+  counts are usually a little lower at the same threshold;
+* similarity search keeps a running top-k per query over the blocks
+  instead of materializing the full score matrix.
+
+Enable it with FEEDBACK_LOW_MEMORY=1 or the Step 3 checkbox.
+
+Peak RSS of the synthetic benchmark (`python low_memory.py`; 384-dim
+embeddings, 1,000 synthetic topics, 1 CPU, float16 store, block 4096;
+encode + cluster + one top-k search in low-memory mode, encode only for
+the float32 baseline):
+
+    items      store on disk   low-memory peak RSS   float32 in RAM peak RSS
+    100,000     77 MB            89 MB  (6 s)          340 MB
+    1,000,000  768 MB            99 MB  (58 s)       2,987 MB
+
+The baseline peaks at about twice the matrix size because the batches are
+concatenated (as MODEL.encode does), and that is before the default
+pipeline's linkage step, which needs n^2/2 distances and cannot run at
+these sizes at all. Both columns include the interpreter and numpy
+(~60 MB). The greedy pass recovers the 1,000 synthetic topics exactly.
+"""
+import os
+import sys
+import json
+import time
+import numpy as np
+
+# -------------------------
+# Config
+# -------------------------
+LOW_MEMORY_MODE = os.getenv("FEEDBACK_LOW_MEMORY", "").strip().lower() in ("1", "true", "yes", "on")
+EMBEDDING_STORE_DIR = os.getenv("EMBEDDING_STORE_DIR", os.path.abspath(".embedding_store"))
+ENCODE_BATCH_SIZE = int(os.getenv("LOW_MEMORY_ENCODE_BATCH", "2048"))
+BLOCK_SIZE = int(os.getenv("LOW_MEMORY_BLOCK_SIZE", "4096"))
+# Centroids are compared in chunks so a block never builds more than
+# BLOCK_SIZE x CENTROID_CHUNK scores at once
+CENTROID_CHUNK = 16384
+STORE_DTYPE = np.float16
+
+
+# -------------------------
+# float16 embedding store
+# -------------------------
+def _store_paths(key):
+    return os.path.join(EMBEDDING_STORE_DIR, f"{key}.f16"), os.path.join(EMBEDDING_STORE_DIR, f"{key}.json")
+
+
+def open_store(key):
+    """The finished store for key as {"path", "n_items", "dim"}, or None."""
+    data_path, meta_path = _store_paths(key)
+    if not (os.path.exists(meta_path) and os.path.exists(data_path)):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return {"path": data_path, "n_items": int(meta["n_items"]), "dim": int(meta["dim"])}
+
+
+def encode_to_store(texts, encode_batch, key, batch_size=ENCODE_BATCH_SIZE, progress_callback=None):
+    """
+    Encodes texts batch by batch with encode_batch(list) -> (rows, dim) and
+    appends each batch to disk as float16. Only one batch is ever in memory.
+    The sidecar is written last, so an interrupted encode is never reused.
+    """
+    store = open_store(key)
+    if store is not None and store["n_items"] == len(texts):
+        return store
+
+    os.makedirs(EMBEDDING_STORE_DIR, exist_ok=True)
+    data_path, meta_path = _store_paths(key)
+    tmp_path = f"{data_path}.{os.getpid()}.tmp"
+    dim = 0
+    with open(tmp_path, "wb") as f:
+        for start in range(0, len(texts), batch_size):
+            batch = np.asarray(encode_batch(list(texts[start:start + batch_size])), dtype=np.float32)
+            dim = batch.shape[1]
+            f.write(batch.astype(STORE_DTYPE).tobytes())
+            if progress_callback:
+                progress_callback(min(start + batch_size, len(texts)), len(texts))
+    os.replace(tmp_path, data_path)
+
+    tmp_meta = f"{meta_path}.{os.getpid()}.tmp"
+    with open(tmp_meta, "w") as f:
+        json.dump({"n_items": len(texts), "dim": dim, "dtype": np.dtype(STORE_DTYPE).name}, f)
+    os.replace(tmp_meta, meta_path)
+    return {"path": data_path, "n_items": len(texts), "dim": dim}
+
+
+def read_block(store, start, stop):
+    """
+    Rows [start, stop) as float32. Only that range is memory-mapped, and it
+    is unmapped again before returning, so resident memory stays at one
+    block no matter how large the store is.
+    """
+    stop = min(stop, store["n_items"])
+    if stop <= start:
+        return np.empty((0, store["dim"]), dtype=np.float32)
+    itemsize = np.dtype(STORE_DTYPE).itemsize
+    mapped = np.memmap(
+        store["path"], dtype=STORE_DTYPE, mode="r",
+        offset=start * store["dim"] * itemsize, shape=(stop - start, store["dim"])
+    )
+    block = np.array(mapped, dtype=np.float32)
+    del mapped
+    return block
+
+
+def iter_blocks(store, block_size=BLOCK_SIZE):
+    """Yields (start_row, float32 block) over the whole store."""
+    for start in range(0, store["n_items"], block_size):
+        yield start, read_block(store, start, start + block_size)
+
+
+def array_blocks(matrix, block_size=BLOCK_SIZE):
+    """Same as iter_blocks, for an in-memory array."""
+    for start in range(0, len(matrix), block_size):
+        yield start, np.asarray(matrix[start:start + block_size], dtype=np.float32)
+
+
+# -------------------------
+# Blockwise similarity
+# -------------------------
+def blockwise_top_k(queries, corpus_blocks, k):
+    """
+    Top-k cosine similarities of each normalized query against a normalized
+    corpus given as (start_row, block) pairs. Keeps a running (n_queries, k)
+    best list instead of the full n_queries x n_corpus score matrix.
+
+    Returns (indices, scores), both (n_queries, k'), best first, where k' is
+    min(k, corpus size).
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    best_idx = np.empty((len(queries), 0), dtype=np.int64)
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+
+    for start, block in corpus_blocks:
+        if not len(block):
+            continue
+        scores = queries @ block.T
+        idx = np.broadcast_to(np.arange(start, start + len(block), dtype=np.int64), scores.shape)
+        all_scores = np.concatenate([best_scores, scores], axis=1)
+        all_idx = np.concatenate([best_idx, idx], axis=1)
+        kk = min(k, all_scores.shape[1])
+        top = np.argpartition(-all_scores, kk - 1, axis=1)[:, :kk]
+        best_scores = np.take_along_axis(all_scores, top, axis=1)
+        best_idx = np.take_along_axis(all_idx, top, axis=1)
+
+    order = np.argsort(-best_scores, axis=1, kind="stable")
+    return np.take_along_axis(best_idx, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+
+# -------------------------
+# Greedy centroid clustering
+# -------------------------
+def _nearest_centroid(block, centroids):
+    best_sim = np.full(len(block), -np.inf, dtype=np.float32)
+    best = np.full(len(block), -1, dtype=np.int64)
+    rows = np.arange(len(block))
+    for c0 in range(0, len(centroids), CENTROID_CHUNK):
+        sims = block @ centroids[c0:c0 + CENTROID_CHUNK].T
+        arg = sims.argmax(axis=1)
+        val = sims[rows, arg]
+        better = val > best_sim
+        best_sim[better] = val[better]
+        best[better] = arg[better] + c0
+    return best_sim, best
+
+
+def leader_cluster(blocks, n_items, distance_threshold):
+    """
+    One greedy pass over (start_row, block) pairs of normalized embeddings.
+    Each item joins the nearest running centroid if its cosine distance is
+    at most distance_threshold, otherwise it starts a new cluster; centroids
+    are the normalized mean of their members so far.
+
+    Returns (labels, centroids): int32 labels per item and the float32
+    normalized centroid per cluster.
+    """
+    min_sim = np.float32(1.0 - distance_threshold)
+    labels = np.empty(n_items, dtype=np.int32)
+    sums = centroids = None
+    n_centroids = 0
+
+    for start, block in blocks:
+        if sums is None:
+            sums = np.zeros((1024, block.shape[1]), dtype=np.float32)
+            centroids = np.zeros_like(sums)
+
+        block_sim, block_labels = _nearest_centroid(block, centroids[:n_centroids])
+        assigned = block_sim >= min_sim
+        n_before = n_centroids
+
+        # Items no existing centroid takes: leader pass among themselves,
+        # against only the clusters started in this block
+        for i in np.flatnonzero(~assigned):
+            item = block[i]
+            if n_centroids > n_before:
+                sims = centroids[n_before:n_centroids] @ item
+                j = int(sims.argmax())
+                if sims[j] >= min_sim:
+                    label = n_before + j
+                    sums[label] += item
+                    centroids[label] = sums[label] / max(np.linalg.norm(sums[label]), 1e-12)
+                    block_labels[i] = label
+                    continue
+            if n_centroids == len(sums):
+                sums = np.concatenate([sums, np.zeros_like(sums)])
+                centroids = np.concatenate([centroids, np.zeros_like(centroids)])
+            sums[n_centroids] = item
+            centroids[n_centroids] = item
+            block_labels[i] = n_centroids
+            n_centroids += 1
+
+        # Fold the block's matched items into their centroids in one go
+        if assigned.any():
+            np.add.at(sums, block_labels[assigned], block[assigned])
+            touched = np.unique(block_labels[assigned])
+            norms = np.maximum(np.linalg.norm(sums[touched], axis=1, keepdims=True), 1e-12)
+            centroids[touched] = sums[touched] / norms
+
+        labels[start:start + len(block)] = block_labels
+
+    if centroids is None:
+        return labels, np.empty((0, 0), dtype=np.float32)
+    return labels, centroids[:n_centroids].copy()
+
+
+# -------------------------
+# Synthetic benchmark
+# -------------------------
+def _peak_rss_mb():
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+
+def _synthetic_encoder(topics, noise=0.03, seed=0):
+    """Stands in for MODEL.encode: each 'text' is a topic id; returns noisy normalized vectors."""
+    rng = np.random.default_rng(seed)
+
+    def encode_batch(batch):
+        vectors = topics[np.asarray(batch, dtype=np.int64)] + rng.normal(0, noise, (len(batch), topics.shape[1])).astype(np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return encode_batch
+
+
+def _run_benchmark(n_items, mode, dim=384, n_topics=1000):
+    rng = np.random.default_rng(42)
+    topics = rng.normal(size=(n_topics, dim)).astype(np.float32)
+    topics /= np.linalg.norm(topics, axis=1, keepdims=True)
+    topic_ids = rng.integers(0, n_topics, n_items)
+    encode_batch = _synthetic_encoder(topics)
+
+    start = time.perf_counter()
+    if mode == "dense":
+        # Baseline: everything float32 in RAM, as MODEL.encode returns it
+        embeddings = np.concatenate([
+            encode_batch(topic_ids[s:s + ENCODE_BATCH_SIZE]) for s in range(0, n_items, ENCODE_BATCH_SIZE)
+        ])
+        result = {"clusters": None, "embeddings_mb": round(embeddings.nbytes / 1e6, 1)}
+    else:
+        store = encode_to_store(topic_ids, encode_batch, key=f"benchmark_{n_items}")
+        labels, centroids = leader_cluster(iter_blocks(store), store["n_items"], distance_threshold=0.35)
+        top_idx, _ = blockwise_top_k(centroids[:10], iter_blocks(store), k=5)
+        result = {"clusters": len(centroids), "store_mb": round(os.path.getsize(store["path"]) / 1e6, 1)}
+    result.update({"items": n_items, "mode": mode, "seconds": round(time.perf_counter() - start, 1),
+                   "peak_rss_mb": round(_peak_rss_mb(), 1)})
+    return result
+
+
+if __name__ == "__main__":
+    # Each size/mode runs in a fresh process so ru_maxrss is not shared.
+    # Usage: python low_memory.py [n_items mode]
+    import subprocess
+    if len(sys.argv) == 3:
+        print(json.dumps(_run_benchmark(int(sys.argv[1]), sys.argv[2])))
+        sys.exit(0)
+
+    for n_items in (100_000, 1_000_000):
+        for mode in ("low_memory", "dense"):
+            out = subprocess.run([sys.executable, __file__, str(n_items), mode], capture_output=True, text=True)
+            print(out.stdout.strip() or out.stderr.strip())
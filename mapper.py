@@ -1,25 +1,41 @@
 import re
-import ast
+import time
 import numpy as np
 import pandas as pd
 import os
 from collections import defaultdict
-from sentence_transformers import SentenceTransformer
-from sentence_transformers.util import pytorch_cos_sim
-from sklearn.cluster import AgglomerativeClustering
+from sentence_transformers import SentenceTransformer, CrossEncoder
+from scipy.cluster.hierarchy import linkage, fcluster
+from sklearn.metrics import adjusted_rand_score
 import streamlit as st  # <-- ADD THIS IMPORT
 
+from stage_cache import cached_stage, fingerprint
+from embedding_service import EMBEDDING_SERVICE_URL, RemoteEmbeddingModel
+from low_memory import LOW_MEMORY_MODE, encode_to_store, iter_blocks, array_blocks, blockwise_top_k, leader_cluster
+from issue_keys import parse_issue_keys
+from telemetry import track_stage
+
 # -------------------------
 # Config / tuning params
 # -------------------------
 
+EMBED_MODEL = "local_model"
+EMBED_MODEL_PATH = os.path.abspath(EMBED_MODEL)
+
 # --- THIS IS THE FIX ---
 # We cache the model load, so it only runs ONCE.
 @st.cache_resource
 def load_embedding_model():
-    """Loads the SentenceTransformer model into Streamlit's cache."""
-    EMBED_MODEL = "local_model"
-    EMBED_MODEL_PATH = os.path.abspath(EMBED_MODEL)
+    """
+    Loads the SentenceTransformer model into Streamlit's cache, or returns a
+    client for the shared embedding service if EMBEDDING_SERVICE_URL is set
+    (see embedding_service.py); both have the same .encode().
+    """
+    if EMBEDDING_SERVICE_URL:
+        remote = RemoteEmbeddingModel(EMBEDDING_SERVICE_URL)
+        if remote.health():
+            return remote
+        print(f"Embedding service at {EMBEDDING_SERVICE_URL} is not reachable; loading the model in-process.")
     try:
         model = SentenceTransformer(EMBED_MODEL_PATH)
         return model
@@ -30,9 +46,56 @@ def load_embedding_model():
         return None
 # ---------------------
 
+@st.cache_resource
+def load_rerank_model():
+    """Loads the local cross-encoder used by the optional Step 4 reranking."""
+    try:
+        return CrossEncoder(RERANK_MODEL_PATH)
+    except Exception as e:
+        print(f"Error loading rerank model from {RERANK_MODEL_PATH}: {e}")
+        st.error(f"Error loading rerank model from {RERANK_MODEL_PATH}. Check folder exists.")
+        return None
+
 DISTANCE_THRESHOLD = 0.35
 #SIMILARITY_THRESHOLD = 0.60
 
+# How "Add Context" conditions the clustering embeddings:
+#   prefix     - re-encode every item as "Context: ... Feedback: ..." (original behaviour)
+#   blend      - mix the cached context-free item embeddings with one context embedding
+#   projection - boost each item along the context direction by how much it relates to it
+CONTEXT_MODE_PREFIX = "prefix"
+CONTEXT_MODE_BLEND = "blend"
+CONTEXT_MODE_PROJECTION = "projection"
+CONTEXT_MODES = (CONTEXT_MODE_PREFIX, CONTEXT_MODE_BLEND, CONTEXT_MODE_PROJECTION)
+DEFAULT_CONTEXT_MODE = CONTEXT_MODE_PREFIX
+
+# Weight of the context vector for blend/projection. None for blend means
+# "the context's share of the words", which mimics what mean pooling does
+# with a prefixed text.
+CONTEXT_WEIGHT = None
+CONTEXT_PROJECTION_WEIGHT = 1.0
+
+# Semantic candidates kept per cluster in the Step 4 score table
+CANDIDATES_PER_CLUSTER = 5
+
+# Optional Step 4 reranking: a cross-encoder (e.g. a saved copy of
+# cross-encoder/ms-marco-MiniLM-L-6-v2) scores only the top-k bi-encoder
+# candidates of each cluster. Its scores are sigmoid outputs in [0, 1], so
+# the same threshold slider applies.
+RERANK_MODEL_PATH = os.getenv("RERANK_MODEL_PATH", os.path.abspath("local_reranker"))
+RERANK_TOP_K = 10
+RERANK_BATCH_SIZE = 32
+
+MATCH_TYPE_EXPLICIT = "Explicit Key"
+MATCH_TYPE_SEMANTIC = "Semantic Match"
+
+# What a cluster is compared to Jira with in Step 4:
+#   text     - its reasoning (or label), encoded at mapping time (original behaviour)
+#   centroid - the mean embedding of its members, saved by Step 3 (no encoding)
+MATCH_MODE_TEXT = "text"
+MATCH_MODE_CENTROID = "centroid"
+MATCH_MODES = (MATCH_MODE_TEXT, MATCH_MODE_CENTROID)
+
 # -------------------------
 # Utilities
 # -------------------------
@@ -45,22 +108,105 @@ def clean_text(t):
     t = re.sub(r'\s+', ' ', t).strip()
     return t
 
+def _column_or_none(df, column):
+    """The column as strings, or None if it is missing (validated by the stage itself)."""
+    if df is None or column not in df.columns:
+        return None
+    return df[column].astype(str)
+
+
+def _linkage_cache_key(feedback_df, text_column, grouping_context="",
+                       context_mode=DEFAULT_CONTEXT_MODE, context_weight=CONTEXT_WEIGHT):
+    # Only the text column feeds the embeddings, so other columns of the
+    # uploaded file must not affect the cache key. The threshold is not part
+    # of it either: the full tree can be cut at any threshold.
+    return (_column_or_none(feedback_df, text_column), grouping_context or "", context_mode, context_weight, EMBED_MODEL)
+
+
 # -------------------------
-# Step 3 Main function (called by app.py)
+# Embeddings (cached per text list)
 # -------------------------
-# We cache the clustering result. If the input df is the same,
-# it will return the cached groups instantly.
-@st.cache_data
-def get_semantic_clusters(feedback_df, text_column, grouping_context=""):
-    """
-    Uses sentence embeddings and AgglomerativeClustering to group
-    feedback items by semantic similarity.
-    """
+@cached_stage("embeddings", lambda texts: (list(texts), EMBED_MODEL))
+def encode_texts(texts):
+    """Normalized embeddings for a list of (already cleaned) texts."""
     MODEL = load_embedding_model() 
     if MODEL is None:
         st.error("Model not loaded. Halting clustering.")
         st.stop()
+        # st.stop() is a no-op outside a Streamlit session (e.g. the job worker)
+        raise RuntimeError("Embedding model not loaded.")
+    with track_stage("encode", items=len(texts)):
+        return np.asarray(MODEL.encode(list(texts), normalize_embeddings=True, show_progress_bar=True))
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
 
+def condition_on_context(embeddings, context_embedding, mode=CONTEXT_MODE_BLEND, weight=CONTEXT_WEIGHT, word_counts=None, context_words=0):
+    """
+    Conditions context-free item embeddings on one context embedding, so a
+    context change costs one encode instead of re-encoding the corpus.
+
+    blend:      normalize((1 - w) * e + w * c). With weight=None, w is the
+                context's share of words per item (ctx / (ctx + item)).
+    projection: normalize(e + w * (e . c) * c), which stretches the axis the
+                context points along, so items are separated by how much
+                they relate to the context.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    context_embedding = np.asarray(context_embedding, dtype=np.float32).reshape(1, -1)
+
+    if mode == CONTEXT_MODE_BLEND:
+        if weight is None:
+            item_words = np.maximum(np.asarray(word_counts if word_counts is not None else [1] * len(embeddings)), 1)
+            w = (context_words / (context_words + item_words)).astype(np.float32).reshape(-1, 1)
+        else:
+            w = np.float32(weight)
+        return _normalize_rows((1 - w) * embeddings + w * context_embedding)
+
+    if mode == CONTEXT_MODE_PROJECTION:
+        w = CONTEXT_PROJECTION_WEIGHT if weight is None else weight
+        relevance = embeddings @ context_embedding.T
+        return _normalize_rows(embeddings + np.float32(w) * relevance * context_embedding)
+
+    raise ValueError(f"Unknown context mode '{mode}'. Use one of {CONTEXT_MODES}.")
+
+
+def _leader_cache_key(feedback_df, text_column, grouping_context="", distance_threshold=DISTANCE_THRESHOLD,
+                      context_mode=DEFAULT_CONTEXT_MODE, context_weight=CONTEXT_WEIGHT):
+    # Unlike the linkage tree, a greedy pass can't be re-cut, so the
+    # threshold is part of the key.
+    return _linkage_cache_key(feedback_df, text_column, grouping_context, context_mode, context_weight) + (float(distance_threshold),)
+
+
+def _candidate_cache_key(feedback_df, jira_df, top_k=CANDIDATES_PER_CLUSTER, centroids=None):
+    # The threshold is deliberately not part of the key: it only filters
+    # the cached score table (see filter_candidates).
+    feedback_cols = ["cluster_label", "reasoning", "issue_keys"]
+    feedback_part = None if feedback_df is None else feedback_df.reindex(columns=feedback_cols).astype(str)
+    jira_part = None if jira_df is None else jira_df.reindex(columns=["Issue Key", "Summary"]).astype(str)
+    centroid_part = None if centroids is None else np.asarray(centroids, dtype=np.float32)
+    return (feedback_part, jira_part, int(top_k), EMBED_MODEL, centroid_part)
+
+
+def _rerank_cache_key(feedback_df, jira_df, top_k=RERANK_TOP_K, batch_size=RERANK_BATCH_SIZE, centroids=None):
+    # batch_size only changes speed, not scores
+    return _candidate_cache_key(feedback_df, jira_df, top_k, centroids) + (RERANK_MODEL_PATH,)
+
+
+# -------------------------
+# Step 3: merge tree (cached) + cheap cuts
+# -------------------------
+# The expensive part of clustering (embeddings + the full average-linkage
+# merge tree) only depends on the texts, context and model, so it is
+# computed once and cached on disk. Any distance threshold is then just a
+# cut through that tree, which takes milliseconds.
+def get_clustering_embeddings(feedback_df, text_column, grouping_context="",
+                              context_mode=DEFAULT_CONTEXT_MODE, context_weight=CONTEXT_WEIGHT):
+    """The (normalized) item embeddings clustering runs on, for any context mode."""
     if feedback_df is None or feedback_df.empty:
         raise ValueError("Feedback DataFrame is empty.")
 
@@ -70,33 +216,168 @@ def get_semantic_clusters(feedback_df, text_column, grouping_context=""):
     # Prepare texts
     original_texts = feedback_df[text_column].astype(str).fillna("").tolist()
     
-    # --- 2. ADD THIS LOGIC TO PREPEND CONTEXT ---
-    cleaned_texts = [clean_text(t) for t in original_texts]
-    if grouping_context and grouping_context.strip():
+    with track_stage("clean_text", items=len(original_texts)):
+        cleaned_texts = [clean_text(t) for t in original_texts]
+    if not any(cleaned_texts):
+        raise ValueError("No textual feedback found in the selected column.")
+
+    has_context = bool(grouping_context and grouping_context.strip())
+    if not has_context:
+        return encode_texts(cleaned_texts)
+
+    clean_context = clean_text(grouping_context)
+    if context_mode == CONTEXT_MODE_PREFIX:
+        # --- 2. ADD THIS LOGIC TO PREPEND CONTEXT ---
         # If context is provided, prepend it to every item
         # This will influence the vector math and change the groups
-        clean_context = clean_text(grouping_context)
-        cleaned_texts = [f"Context: {clean_context}. Feedback: {t}" for t in cleaned_texts]
-    # ----------------------------------------------
+        return encode_texts([f"Context: {clean_context}. Feedback: {t}" for t in cleaned_texts])
+
+    # blend / projection: reuse the cached context-free embeddings and
+    # encode only the context itself
+    embeddings = encode_texts(cleaned_texts)
+    context_embedding = encode_texts([clean_context])[0]
+    return condition_on_context(
+        embeddings, context_embedding, mode=context_mode, weight=context_weight,
+        word_counts=[len(t.split()) for t in cleaned_texts], context_words=len(clean_context.split()) + 2
+    )
 
-    if not any(cleaned_texts):
-        raise ValueError("No textual feedback found in the selected column.")
 
+@cached_stage("linkage", _linkage_cache_key)
+def get_linkage_tree(feedback_df, text_column, grouping_context="",
+                     context_mode=DEFAULT_CONTEXT_MODE, context_weight=CONTEXT_WEIGHT):
+    """
+    Embeds the feedback and returns the full SciPy linkage matrix
+    (average linkage, cosine distance), shape (n_items - 1, 4).
+    """
     # Step 1: Get embeddings
-    embeddings = MODEL.encode(cleaned_texts, normalize_embeddings=True, show_progress_bar=True)
+    embeddings = get_clustering_embeddings(
+        feedback_df, text_column, grouping_context=grouping_context,
+        context_mode=context_mode, context_weight=context_weight
+    )
 
-    # Step 2: Perform clustering
-    # ... (rest of the function is unchanged) ...
+    # Step 2: Build the full merge tree (same criterion as the previous
+    # AgglomerativeClustering(metric="cosine", linkage="average"))
     if len(embeddings) == 1:
-        initial_labels = np.array([0])
+        return np.empty((0, 4))
+    with track_stage("clustering", items=len(embeddings)):
+        return linkage(embeddings, method="average", metric="cosine")
+
+
+# -------------------------
+# Step 3, low-memory mode: float16 store on disk + greedy centroid pass
+# -------------------------
+def _encode_texts_to_store(texts):
+    """Encodes texts in batches into a float16 store on disk (see low_memory.py)."""
+    MODEL = load_embedding_model()
+    if MODEL is None:
+        st.error("Model not loaded. Halting clustering.")
+        st.stop()
+        raise RuntimeError("Embedding model not loaded.")
+    with track_stage("encode", items=len(texts), low_memory=1):
+        return encode_to_store(
+            texts,
+            lambda batch: MODEL.encode(batch, normalize_embeddings=True, show_progress_bar=False),
+            key=fingerprint(list(texts), EMBED_MODEL)
+        )
+
+
+@cached_stage("leader_labels", _leader_cache_key)
+def get_leader_labels(feedback_df, text_column, grouping_context="", distance_threshold=DISTANCE_THRESHOLD,
+                      context_mode=DEFAULT_CONTEXT_MODE, context_weight=CONTEXT_WEIGHT):
+    """
+    Low-memory clustering: embeddings go to a float16 file in batches and a
+    greedy centroid pass reads them back block by block. Returns int labels.
+    """
+    if feedback_df is None or feedback_df.empty:
+        raise ValueError("Feedback DataFrame is empty.")
+    if text_column not in feedback_df.columns:
+        raise ValueError(f"Selected column '{text_column}' not found in feedback file.")
+
+    with track_stage("clean_text", items=len(feedback_df)):
+        cleaned_texts = [clean_text(t) for t in feedback_df[text_column].astype(str).fillna("").tolist()]
+    if not any(cleaned_texts):
+        raise ValueError("No textual feedback found in the selected column.")
+
+    n_items, blocks = _clustering_store_blocks(cleaned_texts, grouping_context, context_mode, context_weight)
+    with track_stage("clustering", items=n_items, low_memory=1):
+        labels, _ = leader_cluster(blocks(), n_items, distance_threshold)
+    return labels
+
+
+def _clustering_store_blocks(cleaned_texts, grouping_context="", context_mode=DEFAULT_CONTEXT_MODE,
+                             context_weight=CONTEXT_WEIGHT):
+    """
+    Low-memory counterpart of get_clustering_embeddings: (n_items, blocks),
+    where blocks() yields (start, block) from the float16 store, conditioned
+    on the context block by block, and can be called for several passes.
+    """
+    has_context = bool(grouping_context and grouping_context.strip())
+    clean_context = clean_text(grouping_context) if has_context else ""
+    if has_context and context_mode == CONTEXT_MODE_PREFIX:
+        store = _encode_texts_to_store([f"Context: {clean_context}. Feedback: {t}" for t in cleaned_texts])
     else:
-        clustering = AgglomerativeClustering(
-            n_clusters=None,
-            distance_threshold=DISTANCE_THRESHOLD,
-            metric="cosine",
-            linkage="average"
+        store = _encode_texts_to_store(cleaned_texts)
+
+    def blocks():
+        if not has_context or context_mode == CONTEXT_MODE_PREFIX:
+            yield from iter_blocks(store)
+            return
+        # Condition each block as it is read, so nothing is held for the full corpus
+        context_embedding = encode_texts([clean_context])[0]
+        word_counts = np.fromiter((len(t.split()) for t in cleaned_texts), dtype=np.int64, count=len(cleaned_texts))
+        for start, block in iter_blocks(store):
+            yield start, condition_on_context(
+                block, context_embedding, mode=context_mode, weight=context_weight,
+                word_counts=word_counts[start:start + len(block)], context_words=len(clean_context.split()) + 2
+            )
+
+    return store["n_items"], blocks
+
+
+def cut_linkage_tree(tree, n_items, distance_threshold=DISTANCE_THRESHOLD):
+    """Flat cluster labels (0-based) for all merges at distance <= threshold."""
+    if n_items == 1:
+        return np.array([0])
+    return fcluster(tree, t=distance_threshold, criterion="distance") - 1
+
+
+def cluster_count_curve(tree, n_items, thresholds):
+    """
+    Number of clusters each threshold would produce. Average-linkage merge
+    heights are monotonic, so this is n_items minus the merges at or below
+    each threshold: one searchsorted over the sorted heights.
+    """
+    heights = np.sort(tree[:, 2]) if len(tree) else np.empty(0)
+    thresholds = np.asarray(thresholds, dtype=float)
+    counts = n_items - np.searchsorted(heights, thresholds, side="right")
+    return pd.DataFrame({"threshold": thresholds, "clusters": counts})
+
+
+# -------------------------
+# Step 3 Main function (called by app.py)
+# -------------------------
+def get_semantic_clusters(feedback_df, text_column, grouping_context="", distance_threshold=DISTANCE_THRESHOLD,
+                          context_mode=DEFAULT_CONTEXT_MODE, context_weight=CONTEXT_WEIGHT, low_memory=LOW_MEMORY_MODE):
+    """
+    Uses sentence embeddings and average-linkage hierarchical clustering to
+    group feedback items by semantic similarity. The merge tree comes from
+    the cache, so changing distance_threshold does not re-embed anything.
+
+    With low_memory=True, embeddings are kept as float16 on disk and grouped
+    by a greedy centroid pass instead (see low_memory.py).
+    """
+    if low_memory:
+        initial_labels = get_leader_labels(
+            feedback_df, text_column, grouping_context=grouping_context, distance_threshold=distance_threshold,
+            context_mode=context_mode, context_weight=context_weight
         )
-        initial_labels = clustering.fit_predict(embeddings)
+    else:
+        tree = get_linkage_tree(
+            feedback_df, text_column, grouping_context=grouping_context,
+            context_mode=context_mode, context_weight=context_weight
+        )
+        initial_labels = cut_linkage_tree(tree, len(feedback_df), distance_threshold)
+    original_texts = feedback_df[text_column].astype(str).fillna("").tolist()
 
     # Step 3: Build the groups
     clusters = defaultdict(list)
@@ -114,125 +395,457 @@ def get_semantic_clusters(feedback_df, text_column, grouping_context=""):
     return final_clusters
 
 
+def _clustering_blocks(feedback_df, text_column, grouping_context="", context_mode=DEFAULT_CONTEXT_MODE,
+                       context_weight=CONTEXT_WEIGHT, low_memory=LOW_MEMORY_MODE):
+    """
+    blocks() yielding (start, block) over the embeddings clustering ran on,
+    from the cache or the float16 store, so nothing is encoded again. Can
+    be called for several passes.
+    """
+    if low_memory:
+        cleaned_texts = [clean_text(t) for t in feedback_df[text_column].astype(str).fillna("").tolist()]
+        return _clustering_store_blocks(cleaned_texts, grouping_context, context_mode, context_weight)[1]
+    embeddings = get_clustering_embeddings(
+        feedback_df, text_column, grouping_context=grouping_context,
+        context_mode=context_mode, context_weight=context_weight
+    )
+    return lambda: array_blocks(embeddings)
+
+
+def get_cluster_embeddings(feedback_df, text_column, cluster_groups, grouping_context="",
+                           context_mode=DEFAULT_CONTEXT_MODE, context_weight=CONTEXT_WEIGHT,
+                           low_memory=LOW_MEMORY_MODE, with_members=False):
+    """
+    Per-cluster embeddings of a get_semantic_clusters result, for reuse in
+    Step 4: (cluster_ids, centroids, members). centroids[i] is the normalized
+    mean of cluster_ids[i]'s member embeddings; members is
+    {cluster_id: float16 matrix} with with_members=True, else None.
+
+    Uses the embeddings clustering ran on (same context mode), so the
+    corpus is not encoded a second time.
+    """
+    original_texts = feedback_df[text_column].astype(str).fillna("").tolist()
+    cluster_ids = list(cluster_groups)
+    cluster_of_text = {text: idx for idx, cid in enumerate(cluster_ids) for text in cluster_groups[cid]}
+    row_cluster = np.fromiter((cluster_of_text.get(t, -1) for t in original_texts), dtype=np.int64, count=len(original_texts))
+
+    blocks = _clustering_blocks(feedback_df, text_column, grouping_context, context_mode, context_weight, low_memory)()
+
+    sums, member_parts = None, []
+    with track_stage("cluster_embeddings", items=len(original_texts), clusters=len(cluster_ids)):
+        for start, block in blocks:
+            if sums is None:
+                sums = np.zeros((len(cluster_ids), block.shape[1]), dtype=np.float32)
+            labels = row_cluster[start:start + len(block)]
+            valid = labels >= 0
+            np.add.at(sums, labels[valid], block[valid])
+            if with_members:
+                member_parts.append((labels[valid], block[valid].astype(np.float16)))
+
+    centroids = _normalize_rows(sums) if sums is not None else np.empty((0, 0), dtype=np.float32)
+    members = None
+    if with_members:
+        labels = np.concatenate([part[0] for part in member_parts]) if member_parts else np.empty(0, dtype=np.int64)
+        vectors = np.concatenate([part[1] for part in member_parts]) if member_parts else np.empty((0, 0), dtype=np.float16)
+        members = {cid: vectors[labels == idx] for idx, cid in enumerate(cluster_ids)}
+    return cluster_ids, centroids, members
+
+
+def cluster_medoids(feedback_df, text_column, cluster_groups, grouping_context="", context_mode=DEFAULT_CONTEXT_MODE,
+                    context_weight=CONTEXT_WEIGHT, low_memory=LOW_MEMORY_MODE):
+    """
+    {cluster_id: medoid text} of a get_semantic_clusters result: the member
+    closest to its cluster's mean, on the embeddings clustering ran on (same
+    context mode, read row by row from the cache or the float16 store, so
+    nothing is encoded again). Two passes: cluster sums, then best members.
+    """
+    original_texts = feedback_df[text_column].astype(str).fillna("").tolist()
+    cluster_ids = list(cluster_groups)
+    cluster_of_text = {text: idx for idx, cid in enumerate(cluster_ids) for text in cluster_groups[cid]}
+    row_cluster = np.fromiter((cluster_of_text.get(t, -1) for t in original_texts), dtype=np.int64, count=len(original_texts))
+
+    blocks = _clustering_blocks(feedback_df, text_column, grouping_context, context_mode, context_weight, low_memory)
+
+    with track_stage("cluster_medoids", items=len(original_texts), clusters=len(cluster_ids)):
+        sums = None
+        for start, block in blocks():
+            if sums is None:
+                sums = np.zeros((len(cluster_ids), block.shape[1]), dtype=np.float32)
+            labels = row_cluster[start:start + len(block)]
+            np.add.at(sums, labels[labels >= 0], block[labels >= 0])
+        if sums is None:
+            return {}
+
+        # Argmax of similarity to the mean = argmax of similarity to the sum
+        best_score = np.full(len(cluster_ids), -np.inf, dtype=np.float32)
+        best_row = np.full(len(cluster_ids), -1, dtype=np.int64)
+        for start, block in blocks():
+            labels = row_cluster[start:start + len(block)]
+            valid = labels >= 0
+            labels, rows = labels[valid], np.arange(start, start + len(block))[valid]
+            scores = np.einsum("ij,ij->i", block[valid], sums[labels])
+            # Best row per cluster within the block: last of each label after sorting by (label, score)
+            order = np.lexsort((scores, labels))
+            labels, rows, scores = labels[order], rows[order], scores[order]
+            last = np.append(labels[1:] != labels[:-1], True) if len(labels) else np.empty(0, dtype=bool)
+            labels, rows, scores = labels[last], rows[last], scores[last]
+            better = scores > best_score[labels]
+            best_score[labels[better]] = scores[better]
+            best_row[labels[better]] = rows[better]
+    return {cid: original_texts[best_row[idx]] for idx, cid in enumerate(cluster_ids) if best_row[idx] >= 0}
+
+
+def compare_context_modes(feedback_df, text_column, grouping_context, distance_threshold=DISTANCE_THRESHOLD,
+                          modes=CONTEXT_MODES):
+    """
+    Clusters the same feedback with each context mode and compares the result
+    with the prefix approach: cluster count, adjusted Rand index vs prefix
+    (1.0 = identical grouping) and wall time (cache misses included, so run
+    it on fresh data for a fair timing).
+    """
+    rows = []
+    labels_by_mode = {}
+    for mode in modes:
+        start = time.perf_counter()
+        tree = get_linkage_tree(feedback_df, text_column, grouping_context=grouping_context, context_mode=mode)
+        labels = cut_linkage_tree(tree, len(feedback_df), distance_threshold)
+        labels_by_mode[mode] = labels
+        rows.append({"mode": mode, "clusters": len(set(labels)), "seconds": round(time.perf_counter() - start, 3)})
+
+    reference = labels_by_mode.get(CONTEXT_MODE_PREFIX)
+    for row in rows:
+        row["ari_vs_prefix"] = (
+            round(float(adjusted_rand_score(reference, labels_by_mode[row["mode"]])), 3) if reference is not None else None
+        )
+    return pd.DataFrame(rows)
+
+
 # -----------------------------------------------------------------
 # --- FUNCTION FOR STEP 4 ---
 # -----------------------------------------------------------------
-# We also cache the mapping step.
-@st.cache_data
-def map_feedback_to_dealblockers(feedback_df, jira_df, similarity_threshold=0.7):
+# The expensive part of the mapping (encoding both sides and scoring every
+# pair) doesn't depend on the threshold, so it is computed once per
+# (feedback run, Jira snapshot, model) into a candidate score table and
+# cached. A threshold change is then just a filter over that table.
+@cached_stage("mapping_candidates", _candidate_cache_key)
+def compute_candidate_scores(feedback_df, jira_df, top_k=CANDIDATES_PER_CLUSTER, centroids=None):
     """
-    Maps consolidated feedback clusters to Jira dealblockers using a
-    hybrid approach.
+    Builds the Step 4 candidate score table, one row per (cluster, Jira issue)
+    candidate with positional indices into both frames:
+
+        fb_row, jira_row, match_type, match_score, rank
+
+    Clusters that mention a fetched Jira key get "Explicit Key" rows (score
+    1.0). All other clusters get their top_k "Semantic Match" candidates by
+    cosine similarity between their reasoning (or label) and the Jira Summary.
+
+    centroids, if given, is an array aligned with feedback_df's rows (see
+    cluster_embeddings.centroids_for): rows that have one are matched on it
+    instead, so only their Jira side is encoded. All-NaN rows fall back to text.
     """
     MODEL = load_embedding_model() # Get the cached model
     if MODEL is None:
         st.error("Model not loaded. Halting mapping.")
         st.stop()
-        
+        raise RuntimeError("Embedding model not loaded.")
+
+    columns = ["fb_row", "jira_row", "match_type", "match_score", "rank"]
     if feedback_df.empty or jira_df.empty:
-        return pd.DataFrame()
+        return pd.DataFrame(columns=columns)
 
-    all_mappings = []
-    
-    # --- Setup Jira side ---
-    jira_key_set = set(jira_df['Issue Key'])
-    jira_summaries = jira_df['Summary'].fillna('').astype(str).tolist()
-    jira_embeddings = MODEL.encode(jira_summaries, normalize_embeddings=True, show_progress_bar=True)
-    
-    unmatched_feedback_rows = []
+    feedback_df = feedback_df.reset_index(drop=True)
+    jira_df = jira_df.reset_index(drop=True)
+    rows = []
 
     # --- Pass 1: Explicit Key Matching ---
-    # --- Pass 1: Explicit Key Matching ---
-    # --- Pass 1: Explicit Key Matching ---
-    for _, fb_row in feedback_df.iterrows():
-
-        # --- START FIX ---
-        # Robustly parse the 'issue_keys' column
-        issue_keys_str = str(fb_row.get('issue_keys', '[]'))
-        
-        # Handle cases where the value is None, NaN, or an empty string
-        if issue_keys_str.lower() in ('', 'nan', 'none', 'null'):
-            issue_keys = []
-        else:
-            try:
-                # Try to evaluate the string as a Python literal
-                issue_keys = ast.literal_eval(issue_keys_str)
-                # Ensure the result is actually a list
-                if not isinstance(issue_keys, list):
-                    issue_keys = []
-            except (ValueError, SyntaxError):
-                # Fail safely to an empty list
-                issue_keys = []
-        # --- END FIX ---
-
-        explicitly_matched = False
-        for key in issue_keys:
-            if key in jira_key_set:
-                jira_row = jira_df[jira_df['Issue Key'] == key].iloc[0]
-                
-                all_mappings.append({
-                    "cluster_label": fb_row['cluster_label'],
-                    "feedback_reasoning": fb_row['reasoning'],
-                    "request_count": fb_row['request_count'],
-                    "original_feedback_texts": fb_row['feedback_text'],
-                    "extracted_feedback_keys": fb_row['issue_keys'],
-                    "mapped_issue_key": jira_row['Issue Key'],
-                    "mapped_issue_summary": jira_row['Summary'],
-                    "match_type": "Explicit Key",
-                    "match_score": 1.0
-                })
-                explicitly_matched = True
-
-        if not explicitly_matched:
-            unmatched_feedback_rows.append(fb_row)
-
-    # --- Pass 2: Semantic Similarity Matching ---
-
-    # --- Pass 2: Semantic Similarity Matching ---
-    if unmatched_feedback_rows:
-        unmatched_df = pd.DataFrame(unmatched_feedback_rows)
-        
-        feedback_texts = unmatched_df['reasoning'].fillna(unmatched_df['cluster_label']).astype(str).tolist()
-        
-        if feedback_texts:
-            feedback_embeddings = MODEL.encode(feedback_texts, normalize_embeddings=True, show_progress_bar=True)
-            
-            cos_scores = pytorch_cos_sim(feedback_embeddings, jira_embeddings)
-            
-            # Find the best match for each feedback item
-            for i, fb_row in enumerate(unmatched_df.itertuples()):
-                
-                best_match_idx = cos_scores[i].argmax().item()
-                best_score = cos_scores[i][best_match_idx].item()
-                
-                if best_score >= similarity_threshold:
-                    jira_row = jira_df.iloc[best_match_idx]
-                    
-                    all_mappings.append({
-                        "cluster_label": fb_row.cluster_label,
-                        "feedback_reasoning": fb_row.reasoning,
-                        "request_count": fb_row.request_count,
-                        "original_feedback_texts": fb_row.feedback_text,
-                        "extracted_feedback_keys": fb_row.issue_keys,
-                        "mapped_issue_key": jira_row['Issue Key'],
-                        "mapped_issue_summary": jira_row['Summary'],
-                        "match_type": "Semantic Match",
-                        "match_score": best_score
-                    })
-
-    # --- Finalize ---
-    if not all_mappings:
+    # First row per key, like jira_df[jira_df['Issue Key'] == key].iloc[0]
+    jira_row_by_key = {}
+    for i, key in enumerate(jira_df['Issue Key']):
+        jira_row_by_key.setdefault(key, i)
+
+    unmatched_rows = []
+    for fb_row, value in enumerate(feedback_df.get('issue_keys', pd.Series([[]] * len(feedback_df)))):
+        matched = [jira_row_by_key[key] for key in parse_issue_keys(value) if key in jira_row_by_key]
+        for rank, jira_row in enumerate(matched, start=1):
+            rows.append((fb_row, jira_row, MATCH_TYPE_EXPLICIT, 1.0, rank))
+        if not matched:
+            unmatched_rows.append(fb_row)
+
+    # --- Pass 2: Semantic Similarity Matching (top-k candidates) ---
+    if unmatched_rows:
+        use_centroid = np.zeros(len(unmatched_rows), dtype=bool)
+        if centroids is not None:
+            centroids = np.asarray(centroids, dtype=np.float32)
+            use_centroid = np.isfinite(centroids[unmatched_rows]).all(axis=1)
+        text_rows = [fb_row for fb_row, has_centroid in zip(unmatched_rows, use_centroid) if not has_centroid]
+        feedback_texts = _mapping_texts(feedback_df.iloc[text_rows]).tolist()
+
+        jira_summaries = jira_df['Summary'].fillna('').astype(str).tolist()
+        with track_stage("encode", items=len(jira_summaries) + len(feedback_texts), side="mapping"):
+            jira_embeddings = np.asarray(MODEL.encode(jira_summaries, normalize_embeddings=True, show_progress_bar=True))
+            text_embeddings = (
+                np.asarray(MODEL.encode(feedback_texts, normalize_embeddings=True, show_progress_bar=True))
+                if feedback_texts else np.empty((0, jira_embeddings.shape[1]), dtype=np.float32)
+            )
+        feedback_embeddings = np.empty((len(unmatched_rows), jira_embeddings.shape[1]), dtype=np.float32)
+        feedback_embeddings[~use_centroid] = text_embeddings
+        if use_centroid.any():
+            feedback_embeddings[use_centroid] = centroids[np.asarray(unmatched_rows)[use_centroid]]
+
+        # Embeddings are normalized, so the dot product is the cosine
+        # similarity; Jira is scored in blocks with a running top-k, so the
+        # full clusters x issues matrix is never built
+        with track_stage("mapping", items=len(unmatched_rows), centroid_rows=int(use_centroid.sum())):
+            top_idx, top_scores = blockwise_top_k(feedback_embeddings, array_blocks(jira_embeddings), int(top_k))
+        k = top_idx.shape[1]
+
+        for i, fb_row in enumerate(unmatched_rows):
+            for rank in range(k):
+                rows.append((fb_row, int(top_idx[i, rank]), MATCH_TYPE_SEMANTIC, float(top_scores[i, rank]), rank + 1))
+
+    return pd.DataFrame(rows, columns=columns)
+
+
+def _mapping_texts(feedback_df):
+    """The text each cluster is matched on: its reasoning, or its label."""
+    return feedback_df['reasoning'].fillna(feedback_df['cluster_label']).astype(str)
+
+
+@cached_stage("reranked_candidates", _rerank_cache_key)
+def compute_reranked_candidates(feedback_df, jira_df, top_k=RERANK_TOP_K, batch_size=RERANK_BATCH_SIZE, centroids=None):
+    """
+    Two-stage Step 4 scoring: the bi-encoder candidate table (top_k per
+    cluster) is re-scored with the cross-encoder, and semantic candidates
+    are re-ranked by the new score. Explicit-key rows are kept as they are.
+
+    Adds a retrieval_score column (the bi-encoder cosine); the added latency
+    per reranked cluster is in result.attrs["rerank_ms_per_cluster"].
+    """
+    candidates = compute_candidate_scores(feedback_df, jira_df, top_k=top_k, centroids=centroids)
+    semantic = candidates["match_type"] == MATCH_TYPE_SEMANTIC
+    candidates = candidates.assign(retrieval_score=candidates["match_score"])
+    if not semantic.any():
+        candidates.attrs["rerank_ms_per_cluster"] = 0.0
+        return candidates
+
+    CROSS_ENCODER = load_rerank_model()
+    if CROSS_ENCODER is None:
+        st.error("Rerank model not loaded. Halting mapping.")
+        st.stop()
+        raise RuntimeError("Rerank model not loaded.")
+
+    feedback_texts = _mapping_texts(feedback_df.reset_index(drop=True))
+    jira_summaries = jira_df.reset_index(drop=True)['Summary'].fillna('').astype(str)
+    pairs = candidates.loc[semantic, ["fb_row", "jira_row"]]
+    sentence_pairs = list(zip(feedback_texts.iloc[pairs["fb_row"]].tolist(), jira_summaries.iloc[pairs["jira_row"]].tolist()))
+    n_clusters = pairs["fb_row"].nunique()
+
+    start = time.perf_counter()
+    with track_stage("rerank", items=len(sentence_pairs), clusters=n_clusters, top_k=int(top_k)):
+        scores = CROSS_ENCODER.predict(sentence_pairs, batch_size=int(batch_size), show_progress_bar=False)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    candidates.loc[semantic, "match_score"] = np.asarray(scores, dtype=float)
+    reranked = candidates[semantic].sort_values(["fb_row", "match_score"], ascending=[True, False], kind="stable")
+    reranked["rank"] = reranked.groupby("fb_row").cumcount() + 1
+    result = pd.concat([candidates[~semantic], reranked], ignore_index=True)
+    result.attrs["rerank_ms_per_cluster"] = elapsed_ms / n_clusters
+    return result
+
+
+def filter_candidates(candidates, feedback_df, jira_df, similarity_threshold=0.7):
+    """
+    Turns the candidate score table into the Step 4 mapping: every explicit
+    match, plus each remaining cluster's best semantic candidate if it
+    scores at least similarity_threshold.
+    """
+    if candidates is None or candidates.empty:
         return pd.DataFrame()
-        
-    final_df = pd.DataFrame(all_mappings)
-    
-    # Re-order columns to be more logical
-    final_cols = [
-        "cluster_label", "feedback_reasoning", "request_count",
-        "mapped_issue_key", "mapped_issue_summary", "match_type", "match_score",
-        "original_feedback_texts", "extracted_feedback_keys"
+
+    kept = candidates[
+        (candidates["match_type"] == MATCH_TYPE_EXPLICIT)
+        | ((candidates["rank"] == 1) & (candidates["match_score"] >= similarity_threshold))
     ]
-    final_df = final_df[[c for c in final_cols if c in final_df.columns]]
+    if kept.empty:
+        return pd.DataFrame()
+
+    fb = feedback_df.reset_index(drop=True).iloc[kept["fb_row"].to_numpy()]
+    jira = jira_df.reset_index(drop=True).iloc[kept["jira_row"].to_numpy()]
+    # Step 3 results reference their items by id; older ones carry the texts
+    items_column, source_column = (
+        ("item_ids", "item_ids") if "item_ids" in fb.columns else ("original_feedback_texts", "feedback_text")
+    )
+
+    final_df = pd.DataFrame({
+        "cluster_label": fb['cluster_label'].to_numpy(),
+        "feedback_reasoning": fb['reasoning'].to_numpy(),
+        "request_count": fb['request_count'].to_numpy(),
+        "mapped_issue_key": jira['Issue Key'].to_numpy(),
+        "mapped_issue_summary": jira['Summary'].to_numpy(),
+        "match_type": kept["match_type"].to_numpy(),
+        "match_score": kept["match_score"].to_numpy(),
+        items_column: fb[source_column].to_numpy(),
+        "extracted_feedback_keys": fb['issue_keys'].to_numpy(),
+    })
     
     final_df = final_df.sort_values(by="match_score", ascending=False).reset_index(drop=True)
-    return final_df
\ No newline at end of file
+    return final_df
+
+
+def threshold_match_counts(candidates, thresholds):
+    """How many clusters each threshold would map (explicit + best semantic >= threshold)."""
+    thresholds = np.asarray(thresholds, dtype=float)
+    if candidates is None or candidates.empty:
+        return pd.DataFrame({"threshold": thresholds, "explicit_matches": 0, "semantic_matches": 0, "total_matches": 0})
+
+    explicit = int((candidates["match_type"] == MATCH_TYPE_EXPLICIT).sum())
+    best_scores = np.sort(candidates.loc[
+        (candidates["match_type"] == MATCH_TYPE_SEMANTIC) & (candidates["rank"] == 1), "match_score"
+    ].to_numpy())
+    semantic = len(best_scores) - np.searchsorted(best_scores, thresholds, side="left")
+    return pd.DataFrame({
+        "threshold": thresholds,
+        "explicit_matches": explicit,
+        "semantic_matches": semantic,
+        "total_matches": explicit + semantic,
+    })
+
+
+def map_feedback_to_dealblockers(feedback_df, jira_df, similarity_threshold=0.7,
+                                 rerank=False, rerank_top_k=RERANK_TOP_K, rerank_batch_size=RERANK_BATCH_SIZE,
+                                 centroids=None):
+    """
+    Maps consolidated feedback clusters to Jira dealblockers using a
+    hybrid approach. With rerank=True, the top rerank_top_k bi-encoder
+    candidates per cluster are re-scored by the cross-encoder. Pass the
+    run's Step 3 centroids to match clusters on them (MATCH_MODE_CENTROID).
+    """
+    if rerank:
+        candidates = compute_reranked_candidates(
+            feedback_df, jira_df, top_k=rerank_top_k, batch_size=rerank_batch_size, centroids=centroids
+        )
+    else:
+        candidates = compute_candidate_scores(feedback_df, jira_df, centroids=centroids)
+    return filter_candidates(candidates, feedback_df, jira_df, similarity_threshold)
+
+
+# -------------------------
+# Reranking evaluation
+# -------------------------
+def build_labelled_sample(jira_df, history_path="step_4_mapping_history.csv"):
+    """
+    A labelled sample from saved Step 4 history: each semantic mapping is
+    taken as (cluster reasoning -> correct Jira key). Rows whose key is not
+    in the current Jira snapshot are dropped. If the file has an
+    is_correct column (reviewed by hand), rows marked false are dropped too.
+
+    The history was produced by the bi-encoder itself, so unreviewed
+    samples favour it; treat the precision change as a lower bound.
+    """
+    history = pd.read_csv(history_path)
+    history = history[history["match_type"] == MATCH_TYPE_SEMANTIC]
+    if "is_correct" in history.columns:
+        history = history[history["is_correct"].astype(str).str.lower().isin(("true", "1", "yes"))]
+    history = history[history["mapped_issue_key"].isin(set(jira_df["Issue Key"]))]
+    history = history.drop_duplicates(subset=["feedback_reasoning", "mapped_issue_key"])
+    return pd.DataFrame({
+        "cluster_label": history["cluster_label"].to_numpy(),
+        "reasoning": history["feedback_reasoning"].to_numpy(),
+        "request_count": history["request_count"].to_numpy(),
+        "feedback_text": history.get("original_feedback_texts", pd.Series("", index=history.index)).to_numpy(),
+        "issue_keys": [[] for _ in range(len(history))],  # score semantically, not by explicit key
+        "gold_issue_key": history["mapped_issue_key"].to_numpy(),
+    })
+
+
+def evaluate_rerank(labelled_df, jira_df, top_k=RERANK_TOP_K, batch_size=RERANK_BATCH_SIZE):
+    """
+    Precision@1 of bi-encoder-only vs retrieve-then-rerank on a labelled
+    sample, with recall@k of the retrieval stage (the ceiling for the
+    reranker) and milliseconds per cluster of each stage (uncached).
+    """
+    if labelled_df.empty:
+        return pd.DataFrame()
+    gold = labelled_df["gold_issue_key"].to_numpy()
+    jira_keys = jira_df.reset_index(drop=True)["Issue Key"].to_numpy()
+
+    def top1_precision(candidates):
+        top1 = candidates[candidates["rank"] == 1].drop_duplicates("fb_row").set_index("fb_row")["jira_row"].to_dict()
+        return float(np.mean([i in top1 and jira_keys[top1[i]] == gold[i] for i in range(len(gold))]))
+
+    start = time.perf_counter()
+    retrieved = compute_candidate_scores.uncached(labelled_df, jira_df, top_k=top_k)
+    retrieval_ms = (time.perf_counter() - start) * 1000 / len(labelled_df)
+    recall = float(np.mean([
+        gold[fb_row] in set(jira_keys[group["jira_row"]])
+        for fb_row, group in retrieved.groupby("fb_row")
+    ]))
+
+    reranked = compute_reranked_candidates.uncached(labelled_df, jira_df, top_k=top_k, batch_size=batch_size)
+    return pd.DataFrame([
+        {"mode": "bi-encoder", "samples": len(labelled_df), "precision_at_1": round(top1_precision(retrieved), 3),
+         f"recall_at_{top_k}": round(recall, 3), "ms_per_cluster": round(retrieval_ms, 1)},
+        {"mode": f"rerank top-{top_k}", "samples": len(labelled_df), "precision_at_1": round(top1_precision(reranked), 3),
+         f"recall_at_{top_k}": round(recall, 3),
+         "ms_per_cluster": round(retrieval_ms + reranked.attrs.get("rerank_ms_per_cluster", 0.0), 1)},
+    ])
+
+
+# -------------------------
+# Text vs centroid matching evaluation
+# -------------------------
+def match_mode_gold_keys(feedback_df, jira_df, history_path="step_4_mapping_history.csv"):
+    """
+    The expected Jira key per cluster row (None where unknown): the first
+    fetched key the cluster mentions explicitly, else the saved semantic
+    mapping of the same reasoning in the Step 4 history (see
+    build_labelled_sample for the bias that carries).
+    """
+    jira_keys = set(jira_df["Issue Key"])
+    issue_keys = feedback_df.get("issue_keys", pd.Series([[]] * len(feedback_df), index=feedback_df.index))
+    gold = [next((key for key in parse_issue_keys(value) if key in jira_keys), None) for value in issue_keys]
+    try:
+        labelled = build_labelled_sample(jira_df, history_path)
+        by_reasoning = dict(zip(labelled["reasoning"], labelled["gold_issue_key"]))
+        gold = [key if key is not None else by_reasoning.get(reasoning) for key, reasoning in zip(gold, feedback_df["reasoning"])]
+    except FileNotFoundError:
+        pass
+    return pd.Series(gold, index=feedback_df.index, dtype=object)
+
+
+def evaluate_match_modes(feedback_df, jira_df, centroids, gold_keys=None, top_k=CANDIDATES_PER_CLUSTER):
+    """
+    Text vs centroid matching on the same clusters. Every cluster is scored
+    semantically (explicit keys are hidden, so they can serve as labels):
+    precision@1 against gold_keys where known, how often the top-1 issue
+    agrees with text mode, mean top-1 score, and uncached ms per cluster
+    (both include encoding the Jira side).
+    """
+    if feedback_df.empty:
+        return pd.DataFrame()
+    sample = feedback_df.reset_index(drop=True).assign(issue_keys=[[] for _ in range(len(feedback_df))])
+    jira_keys = jira_df.reset_index(drop=True)["Issue Key"].to_numpy()
+    gold = None if gold_keys is None else pd.Series(list(gold_keys), dtype=object)
+
+    rows, top1_by_mode = [], {}
+    for mode, mode_centroids in ((MATCH_MODE_TEXT, None), (MATCH_MODE_CENTROID, centroids)):
+        start = time.perf_counter()
+        candidates = compute_candidate_scores.uncached(sample, jira_df, top_k=top_k, centroids=mode_centroids)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        top1 = candidates[candidates["rank"] == 1].drop_duplicates("fb_row").set_index("fb_row")
+        top1_by_mode[mode] = top1["jira_row"]
+
+        row = {"mode": mode, "clusters": len(sample), "mean_top1_score": round(float(top1["match_score"].mean()), 3),
+               "ms_per_cluster": round(elapsed_ms / len(sample), 2)}
+        if gold is not None and gold.notna().any():
+            labelled = gold[gold.notna()]
+            row["labelled"] = len(labelled)
+            row["precision_at_1"] = round(float(np.mean([
+                fb_row in top1.index and jira_keys[top1.at[fb_row, "jira_row"]] == key for fb_row, key in labelled.items()
+            ])), 3)
+        rows.append(row)
+
+    text_top1 = top1_by_mode[MATCH_MODE_TEXT]
+    for row in rows:
+        row["top1_agreement_with_text"] = round(float((top1_by_mode[row["mode"]].reindex(text_top1.index) == text_top1).mean()), 3)
+    return pd.DataFrame(rows)
@@ -0,0 +1,92 @@
+# profiling.py
+"""
+Opt-in profiling of pipeline runs.
+
+Enabled with FEEDBACK_PROFILE=1 (or the hidden sidebar toggle shown when
+the app is opened with ?debug=1). Each profiled stage runs under cProfile
+and tracemalloc; the profile is saved as profiles/<run_id>/<stage>_<time>.pstats
+and attached to the run in the run_artifacts table, together with the wall
+time and the tracemalloc peak.
+
+.pstats files open directly in snakeviz / tuna, or convert to a flamegraph
+with flameprof or gprof2dot.
+"""
+import os
+import time
+import pstats
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+import pandas as pd
+
+from history_db import save_run_artifact, load_run_artifacts
+from telemetry import record_metric
+
+PROFILE_ENV_VAR = "FEEDBACK_PROFILE"
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.abspath("profiles"))
+TOP_N_FUNCTIONS = 25
+
+
+def profiling_enabled(ui_toggle=False):
+    """True if the UI toggle is on or FEEDBACK_PROFILE is set to a truthy value."""
+    return bool(ui_toggle) or os.getenv(PROFILE_ENV_VAR, "").strip().lower() in ("1", "true", "yes", "on")
+
+
+@contextmanager
+def profile_stage(run_id, stage, enabled=True):
+    """
+    Profiles the block (CPU via cProfile, Python allocations via tracemalloc)
+    and attaches the result to run_id. A no-op when enabled is False.
+    """
+    if not enabled:
+        yield None
+        return
+
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        wall_seconds = time.perf_counter() - start
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        if started_tracing:
+            tracemalloc.stop()
+
+        try:
+            run_dir = os.path.join(PROFILE_DIR, run_id)
+            os.makedirs(run_dir, exist_ok=True)
+            path = os.path.join(run_dir, f"{stage}_{datetime.now().strftime('%H%M%S_%f')}.pstats")
+            profiler.dump_stats(path)
+            meta = {"wall_s": round(wall_seconds, 3), "tracemalloc_peak_mb": round(peak_bytes / 1e6, 2)}
+            save_run_artifact(run_id, "profile", stage, path, meta)
+            record_metric(f"profile:{stage}", wall_seconds * 1000, run_id=run_id, **meta)
+        except Exception as e:
+            print(f"Could not save profile for {run_id}/{stage}: {e}")
+
+
+def top_functions(path, n=TOP_N_FUNCTIONS, sort_by="cumulative"):
+    """The n hottest functions of a saved profile as a DataFrame."""
+    stats = pstats.Stats(path)
+    rows = []
+    for (filename, line, func), (cc, ncalls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({
+            "function": f"{func} ({os.path.basename(filename)}:{line})",
+            "calls": ncalls,
+            "self_s": round(tottime, 4),
+            "cumulative_s": round(cumtime, 4),
+        })
+    sort_col = "cumulative_s" if sort_by == "cumulative" else "self_s"
+    return pd.DataFrame(rows).sort_values(sort_col, ascending=False).head(n).reset_index(drop=True)
+
+
+def list_profiles(run_id):
+    """The profiles attached to a run (newest first)."""
+    return load_run_artifacts(run_id, kind="profile")
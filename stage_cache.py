@@ -0,0 +1,239 @@
+# stage_cache.py
+"""
+Disk-backed cache for the expensive pipeline stages.
+
+`st.cache_data` hashes every argument in full (whole DataFrames, including
+columns a stage never reads) and only lives as long as the server process.
+Here each stage declares a small key function that picks out just the
+inputs it actually uses; those are reduced to a cheap fingerprint and the
+result is pickled under .stage_cache/<stage>/<fingerprint>.pkl. The
+directory is size-bounded: least-recently-used entries are evicted first.
+
+Hit/miss counts and the time spent fingerprinting are kept per stage and
+shown in the app sidebar (see cache_stats()).
+"""
+import os
+import json
+import time
+import pickle
+import hashlib
+import threading
+from functools import wraps
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+
+from telemetry import record_metric
+
+# -------------------------
+# Config
+# -------------------------
+CACHE_DIR = os.getenv("STAGE_CACHE_DIR", os.path.abspath(".stage_cache"))
+CACHE_MAX_BYTES = int(float(os.getenv("STAGE_CACHE_MAX_MB", "512")) * 1024 * 1024)
+# Other processes share the directory, so the running size is re-synced by a full scan this often
+EVICT_SCAN_EVERY = int(os.getenv("STAGE_CACHE_EVICT_SCAN_EVERY", "50"))
+# Eviction frees down to this share of the budget, so the next writes do not walk the directory again
+EVICT_LOW_WATER = 0.8
+
+_stats = defaultdict(lambda: {"hits": 0, "misses": 0, "hash_seconds": 0.0, "compute_seconds": 0.0})
+_lock = threading.Lock()
+_cache_bytes = None  # running size of CACHE_DIR as written by this process; None until scanned
+_writes_since_scan = 0
+
+
+# -------------------------
+# Fingerprinting
+# -------------------------
+def _update_digest(digest, part):
+    if isinstance(part, (pd.Series, pd.DataFrame)):
+        # Vectorized 64-bit hash per row; far cheaper than pickling the frame.
+        digest.update(pd.util.hash_pandas_object(part, index=False).values.tobytes())
+    elif isinstance(part, np.ndarray):
+        digest.update(str(part.dtype).encode("utf-8"))
+        digest.update(np.ascontiguousarray(part).tobytes())
+    elif isinstance(part, (list, tuple)) and all(isinstance(p, str) for p in part):
+        digest.update(pd.util.hash_array(np.asarray(part, dtype=object)).tobytes())
+    elif isinstance(part, bytes):
+        digest.update(part)
+    else:
+        digest.update(json.dumps(part, sort_keys=True, default=str).encode("utf-8"))
+
+
+def fingerprint(*parts):
+    """Returns a short hex digest over the given stage inputs."""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        _update_digest(digest, part)
+        digest.update(b"\x1e")
+    return digest.hexdigest()
+
+
+# -------------------------
+# Storage
+# -------------------------
+def _entry_path(stage, key):
+    return os.path.join(CACHE_DIR, stage, f"{key}.pkl")
+
+
+def _evict(max_bytes=CACHE_MAX_BYTES):
+    """Deletes least-recently-used entries until the cache fits in max_bytes; returns the size left."""
+    entries = []
+    for root, _, files in os.walk(CACHE_DIR):
+        for name in files:
+            if name.endswith(".tmp"):
+                continue  # being written by another process
+            path = os.path.join(root, name)
+            try:
+                st_info = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st_info.st_mtime, st_info.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except FileNotFoundError:
+            pass
+    return total
+
+
+def _account_write(delta):
+    """
+    Adds a write to the running cache size. The directory is only walked
+    (and evicted) once that size is over budget, or every EVICT_SCAN_EVERY
+    writes to pick up what other processes wrote.
+    """
+    global _cache_bytes, _writes_since_scan
+    with _lock:
+        _writes_since_scan += 1
+        if _cache_bytes is not None:
+            _cache_bytes += delta
+            if _cache_bytes <= CACHE_MAX_BYTES and _writes_since_scan < EVICT_SCAN_EVERY:
+                return
+        _writes_since_scan = 0
+    total = _evict(int(CACHE_MAX_BYTES * EVICT_LOW_WATER))
+    with _lock:
+        _cache_bytes = total
+
+
+def _load(path):
+    with open(path, "rb") as f:
+        value = pickle.load(f)
+    os.utime(path)  # mark as recently used for LRU eviction
+    return value
+
+
+def _store(path, value):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    replaced_size = _file_size(path)
+    os.replace(tmp_path, path)  # atomic, so concurrent readers never see half a file
+    _account_write(_file_size(path) - replaced_size)
+
+
+# -------------------------
+# Public API
+# -------------------------
+def cached_stage(stage, key_fn, cacheable=None):
+    """
+    Decorator that caches a stage function on disk.
+
+    key_fn receives the same arguments as the stage and returns a tuple of
+    the inputs that determine its result. cacheable(result) can veto storing
+    a result (e.g. a summary table that still contains failed rows).
+    Exceptions are never cached.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            key = fingerprint(stage, *key_fn(*args, **kwargs))
+            hash_seconds = time.perf_counter() - start
+            path = _entry_path(stage, key)
+
+            if os.path.exists(path):
+                try:
+                    value = _load(path)
+                    with _lock:
+                        _stats[stage]["hits"] += 1
+                        _stats[stage]["hash_seconds"] += hash_seconds
+                    record_metric(f"cache:{stage}", hash_seconds * 1000, cache_hit=1)
+                    return value
+                except Exception as e:
+                    print(f"Stage cache entry unreadable, recomputing ({stage}/{key}): {e}")
+
+            start = time.perf_counter()
+            value = fn(*args, **kwargs)
+            compute_seconds = time.perf_counter() - start
+            with _lock:
+                _stats[stage]["misses"] += 1
+                _stats[stage]["hash_seconds"] += hash_seconds
+                _stats[stage]["compute_seconds"] += compute_seconds
+            record_metric(f"cache:{stage}", hash_seconds * 1000, cache_hit=0)
+
+            if cacheable is None or cacheable(value):
+                try:
+                    _store(path, value)
+                except Exception as e:
+                    print(f"Could not write stage cache entry ({stage}/{key}): {e}")
+            return value
+
+        wrapper.uncached = fn
+        wrapper.stage = stage
+        return wrapper
+    return decorator
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:  # evicted meanwhile
+        return 0
+
+
+def cache_stats():
+    """Per-stage hits, misses, hit rate, fingerprinting time and disk usage."""
+    rows = []
+    with _lock:
+        stats = {stage: dict(values) for stage, values in _stats.items()}
+
+    stages = set(stats)
+    if os.path.isdir(CACHE_DIR):
+        stages.update(d for d in os.listdir(CACHE_DIR) if os.path.isdir(os.path.join(CACHE_DIR, d)))
+
+    for stage in sorted(stages):
+        values = stats.get(stage, {"hits": 0, "misses": 0, "hash_seconds": 0.0, "compute_seconds": 0.0})
+        calls = values["hits"] + values["misses"]
+        stage_dir = os.path.join(CACHE_DIR, stage)
+        files = os.listdir(stage_dir) if os.path.isdir(stage_dir) else []
+        rows.append({
+            "stage": stage,
+            "hits": values["hits"],
+            "misses": values["misses"],
+            "hit_rate": round(values["hits"] / calls, 3) if calls else None,
+            "avg_hash_ms": round(1000 * values["hash_seconds"] / calls, 2) if calls else None,
+            "compute_s": round(values["compute_seconds"], 2),
+            "entries": len(files),
+            "disk_mb": round(sum(_file_size(os.path.join(stage_dir, f)) for f in files) / 1e6, 2),
+        })
+    return pd.DataFrame(rows)
+
+
+def clear_cache(stage=None):
+    """Removes all cached entries (or only those of one stage)."""
+    global _cache_bytes
+    target = os.path.join(CACHE_DIR, stage) if stage else CACHE_DIR
+    for root, _, files in os.walk(target):
+        for name in files:
+            try:
+                os.remove(os.path.join(root, name))
+            except FileNotFoundError:
+                pass
+    with _lock:
+        _cache_bytes = None  # rescanned on the next write
@@ -0,0 +1,146 @@
+# telemetry.py
+"""
+Per-stage performance metrics, recorded per run_id.
+
+Wrap a pipeline run in `run_context(run_id)` and time its stages with
+`track_stage("encode", items=n)`. Metrics are buffered in memory while the
+run executes and written to the stage_metrics table of history.db in one
+batch when the context exits, so instrumenting hundreds of Gemini calls
+doesn't mean hundreds of database writes.
+
+Outside a run_context, metrics are dropped unless an explicit run_id is
+passed to record_metric, which then writes right away.
+"""
+import json
+import time
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+from history_db import save_stage_metrics, load_stage_metrics
+
+_current_run = contextvars.ContextVar("telemetry_run", default=None)
+
+# Numeric attributes summed per stage in the Performance panel
+SUMMED_ATTRS = ("items", "prompt_tokens", "output_tokens", "retries", "http_429", "cache_hit", "repaired", "parse_failed")
+
+
+def current_run_id():
+    run = _current_run.get()
+    return run["run_id"] if run else None
+
+
+@contextmanager
+def run_context(run_id):
+    """Collects every metric recorded inside the block under run_id."""
+    run = {"run_id": run_id, "rows": []}
+    token = _current_run.set(run)
+    try:
+        yield run
+    finally:
+        _current_run.reset(token)
+        try:
+            save_stage_metrics(run["rows"])
+        except Exception as e:
+            print(f"Could not save stage metrics for {run_id}: {e}")
+
+
+def record_metric(stage, duration_ms=None, status="ok", run_id=None, **attrs):
+    """Records one metric row for the current run (or the given run_id)."""
+    run = _current_run.get()
+    target_run_id = run["run_id"] if run else run_id
+    if target_run_id is None:
+        return
+    row = (
+        target_run_id, stage, datetime.now().isoformat(),
+        None if duration_ms is None else float(duration_ms), status,
+        json.dumps(attrs, default=str)
+    )
+    if run:
+        run["rows"].append(row)
+    else:
+        save_stage_metrics([row])
+
+
+@contextmanager
+def track_stage(stage, **attrs):
+    """
+    Times the block and records it as one metric row. The yielded dict can
+    be filled with more attributes (token counts, retries, ...) inside.
+    """
+    extra = dict(attrs)
+    status = "ok"
+    start = time.perf_counter()
+    try:
+        yield extra
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        record_metric(stage, (time.perf_counter() - start) * 1000, status=status, **extra)
+
+
+# -------------------------
+# Reporting
+# -------------------------
+def _expand_attrs(metrics_df):
+    attrs = pd.json_normalize(metrics_df["attrs_json"].fillna("{}").map(json.loads).tolist())
+    attrs.index = metrics_df.index
+    return pd.concat([metrics_df.drop(columns=["attrs_json"]), attrs], axis=1)
+
+
+def summarize_run_metrics(run_id):
+    """Per-stage calls, total/mean/p95 latency, errors and summed counters for one run."""
+    metrics_df = load_stage_metrics([run_id])
+    if metrics_df.empty:
+        return pd.DataFrame()
+    metrics_df = _expand_attrs(metrics_df)
+
+    grouped = metrics_df.groupby("stage", sort=False)
+    summary = pd.DataFrame({
+        "calls": grouped.size(),
+        "total_ms": grouped["duration_ms"].sum().round(1),
+        "mean_ms": grouped["duration_ms"].mean().round(1),
+        "p95_ms": grouped["duration_ms"].agg(lambda d: np.nanpercentile(d, 95) if d.notna().any() else np.nan).round(1),
+        "errors": grouped["status"].agg(lambda s: int((s != "ok").sum())),
+    })
+    for attr in SUMMED_ATTRS:
+        if attr in metrics_df.columns:
+            summary[attr] = grouped[attr].sum(min_count=1)
+    return summary.reset_index().sort_values("total_ms", ascending=False)
+
+
+def llm_parse_rates(run_id, stage="summary_parse"):
+    """
+    How often the LLM's JSON answers of one run parsed cleanly, needed a
+    local repair, or failed (and were retried). Empty dict without answers.
+    """
+    metrics_df = load_stage_metrics([run_id])
+    if metrics_df.empty:
+        return {}
+    metrics_df = _expand_attrs(metrics_df)
+    parses = metrics_df[metrics_df["stage"] == stage]
+    if parses.empty:
+        return {}
+    responses = len(parses)
+    repaired = int(parses.get("repaired", pd.Series(dtype=float)).fillna(0).sum())
+    failed = int(parses.get("parse_failed", pd.Series(dtype=float)).fillna(0).sum())
+    return {
+        "responses": responses,
+        "repaired": repaired,
+        "parse_failed": failed,
+        "repair_rate": round(repaired / responses, 3),
+        "parse_failure_rate": round(failed / responses, 3),
+    }
+
+
+def compare_runs(run_ids):
+    """Total milliseconds per stage (rows) for each run (columns), to spot regressions."""
+    metrics_df = load_stage_metrics(run_ids)
+    if metrics_df.empty:
+        return pd.DataFrame()
+    return metrics_df.pivot_table(
+        index="stage", columns="run_id", values="duration_ms", aggfunc="sum"
+    ).round(1)
@@ -0,0 +1,142 @@
+# trends.py
+"""
+Week-over-week (or day-over-day) growth of clusters across runs.
+
+Every Step 3 save adds the run's clusters to materialized rollups in
+history.db (trend_clusters, trend_items, trend_rollups), so a trend chart
+is a primary-key lookup instead of re-aggregating every saved run:
+
+- items are dated by the feedback's own timestamp (a column picked in the
+  UI, e.g. Slack `ts`, Jira `Created`), else by the day the run was saved;
+- an item is identified by its text and timestamp, so feedback uploaded
+  again in a later run is not counted twice; without a timestamp, by its
+  text, the save day and its repeat count within the run, so a complaint
+  that comes back in a later week is counted again;
+- clusters get a stable trend identity across runs: the identity that
+  already owns most of their items (see TREND_MATCH_THRESHOLD), else the
+  one with the same label (carried-forward and local labels repeat
+  exactly), else a new one.
+"""
+import os
+import re
+import hashlib
+from collections import Counter
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+from history_db import save_trend_items, load_trend_rollups, expand_items
+from telemetry import track_stage
+
+# -------------------------
+# Config
+# -------------------------
+# Share of a cluster's items that must already belong to one trend
+# identity for the cluster to continue it
+TREND_MATCH_THRESHOLD = float(os.getenv("TREND_MATCH_THRESHOLD", "0.5"))
+TREND_GRANULARITIES = ("day", "week")
+
+
+def parse_timestamps(values):
+    """
+    Parses a timestamp column into UTC datetimes (NaT where unparseable).
+    Numbers and numeric strings are epoch seconds (Slack's "1712345678.000200");
+    anything else goes through pandas' date parser.
+    """
+    series = pd.Series(values)
+    numeric = pd.to_numeric(series, errors="coerce")
+    if numeric.notna().mean() > 0.5:
+        return pd.to_datetime(numeric, unit="s", utc=True, errors="coerce")
+    return pd.to_datetime(series, utc=True, errors="coerce", format="mixed")
+
+
+def item_timestamps(texts, timestamps):
+    """{text: [timestamps in input order]} for the Step 3 input rows, to date the clustered items."""
+    by_text = {}
+    for text, ts in zip(texts, parse_timestamps(timestamps)):
+        by_text.setdefault(text, []).append(None if pd.isna(ts) else ts)
+    return by_text
+
+
+def _item_hash(text, stamp):
+    # Signed 64-bit, to fit SQLite's INTEGER PRIMARY KEY
+    digest = hashlib.blake2b(f"{text}\x1f{stamp}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def _normalize_label(label):
+    return re.sub(r"\s+", " ", str(label or "")).strip().lower()
+
+
+def _buckets(ts):
+    day = ts.date()
+    return day.isoformat(), (day - pd.Timedelta(days=day.weekday())).isoformat()
+
+
+def build_trend_clusters(clustered_df, timestamps_by_text=None, saved_at=None):
+    """
+    The rows save_trend_items needs, from a Step 3 result: per cluster its
+    key, label and (item_hash, day, week-start) for every item.
+    """
+    fallback_ts = pd.Timestamp(saved_at or datetime.now())
+    remaining = {text: list(stamps) for text, stamps in (timestamps_by_text or {}).items()}
+    undated = Counter()
+
+    clusters = []
+    for row in clustered_df.to_dict(orient="records"):
+        if str(row.get("cluster_label", "")).startswith("Error"):
+            continue
+        items = []
+        for text in (t.strip() for t in str(row.get("feedback_text", "")).split(" | ")):
+            if not text:
+                continue
+            # Duplicated texts take their timestamps in input order
+            stamps = remaining.get(text)
+            ts = stamps.pop(0) if stamps else None
+            day, week = _buckets(ts.tz_convert(None) if ts is not None else fallback_ts)
+            if ts is not None:
+                item_hash = _item_hash(text, ts.isoformat())
+            else:
+                # Only the text is known: the save day keeps a re-upload on the
+                # same day from counting twice, the repeat count keeps
+                # duplicates within the run
+                item_hash = _item_hash(text, f"{day}#{undated[text]}")
+                undated[text] += 1
+            items.append((item_hash, day, week))
+        if items:
+            clusters.append({
+                "key": f"trend_{hashlib.blake2b(str(sorted(h for h, _, _ in items)).encode(), digest_size=8).hexdigest()}",
+                "label": row.get("cluster_label"),
+                "label_norm": _normalize_label(row.get("cluster_label")),
+                "items": items,
+            })
+    return clusters
+
+
+def update_trends(run_id, clustered_df, timestamps_by_text=None, match_threshold=TREND_MATCH_THRESHOLD):
+    """Adds a saved Step 3 result to the trend rollups (call it right after save_run_data)."""
+    if clustered_df is None or clustered_df.empty:
+        return
+    with track_stage("trend_rollup", items=len(clustered_df)):
+        save_trend_items(run_id, build_trend_clusters(expand_items(clustered_df, run_id), timestamps_by_text), match_threshold)
+
+
+def trend_frame(trend_keys, granularity="week"):
+    """
+    Counts per bucket for the given trend identities, with missing buckets
+    filled with 0 so growth reads correctly: bucket, trend_key, item_count.
+    """
+    if granularity not in TREND_GRANULARITIES:
+        raise ValueError(f"Unknown granularity '{granularity}'. Use one of {TREND_GRANULARITIES}.")
+    rollups = load_trend_rollups(trend_keys, granularity)
+    if rollups.empty:
+        return rollups
+    rollups["bucket"] = pd.to_datetime(rollups["bucket"])
+    step = "D" if granularity == "day" else "W-MON"
+    full_range = pd.date_range(rollups["bucket"].min(), rollups["bucket"].max(), freq=step)
+    return (
+        rollups.pivot_table(index="bucket", columns="trend_key", values="item_count", aggfunc="sum")
+        .reindex(full_range).fillna(0).astype(np.int64)
+        .rename_axis("bucket").reset_index()
+        .melt(id_vars="bucket", var_name="trend_key", value_name="item_count")
+    )
@@ -0,0 +1,78 @@
+# visualize.py
+import os
+import plotly.express as px
+
+# -------------------------
+# Config / tuning params
+# -------------------------
+# Above this many individual feedback items the treemap shows one box per
+# cluster (sized by item count) instead of one leaf per item; a single
+# cluster's items can still be drilled into on demand.
+TREEMAP_MAX_LEAVES = int(os.getenv("TREEMAP_MAX_LEAVES", "2000"))
+
+TREEMAP_COLUMNS = ["category", "cluster_label", "reasoning", "feedback_text"]
+
+
+def explode_feedback_items(clustered_df):
+    """
+    Splits each cluster's ' | '-joined feedback_text into one row per item
+    using vectorized string split + explode (no Python loop over rows).
+    """
+    items = clustered_df.reindex(columns=TREEMAP_COLUMNS).copy()
+    items["individual_feedback"] = items["feedback_text"].astype(str).str.split(" | ", regex=False)
+    items = items.drop(columns="feedback_text").explode("individual_feedback", ignore_index=True)
+    items["individual_feedback"] = items["individual_feedback"].str.strip()
+    items = items[items["individual_feedback"].fillna("").ne("")].reset_index(drop=True)
+    items["size"] = 1
+    return items
+
+
+def build_treemap_frame(clustered_df, max_leaves=TREEMAP_MAX_LEAVES):
+    """
+    Returns (treemap_df, aggregated). With more than max_leaves items the
+    per-item leaves are collapsed into one row per cluster with a count.
+    """
+    items = explode_feedback_items(clustered_df)
+    if len(items) <= max_leaves:
+        return items, False
+
+    aggregated = (
+        items.groupby(["category", "cluster_label"], sort=False, dropna=False)
+        .agg(reasoning=("reasoning", "first"), size=("size", "sum"))
+        .reset_index()
+    )
+    return aggregated, True
+
+
+def cluster_items(clustered_df, cluster_label):
+    """The individual feedback items of a single cluster (for drill-down)."""
+    return explode_feedback_items(clustered_df[clustered_df["cluster_label"] == cluster_label])
+
+
+def treemap_figure(treemap_df, aggregated=False):
+    """Builds the Plotly treemap for either per-item or per-cluster rows."""
+    if aggregated:
+        fig = px.treemap(
+            treemap_df,
+            path=[px.Constant("All Feedback"), 'category', 'cluster_label'],
+            values='size',
+            color='category',
+            hover_data={'reasoning': True, 'size': True}
+        )
+        fig.update_traces(hovertemplate='<b>Cluster:</b> %{label}<br><b>Items:</b> %{value}<br><b>Reasoning:</b> %{customdata[0]}<extra></extra>')
+    else:
+        fig = px.treemap(
+            treemap_df,
+            path=[px.Constant("All Feedback"), 'category', 'cluster_label', 'individual_feedback'],
+            values='size',
+            color='category',
+            hover_data={
+                'reasoning': True,
+                'cluster_label': True,
+                'individual_feedback': True,
+                'size': False
+            }
+        )
+        fig.update_traces(hovertemplate='<b>Cluster:</b> %{customdata[1]}<br><b>Feedback:</b> %{customdata[2]}<br><b>Reasoning:</b> %{customdata[0]}<extra></extra>')
+    fig.update_layout(margin = dict(t=50, l=25, r=25, b=25))
+    return fig